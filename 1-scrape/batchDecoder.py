@@ -0,0 +1,335 @@
+# Columnar decoding of BigQuery log rows. A full page of rows is decoded at once: the data/topics columns are laid out as fixed-width
+# byte arrays, so that slicing 32-byte words and building addresses happens in NumPy instead of one Python call per row.
+# The rows produced are identical to the rows produced by the Protocol._process_results_* handlers in defiEvents.py, including in
+# fixed-point mode (amounts as fixedPoint.Wei integers) and in address ID mode (addresses as utils/addressBook.py IDs, interned straight from
+# the hex characters of each page, without building a string per address)
+from decimal import Decimal, localcontext
+from itertools import repeat
+
+import numpy as np
+
+from fixedPoint import Wei, SCALE
+from utils.addressBook import AddressId
+
+# Same constants used by Web3.fromWei, so that the column conversion gives the same Decimal values (and the same int 0 for zero amounts)
+_WEI_PER_ETHER = Decimal('1000000000000000000')
+_MAX_WEI = 2 ** 256 - 1
+
+class BatchDecoder:
+    """
+    A class that decodes a whole page of BigQuery rows for a protocol, instead of decoding row by row
+
+    Attributes
+    ----------
+    protocol (Protocol)         The protocol whose rows are decoded
+    supported (Boolean)         Whether a batch handler exists for the protocol (otherwise the per-row handler is used)
+
+    Methods
+    -------
+    __init__                    Sets the batch handler for the protocol
+    process_page                Decodes a page of rows and appends them to sqlArr, in the same format as Protocol.process_results
+    process_rows                Decodes a page of rows one row at a time, with Protocol.process_results
+    handler_name                Returns the name of the function that decodes the rows (for metrics)
+    _split_records              Splits the rows of a RecordSet into one page per record, with the position of each row in the page
+    _append                     Appends decoded rows to sqlArr, skipping repeated rows (Maker), as the per-row handlers do
+     _decode_maker2             Batch handler for Maker version 2
+     _decode_compound2          Batch handler for Compound version 2
+     _decode_uniswap2           Batch handler for Uniswap version 2
+     _decode_aave1              Batch handler for Aave version 1
+    _data_words                 Lays out the data column as an array of rows x hex characters
+    _topic_words                Lays out one topic of every row as an array of rows x hex characters
+    _addr_column                Converts the last 40 hex characters of each word to an address (or to an address ID, in address ID mode)
+    _addr_strings               Converts the last 40 hex characters of each word to an address string
+    _intern                     Converts a column of address strings to address IDs, in address ID mode
+    _int_column                 Converts hex words to (unsigned) integers
+    _twos_comp_column           Converts hex words to absolute values and signs, as in Protocol._twos_comp
+    _wei_column                 Converts wei amounts to decimals, as in Web3.fromWei (or to Wei, in fixed-point mode)
+    _dec_column                 Converts hex words to decimals with a per-row number of decimals, as in Protocol._convert_dec
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+        # Maker V1 and Uniswap V1 are not decoded in batches. They are only kept for reference (only data from the most recent protocol
+        # version was used), so they always go through the per-row handler
+        func_name = f'_decode_{protocol.name.lower()}{protocol.version}'
+        self._decode = getattr(self, func_name, None)
+        self.supported = self._decode is not None
+
+    def process_page(self, rows, record, sqlArr):
+        if (len(rows) == 0):
+            return sqlArr
+
+        # A RecordSet (even with a single record, e.g. allMaker2) dispatches each row to its record by signature, and each record is
+        # decoded as its own page. A Record only holds itself
+        if (record.records == [record]):
+            pages = [(record, list(range(len(rows))), rows)]
+        else:
+            pages = [(item_record, positions, [rows[i] for i in positions]) for item_record, positions in self._split_records(rows, record)]
+
+        # Rows with different data lengths can't be laid out as one array. This does not happen for a single record type, but if it
+        # does, the page is decoded row by row, so that the output is still the same
+        has_data = 'data' in rows[0].keys()
+        if (not self.supported or any(len({len(row['data']) for row in page_rows}) > 1 for _, _, page_rows in pages if has_data)):
+            return self.process_rows(rows, record, sqlArr)
+
+        # Batch handlers return one row per log. The rows of each record are put back at the position of their log, so that the output is
+        # in the same (block and log) order as with the per-row handlers
+        decoded = [None] * len(rows)
+        for item_record, positions, page_rows in pages:
+            partial_cols = (
+                [row['block_timestamp'] for row in page_rows],
+                [row['block_number'] for row in page_rows],
+                [row['transaction_hash'] for row in page_rows],
+            )
+            for position, allFields in zip(positions, self._decode(page_rows, partial_cols, item_record)):
+                decoded[position] = allFields
+        return self._append(decoded, sqlArr)
+
+    def process_rows(self, rows, record, sqlArr):
+        for item in rows:
+            partial_list = {
+                'blockTime': item['block_timestamp'],
+                'blockNumber': item['block_number'],
+                'trxHash': item['transaction_hash']
+            }
+            sqlArr = self.protocol.process_results(item, partial_list, record.record_for(item), sqlArr)
+        return sqlArr
+
+    def handler_name(self, decode_mode):
+        if (decode_mode == 'batch' and self.supported):
+            return self._decode.__name__
+        return self.protocol.process_results.__name__
+
+    def _split_records(self, rows, record):
+        # Positions are in increasing order within each record
+        pages = {}
+        for position, item in enumerate(rows):
+            item_record = record.record_for(item)
+            pages.setdefault(item_record.name, (item_record, []))[1].append(position)
+        return list(pages.values())
+
+    def _append(self, decoded, sqlArr):
+        # Maker logs can be repeated: a row is skipped if it is the same as the previous row (including the last row of the previous page)
+        if (self.protocol.name == 'Maker'):
+            for allFields in decoded:
+                if (len(sqlArr) == 0 or sqlArr[len(sqlArr) - 1] != allFields):
+                    sqlArr.append(allFields)
+        else:
+            sqlArr.extend(decoded)
+        return sqlArr
+
+    def _decode_maker2(self, rows, partial_cols, record):
+        n = len(rows)
+
+        # vaultID (only set for newCdp, which is not currently collected)
+        if (record.name == 'newCdp'):
+            vaultIDs = [x if x <= 4294967295 else 0 for x in self._int_column(self._topic_words(rows, 3))]
+        else:
+            vaultIDs = [None] * n
+
+        # usrAddr
+        if (record.name == 'give'):
+            usrAddrs = self._addr_column(self._topic_words(rows, 3))
+        else:
+            usrAddrs = self._addr_column(self._topic_words(rows, 2))
+
+        # amounts
+        if (record.name == 'frob2'):
+            # Same layout as the custom chunk lengths [64, 64, 8, 64, 64, 64, 64, 64, 64] in the per-row handler: dink and dart are the
+            # last two chunks
+            words = self._data_words(rows)
+            dinkWei, dinkSign = self._twos_comp_column(words[:, 392:456])
+            dartWei, dartSign = self._twos_comp_column(words[:, 456:520])
+            dinkAmts = [amt * sign for amt, sign in zip(self._wei_column(dinkWei), dinkSign)]
+            dartAmts = [amt * sign for amt, sign in zip(self._wei_column(dartWei), dartSign)]
+        else:
+            dinkAmts = [0] * n
+            dartAmts = [0] * n
+
+        # Duplicate rows are skipped by _append, once the rows of every record are back in order
+        return list(map(list, zip(*partial_cols, usrAddrs, dinkAmts, dartAmts, vaultIDs, repeat(record.name, n))))
+
+    def _decode_compound2(self, rows, partial_cols, record):
+        n = len(rows)
+        words = self._data_words(rows)
+
+        # cTokenID and decimals
+        matched = [self.protocol.registry.ctoken(row['address']) for row in rows]
+        cTokenIDs = [token[0] for token in matched]
+        tokenDecimals = [token[1] for token in matched]
+        cTokenDecimals = [self.protocol._cTokenDecimals] * n
+
+        # usrAddr and tokenAmount
+        if (record.name in ['RepayBorrow', 'LiquidateBorrow']):
+            usrAddrs = self._addr_column(words[:, 64:128])
+            tokenAmounts = self._dec_column(words[:, 128:192], tokenDecimals)
+        else:
+            usrAddrs = self._addr_column(words[:, 0:64])
+            tokenAmounts = self._dec_column(words[:, 64:128], tokenDecimals)
+
+        # liquidatorAddr and liquidateCollateralAddr
+        if (record.name == 'LiquidateBorrow'):
+            liquidatorAddrs = self._addr_column(words[:, 0:64])
+            liquidateCollateralAddrs = self._addr_column(words[:, 192:256])
+        else:
+            liquidatorAddrs = [None] * n
+            liquidateCollateralAddrs = [None] * n
+
+        # cTokenAmount
+        if (record.name in ['Mint', 'Redeem']):
+            cTokenAmounts = self._dec_column(words[:, 128:192], cTokenDecimals)
+        elif (record.name == 'LiquidateBorrow'):
+            cTokenAmounts = self._dec_column(words[:, 256:320], cTokenDecimals)
+        else:
+            cTokenAmounts = [0] * n
+
+        # accountBorrowBalance, totalBorrowBalance
+        if (record.name == 'Borrow'):
+            accountBorrowBalances = self._dec_column(words[:, 128:192], tokenDecimals)
+            totalBorrowBalances = self._dec_column(words[:, 192:256], tokenDecimals)
+        elif (record.name == 'RepayBorrow'):
+            accountBorrowBalances = self._dec_column(words[:, 192:256], tokenDecimals)
+            totalBorrowBalances = self._dec_column(words[:, 256:320], tokenDecimals)
+        else:
+            accountBorrowBalances = [0] * n
+            totalBorrowBalances = [0] * n
+
+        return list(map(list, zip(
+            *partial_cols, usrAddrs, liquidatorAddrs, cTokenIDs, tokenAmounts, cTokenAmounts, liquidateCollateralAddrs,
+            accountBorrowBalances, totalBorrowBalances, repeat(record.name, n)
+        )))
+
+    def _decode_uniswap2(self, rows, partial_cols, record):
+        n = len(rows)
+        words = self._data_words(rows)
+
+        # pairID and decimals
+        matched = [self.protocol.registry.pair(row['address']) for row in rows]
+        pairIDs = [pair[0] for pair in matched]
+        token0Decimals = [pair[1] for pair in matched]
+        token1Decimals = [pair[2] for pair in matched]
+
+        # send/receiveAddr
+        sendAddrs = self._addr_column(self._topic_words(rows, 1))
+        receiveAddrs = self._addr_column(self._topic_words(rows, 2))
+
+        # amounts
+        amount0In = self._dec_column(words[:, 0:64], token0Decimals)
+        amount1In = self._dec_column(words[:, 64:128], token1Decimals)
+        amount0Out = self._dec_column(words[:, 128:192], token0Decimals)
+        amount1Out = self._dec_column(words[:, 192:256], token1Decimals)
+
+        return list(map(list, zip(
+            *partial_cols, sendAddrs, receiveAddrs, pairIDs, amount0In, amount1In, amount0Out, amount1Out, repeat(record.name, n)
+        )))
+
+    def _decode_aave1(self, rows, partial_cols, record):
+        n = len(rows)
+        words = self._data_words(rows)
+
+        # Addresses. The reserve and collateral addresses are kept as strings until the decimals are looked up (the registry is indexed by
+        # address string)
+        if (record.name == 'LiquidationCall'):
+            reserveAddrs = self._addr_strings(self._topic_words(rows, 2))
+            usrAddrs = self._addr_column(self._topic_words(rows, 3))
+            liquidatorAddrs = self._addr_column(words[:, 192:256])
+            liquidateCollateralAddrs = self._addr_strings(self._topic_words(rows, 1))
+        else:
+            reserveAddrs = self._addr_strings(self._topic_words(rows, 1))
+            usrAddrs = self._addr_column(self._topic_words(rows, 2))
+            liquidatorAddrs = [None] * n
+            liquidateCollateralAddrs = [None] * n
+
+        # Decimals (if the token is not found, then the registry assumes 18 decimals)
+        reserveDecimals = [self.protocol.registry.reserve_decimals(addr) for addr in reserveAddrs]
+        liquidateDecimals = [self.protocol.registry.reserve_decimals(addr) for addr in liquidateCollateralAddrs]
+
+        # tokenAmount
+        tokenAmounts = self._dec_column(words[:, 0:64], reserveDecimals)
+
+        # liquidateCollateralAmt
+        if (record.name == 'LiquidationCall'):
+            liquidateCollateralAmts = self._dec_column(words[:, 64:128], liquidateDecimals)
+        else:
+            liquidateCollateralAmts = [0] * n
+
+        # Origination Fee
+        if (record.name == 'Borrow'):
+            originationFees = self._dec_column(words[:, 192:256], [27] * n) # Convert to ray (take out 9 decimals)
+        else:
+            originationFees = [0] * n
+
+        reserveAddrs = self._intern(reserveAddrs)
+        if (record.name == 'LiquidationCall'):
+            liquidateCollateralAddrs = self._intern(liquidateCollateralAddrs)
+
+        return list(map(list, zip(
+            *partial_cols, usrAddrs, liquidatorAddrs, reserveAddrs, tokenAmounts, originationFees, liquidateCollateralAmts,
+            liquidateCollateralAddrs, repeat(record.name, n)
+        )))
+
+    def _data_words(self, rows):
+        # Join the data column into one buffer, then view it as rows x characters. The "0x" prefix is dropped, so that word k is at
+        # columns [64k, 64k + 64)
+        data = ''.join([row['data'] for row in rows]).encode('ascii')
+        return np.frombuffer(data, dtype=np.uint8).reshape(len(rows), -1)[:, 2:]
+
+    def _topic_words(self, rows, position):
+        # Topics are always 32 bytes ("0x" + 64 characters)
+        topics = ''.join([row['topics'][position] for row in rows]).encode('ascii')
+        return np.frombuffer(topics, dtype=np.uint8).reshape(len(rows), 66)[:, 2:]
+
+    def _addr_column(self, words):
+        address_book = self.protocol.address_book
+        if (address_book is not None):
+            return list(map(AddressId, address_book.hex_ids(words[:, -40:]).tolist()))
+        return self._addr_strings(words)
+
+    def _addr_strings(self, words):
+        # An address is "0x" + the last 40 characters of the word
+        addrs = np.empty((words.shape[0], 42), dtype=np.uint8)
+        addrs[:, 0] = ord('0')
+        addrs[:, 1] = ord('x')
+        addrs[:, 2:] = words[:, -40:]
+        return addrs.view('S42').ravel().astype('U42').tolist()
+
+    def _intern(self, addrs):
+        address_book = self.protocol.address_book
+        if (address_book is None):
+            return addrs
+        return list(map(AddressId, address_book.ids(addrs).tolist()))
+
+    def _int_column(self, words):
+        hex_words = np.ascontiguousarray(words).view(f'S{words.shape[1]}').ravel().tolist()
+        return list(map(int, hex_words, repeat(16)))
+
+    def _twos_comp_column(self, words):
+        values = self._int_column(words)
+        # A value is negative if the first bit is set, i.e. if the first hex character is 8-f. The negative value is returned as a
+        # positive amount and a sign, because fromWei can only handle positive values
+        negative = (words[:, 0] >= ord('8')).tolist()
+        amounts = [(1 << 256) - value if neg else value for value, neg in zip(values, negative)]
+        signs = [-1 if neg else 1 for neg in negative]
+        return amounts, signs
+
+    def _wei_column(self, values):
+        # Same steps as Web3.fromWei, but with one decimal context for the whole column
+        for value in values:
+            if (value < 0 or value > _MAX_WEI):
+                raise ValueError("value must be between 1 and 2**256 - 1")
+        if (self.protocol.fixed_point):
+            return list(map(Wei, values))
+        with localcontext() as ctx:
+            ctx.prec = 999
+            return [Decimal(value) / _WEI_PER_ETHER if value != 0 else 0 for value in values]
+
+    def _dec_column(self, words, decimals):
+        # Same normalization to 18 decimals as Protocol._convert_dec (fixedPoint.scale_units), with one multiplier and one divisor per row
+        values = np.array(self._int_column(words), dtype=object)
+        multipliers = np.array([10 ** (SCALE - d) if d <= SCALE else 1 for d in decimals], dtype=object)
+        divisors = np.array([10 ** (d - SCALE) if d > SCALE else 1 for d in decimals], dtype=object)
+        return self._wei_column((values * multipliers // divisors).tolist())
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.protocol})')
@@ -0,0 +1,321 @@
+# Throughput benchmark of the decoders. Synthetic logs (syntheticLogs.py) of every valid record of every protocol are decoded by the
+# per-row handler (Protocol._process_results_*), by the batch decoder (batchDecoder.py) where one exists, and end to end by
+# RecordExplorer.transform_results (all records of a protocol in one scan, Stage 2: decoded but not inserted). The handlers are timed with
+# Decimal amounts, and in fixed-point mode (integer amounts, fixedPoint.py). The helpers _convert_dec, _twos_comp and _chunk_data are also
+# timed on their own. Before a batch decoder or an end-to-end batch run is timed, its rows are compared to the rows of the per-row path
+# (checkDecoders.py), in order, and the benchmark stops if they differ, so that a speedup can't come from wrong rows.
+# Each benchmark reports rows per second (best of several runs) and the memory allocated while decoding (peak and retained, with
+# tracemalloc, in a separate run). Rates are compared to a baseline stored on the first run (cache/decodeBaseline.json): the script exits
+# with status 1 if a benchmark is slower than its baseline by more than the tolerance. Timings depend on the machine, so the baseline is
+# local, and is only replaced with --update-baseline
+#
+# Usage: python benchDecoders.py [--rows 20000] [--repeat 3] [--tolerance 0.25] [--only Uniswap2] [--output report.json] [--update-baseline]
+
+# Need to complete this action so that files can be imported from the parent directory structure
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import argparse, gc, json, platform, tempfile, tracemalloc
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+import defiEvents
+from batchDecoder import BatchDecoder
+from syntheticLogs import SyntheticLogs
+from checkDecoders import first_difference, decode_both
+
+# Default location of the stored baseline
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'decodeBaseline.json')
+
+class SyntheticJob:
+    """
+    A class representing synthetic rows, with the same interface as a BigQuery job (for RecordExplorer.transform_results)
+
+    Attributes
+    ----------
+    created (Datetime)              Time the job was created
+    ended (Datetime)                Time the job ended (same as created)
+    total_bytes_processed (Integer) Size of the rows (0, nothing is scanned)
+    _rows (Array)                   Rows of the job
+
+    Methods
+    -------
+    __init__                        Saves the rows
+    result                          Returns the rows, in pages
+    __repr__                        Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, rows):
+        self._rows = rows
+        self.created = self.ended = datetime.now(timezone.utc)
+        self.total_bytes_processed = 0
+
+    def result(self, page_size = None):
+        return SyntheticRowIterator(self._rows, page_size)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self._rows)} rows)')
+
+class SyntheticRowIterator:
+    """
+    A class representing the rows of a synthetic job, with the same interface as a BigQuery row iterator
+
+    Attributes
+    ----------
+    _rows (Array)               Rows of the job
+    _page_size (Integer)        Number of rows per page
+
+    Methods
+    -------
+    __init__                    Saves the rows
+    pages                       Returns the rows in pages
+    """
+    def __init__(self, rows, page_size = None):
+        self._rows = rows
+        self._page_size = page_size or 10000
+
+    @property
+    def pages(self):
+        for k in range(0, len(self._rows), self._page_size):
+            yield self._rows[k:k+self._page_size]
+
+class SyntheticSources:
+    """
+    A class that stands in for ExternalSources in end-to-end runs: results come from synthetic rows, and nothing is written to SQL
+
+    Attributes
+    ----------
+    registry (ReferenceRegistry)    Synthetic reference data
+    results (SyntheticJob)      Rows of the run
+    temp_used (Boolean)         Whether the results are decoded (always True)
+    cursor (SyntheticSources)   Cursor closed at the end of the run (the object itself, which has nothing to close)
+
+    Methods
+    -------
+    __init__                    Saves the rows
+    close                       Does nothing (closes the cursor)
+    """
+    def __init__(self, registry, rows):
+        self.registry = registry
+        self.results = SyntheticJob(rows)
+        self.temp_used = True
+        self.cursor = self
+
+    def close(self):
+        pass
+
+class DecoderBenchmark:
+    """
+    A class that times the decoders on synthetic logs, and compares the rates to a stored baseline
+
+    Attributes
+    ----------
+    rows (Integer)              Number of rows decoded by each benchmark
+    repeat (Integer)            Number of timed runs of each benchmark (the best one is kept)
+    page_size (Integer)         Number of rows per page (batch decoder and end-to-end runs)
+    only (String)               Only runs the benchmarks whose name starts with this text (None for all)
+    results (Dictionary)        Rows per second and allocated memory, by benchmark name
+    _logs (SyntheticLogs)       Generator of the synthetic rows
+
+    Methods
+    -------
+    __init__                    Creates the generator of synthetic rows
+    run                         Runs every benchmark, and returns the results
+    compare                     Returns the benchmarks slower than their baseline by more than the tolerance
+    _handlers                   Benchmarks of the per-row handlers and batch decoders, for each record (Decimal and fixed-point amounts)
+    _helpers                    Benchmarks of _convert_dec, _twos_comp and _chunk_data
+    _end_to_end                 Benchmarks of RecordExplorer.transform_results, for each protocol
+    _selected                   Returns whether a benchmark (or group of benchmarks) is selected by the filter
+    _check_rows                 Raises an error if the rows of the batch path differ from the rows of the per-row path
+    _measure                    Times a function on a number of rows, and measures the memory it allocates
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, snapshot_path, rows = 20000, repeat = 3, page_size = 10000, seed = 0, only = None):
+        self.rows = rows
+        self.repeat = repeat
+        self.page_size = page_size
+        self.only = only
+        self.results = {}
+        self._logs = SyntheticLogs(snapshot_path, seed = seed)
+
+    def run(self):
+        for protocol in self._logs.protocols():
+            self._handlers(protocol)
+            self._end_to_end(protocol)
+        self._helpers()
+        return self.results
+
+    def compare(self, baseline, tolerance):
+        regressions = {}
+        for name, result in self.results.items():
+            if (name in baseline and result['rows_per_sec'] < baseline[name]['rows_per_sec'] * (1 - tolerance)):
+                regressions[name] = (baseline[name]['rows_per_sec'], result['rows_per_sec'])
+        return regressions
+
+    def _handlers(self, protocol):
+        decoder = BatchDecoder(protocol)
+        for record in self._logs.records(protocol):
+            name = f'{protocol.name}{protocol.version}/{record.name}'
+            if (not self._selected(name)):
+                continue
+            rows = self._logs.rows(protocol, record, self.rows)
+            for fixed_point, suffix in [(False, ''), (True, ' (fixed point)')]:
+                protocol.fixed_point = fixed_point
+                self._measure(f'{name}/row{suffix}', len(rows), lambda: decoder.process_rows(rows, record, []))
+                if (decoder.supported and self._selected(f'{name}/batch{suffix}')):
+                    self._check_rows(f'{name}/batch{suffix}', *decode_both(decoder, record, rows, self.page_size))
+                    self._measure(f'{name}/batch{suffix}', len(rows), lambda: [
+                        decoder.process_page(rows[k:k+self.page_size], record, []) for k in range(0, len(rows), self.page_size)
+                    ])
+            protocol.fixed_point = False
+
+    def _helpers(self):
+        if (not self._selected('helpers/')):
+            return
+
+        # Words of Uniswap V2 swaps (amounts with mixed decimals) and Maker V2 frobs (signed amounts)
+        protocols = {(protocol.name, protocol.version): protocol for protocol in self._logs.protocols()}
+        uniswap = protocols[('Uniswap', 2)]
+        maker = protocols[('Maker', 2)]
+        swaps = self._logs.rows(uniswap, self._logs.records(uniswap)[0], self.rows)
+        frobs = self._logs.rows(maker, self._logs.records(maker)[0], self.rows)
+        frob_layout = [64, 64, 8, 64, 64, 64, 64, 64, 64]
+        amounts = [(row['data'][2:66], decimals) for row, decimals in zip(swaps, [6, 8, 18, 27] * len(swaps))]
+        signed = [row['data'][394:458] for row in frobs]
+
+        self._measure('helpers/_convert_dec', len(amounts), lambda: [uniswap._convert_dec(word, decimals) for word, decimals in amounts])
+        self._measure('helpers/_twos_comp', len(signed), lambda: [maker._twos_comp(word) for word in signed])
+        self._measure('helpers/_chunk_data', len(swaps), lambda: [uniswap._chunk_data(row['data']) for row in swaps])
+        self._measure('helpers/_chunk_data (custom)', len(frobs), lambda: [maker._chunk_data(row['data'], frob_layout) for row in frobs])
+
+    def _end_to_end(self, protocol):
+        name = f'{protocol.name}{protocol.version}/transform_results'
+        if (not self._selected(name)):
+            return
+        explorer = defiEvents.RecordExplorer()
+        explorer.set_metrics(report_dir = None)
+        explorer.protocol = protocol
+        explorer.set_records()
+        explorer.set_stage(2)
+        explorer.set_page_size(self.page_size)
+        rows = self._logs.rows(protocol, explorer.record, self.rows)
+
+        # Rows of the whole run (duplicate removal and decoding, page by page), in the order they would be inserted
+        outputs = {}
+        for decode_mode in ['row', 'batch']:
+            explorer.set_decode_mode(decode_mode)
+            outputs[decode_mode] = [row for _, sqlArr, _ in explorer._result_pages(SyntheticJob(rows)) for row in sqlArr]
+        self._check_rows(f'{name}/batch', outputs['row'], outputs['batch'])
+
+        for decode_mode in ['row', 'batch']:
+            explorer.set_decode_mode(decode_mode)
+            def transform():
+                # Each run starts from new results, with the same rows
+                explorer.ex_sources = SyntheticSources(self._logs.registry, rows)
+                explorer.transform_results()
+            self._measure(f'{name}/{decode_mode}', len(rows), transform)
+
+    def _selected(self, name):
+        # A name is selected if it starts with the filter (e.g. Maker2), or if the filter starts with it (e.g. helpers/_twos_comp)
+        return self.only is None or name.startswith(self.only) or self.only.startswith(name)
+
+    def _check_rows(self, name, expected, actual):
+        position = first_difference(expected, actual)
+        if (position is not None):
+            raise ValueError(
+                f'{name}: batch rows differ from per-row rows from row {position} ({len(actual)} batch rows, {len(expected)} per-row rows). '
+                'Fix the batch decoder before timing it (python checkDecoders.py)'
+            )
+
+    def _measure(self, name, n, function):
+        if (not self._selected(name)):
+            return
+
+        # Timed runs, without tracing (tracemalloc slows allocations down)
+        best = None
+        for _ in range(self.repeat):
+            gc.collect()
+            start = timer()
+            function()
+            elapsed = timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        # Memory allocated while decoding: peak, and still held by the result when the function returns
+        gc.collect()
+        tracemalloc.start()
+        result = function()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del result
+
+        self.results[name] = {
+            'rows': n,
+            'seconds': best,
+            'rows_per_sec': n / best if best > 0 else float('inf'),
+            'peak_bytes_per_row': peak / n,
+            'retained_bytes_per_row': retained / n,
+        }
+        print(f'{name:<50} {self.results[name]["rows_per_sec"]:>12,.0f} rows/s {peak / n:>10,.0f} B/row peak {retained / n:>10,.0f} B/row retained')
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.rows} rows, best of {self.repeat})')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Decoder throughput benchmark on synthetic logs')
+    parser.add_argument('--rows', type = int, default = 20000, help = 'rows decoded by each benchmark')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'timed runs of each benchmark (the best one is kept)')
+    parser.add_argument('--page-size', type = int, default = 10000, help = 'rows per page (batch decoder and end-to-end runs)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic rows')
+    parser.add_argument('--only', default = None, help = 'only run benchmarks whose name starts with this text (e.g. Maker2, helpers)')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'allowed slowdown compared to the baseline (0.25 = 25%%)')
+    parser.add_argument('--baseline', default = BASELINE_PATH, help = 'location of the stored baseline')
+    parser.add_argument('--update-baseline', action = 'store_true', help = 'replace the baseline with the results of this run')
+    parser.add_argument('--output', default = None, help = 'write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        benchmark = DecoderBenchmark(
+            os.path.join(snapshot_dir, 'refData.json'), args.rows, args.repeat, args.page_size, args.seed, args.only
+        )
+        results = benchmark.run()
+
+    report = {
+        'created': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'rows': args.rows,
+        'seed': args.seed,
+        'results': results,
+    }
+    if (args.output is not None):
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+
+    # The first run (or --update-baseline) stores the baseline. Later runs are compared to it
+    if (args.update_baseline or not os.path.exists(args.baseline)):
+        baseline = {}
+        if (os.path.exists(args.baseline)):
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        report['results'] = {**baseline, **results}
+        os.makedirs(os.path.dirname(args.baseline), exist_ok = True)
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline['rows'] != args.rows or baseline['seed'] != args.seed):
+        print(f'WARNING: baseline was measured with {baseline["rows"]} rows and seed {baseline["seed"]}')
+    regressions = benchmark.compare(baseline['results'], args.tolerance)
+    if (len(regressions) > 0):
+        print('-'*60)
+        print(f'Slower than the baseline by more than {args.tolerance:.0%}:')
+        for name, (before, after) in regressions.items():
+            print(f'    {name}: {before:,.0f} -> {after:,.0f} rows/s ({after / before - 1:+.0%})')
+        return 1
+    print(f'No regression compared to the baseline ({len(set(results) & set(baseline["results"]))} benchmarks compared)')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# Bulk-load sink for PageWriter. Decoded rows are staged (in a tab-separated file, or in memory) and loaded in large chunks, each chunk in
+# one transaction: with LOAD DATA LOCAL INFILE ('load'), or with large multi-row INSERT statements ('insert'). Datetimes are passed as
+# DATETIME values, instead of strings converted with STR_TO_DATE. Secondary indexes can be dropped before the load and rebuilt afterwards,
+# which is much faster than updating them for every row. With a watermark (watermarks.py), rows are only committed at checkpoints, in one
+# transaction per block chunk
+import os, re, tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from timeit import default_timer as timer
+
+from fixedPoint import Wei
+
+class BulkLoadSink:
+    """
+    A class that loads rows into a protocol table in large transactional chunks
+
+    Attributes
+    ----------
+    table (String)              Table loaded (from the protocol's insert query)
+    columns (Array)             Columns loaded (from the protocol's insert query)
+    method (String)             'load' for LOAD DATA LOCAL INFILE, 'insert' for multi-row INSERT statements
+    chunk_rows (Integer)        Number of rows per transaction
+    statement_rows (Integer)    Number of rows per INSERT statement (only for 'insert')
+    rebuild_indexes (Boolean)   Whether secondary indexes are dropped before the load and rebuilt afterwards
+    watermark (Watermark)       Watermark updated at each checkpoint (None if each chunk is committed once loaded)
+    address_book (AddressBook)  Address book of the address IDs in the rows, written as address strings (None if rows hold strings)
+    _staged (Integer)           Number of rows staged for the current chunk
+    _stage_file (File)          Tab-separated file with the staged rows (only for 'load')
+    _stage_rows (Array)         Staged rows (only for 'insert')
+    _indexes (Dictionary)       Definitions of the dropped indexes, by index name
+
+    Methods
+    -------
+    __init__                    Sets the table, columns and options
+    open                        Creates the cursor, drops secondary indexes if needed, and starts staging the first chunk
+    write                       Stages a page of rows, and loads the chunk when it is full
+    checkpoint                  Loads the staged rows, and commits them together with the watermark
+    abort                       Rolls back the uncommitted rows, and rebuilds the dropped indexes
+    close                       Loads the last chunk and rebuilds the dropped indexes
+    _release                    Removes the staging file, rebuilds the dropped indexes and closes the cursor
+    _new_chunk                  Starts staging a new chunk
+    _load_chunk                 Loads the staged chunk (committed by the caller)
+    _drop_indexes               Drops the non-unique secondary indexes of the table
+    _rebuild_indexes            Adds back the dropped indexes
+    _field                      Formats a value for the staging file
+    _value                      Converts a value to a type accepted by the MySQL connector
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, insert_query, method = 'load', chunk_rows = 500000, statement_rows = 5000, rebuild_indexes = False,
+        watermark = None, address_book = None):
+        # Table and columns are the same as in the protocol's insert query
+        match = re.match(r'\s*INSERT INTO (\w+)\s*\(([^)]*)\)', insert_query)
+        self.table = match.group(1)
+        self.columns = [column.strip() for column in match.group(2).split(',')]
+
+        self.method = method
+        self.chunk_rows = chunk_rows
+        self.statement_rows = statement_rows
+        self.rebuild_indexes = rebuild_indexes
+        self.watermark = watermark
+        self.address_book = address_book
+        self._staged = 0
+        self._stage_file = None
+        self._stage_rows = []
+        self._indexes = {}
+
+    def open(self, db):
+        self._db = db
+        self._cursor = db.cursor()
+        # Each chunk (or each block chunk, with a watermark) is committed on its own, so a failed run keeps everything committed before
+        # the failure
+        self._db.autocommit = False
+        if (self.rebuild_indexes):
+            self._drop_indexes()
+        self._new_chunk()
+
+    def write(self, rows):
+        if (self.method == 'load'):
+            lines = ['\t'.join([self._field(value) for value in row]) + '\n' for row in rows]
+            self._stage_file.writelines(lines)
+        else:
+            self._stage_rows.extend([[self._value(value) for value in row] for row in rows])
+        self._staged += len(rows)
+
+        # With a watermark, full chunks are loaded but not committed: the transaction stays open until the end of the block chunk
+        if (self._staged >= self.chunk_rows):
+            self._load_chunk()
+            if (self.watermark is None):
+                self._db.commit()
+            self._new_chunk()
+
+    def checkpoint(self, block):
+        if (self._staged > 0):
+            self._load_chunk()
+        self.watermark.write(self._cursor, block)
+        self._db.commit()
+        self._new_chunk()
+
+    def abort(self):
+        self._db.rollback()
+        self._release()
+
+    def close(self):
+        try:
+            # With a watermark, rows after the last checkpoint are not committed (they are loaded again when the run resumes)
+            if (self._staged > 0 and self.watermark is None):
+                self._load_chunk()
+                self._db.commit()
+            else:
+                self._db.rollback()
+        except Exception:
+            self._db.rollback()
+            raise
+        finally:
+            self._release()
+
+    def _release(self):
+        if (self._stage_file is not None):
+            self._stage_file.close()
+            os.remove(self._stage_file.name)
+            self._stage_file = None
+        # Indexes are rebuilt even if the load failed, so that the table is never left without them. The failed rows must be rolled back
+        # first, because ALTER TABLE commits the open transaction
+        if (len(self._indexes) > 0):
+            self._rebuild_indexes()
+        self._cursor.close()
+
+    def _new_chunk(self):
+        self._staged = 0
+        self._stage_rows = []
+        if (self.method == 'load'):
+            if (self._stage_file is not None):
+                self._stage_file.close()
+                os.remove(self._stage_file.name)
+            self._stage_file = tempfile.NamedTemporaryFile('w', suffix = '.tsv', delete = False)
+
+    def _load_chunk(self):
+        start = timer()
+        columns = ', '.join(self.columns)
+        try:
+            if (self.method == 'load'):
+                self._stage_file.flush()
+                query = (
+                    f"LOAD DATA LOCAL INFILE '{self._stage_file.name}' INTO TABLE {self.table} "
+                    f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' ({columns})"
+                )
+                self._cursor.execute(query)
+            else:
+                placeholders = '(' + ', '.join(['%s'] * len(self.columns)) + ')'
+                for i in range(0, len(self._stage_rows), self.statement_rows):
+                    statement_rows = self._stage_rows[i:i+self.statement_rows]
+                    query = f"INSERT INTO {self.table} ({columns}) VALUES " + ', '.join([placeholders] * len(statement_rows))
+                    self._cursor.execute(query, [value for row in statement_rows for value in row])
+        except Exception:
+            self._db.rollback()
+            raise
+        seconds = timer() - start
+        print(f'Loaded {self._staged} rows into {self.table} in {seconds:.1f} s ({self._staged / max(seconds, 1e-9):,.0f} rows/s)')
+
+    def _drop_indexes(self):
+        # Only non-unique secondary indexes are dropped. The primary key and unique indexes are kept, so that they are still enforced
+        self._cursor.execute(f'SHOW INDEX FROM {self.table}')
+        names = [column[0] for column in self._cursor.description]
+        for row in self._cursor.fetchall():
+            index = dict(zip(names, row))
+            if (index['Key_name'] == 'PRIMARY' or int(index['Non_unique']) == 0):
+                continue
+            column = f"`{index['Column_name']}`" + (f"({index['Sub_part']})" if index['Sub_part'] is not None else '')
+            self._indexes.setdefault(index['Key_name'], []).append((int(index['Seq_in_index']), column))
+
+        if (len(self._indexes) > 0):
+            print(f'Dropping indexes on {self.table}: {", ".join(self._indexes)}')
+            self._cursor.execute(f'ALTER TABLE {self.table} ' + ', '.join([f'DROP INDEX `{name}`' for name in self._indexes]))
+
+    def _rebuild_indexes(self):
+        definitions = []
+        for name, columns in self._indexes.items():
+            definitions.append(f'ADD INDEX `{name}` (' + ', '.join([column for _, column in sorted(columns)]) + ')')
+        print(f'Rebuilding indexes on {self.table}: {", ".join(self._indexes)}')
+        self._cursor.execute(f'ALTER TABLE {self.table} ' + ', '.join(definitions))
+        self._indexes = {}
+
+    def _field(self, value):
+        # NULL is written as \N. Decimals are written in fixed-point notation (never with an exponent), and so are fixed-point amounts.
+        # Address IDs are written as address strings
+        if (self.address_book is not None):
+            value = self.address_book.sql_value(value)
+        if (value is None):
+            return '\\N'
+        if (isinstance(value, Decimal)):
+            return format(value, 'f')
+        if (isinstance(value, Wei)):
+            return value.literal()
+        if (isinstance(value, datetime)):
+            return self._value(value).strftime('%Y-%m-%d %H:%M:%S')
+        return str(value)
+
+    def _value(self, value):
+        # Block timestamps are in UTC. They are stored without a time zone, as DATETIME values. Fixed-point amounts are passed as decimal
+        # literals (the MySQL connector only converts built-in types), and address IDs as address strings
+        if (self.address_book is not None):
+            value = self.address_book.sql_value(value)
+        if (isinstance(value, datetime) and value.tzinfo is not None):
+            return value.astimezone(timezone.utc).replace(tzinfo = None)
+        if (isinstance(value, Wei)):
+            return value.literal()
+        return value
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.table}, {self.method})')
@@ -0,0 +1,112 @@
+# Check that the batch decoder (batchDecoder.py) gives the same rows as the per-row handlers (Protocol._process_results_*). Synthetic logs
+# (syntheticLogs.py) of each record, and of all records of a protocol in one scan (RecordSet, as with RecordExplorer.set_records()), are
+# decoded both ways, page by page, with Decimal and fixed-point amounts, and with address strings and address IDs. The rows must be equal
+# and in the same order (block and log order, which the Maker duplicate check relies on). The script exits with status 1 if any rows differ.
+# The benchmark (benchDecoders.py) runs the same comparison before it times a batch decoder
+#
+# Usage: python checkDecoders.py [--rows 5000] [--page-size 777] [--seed 0] [--only Maker2]
+
+# Need to complete this action so that files can be imported from the parent directory structure
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import argparse, tempfile
+
+from defiEvents import RecordSet
+from batchDecoder import BatchDecoder
+from syntheticLogs import SyntheticLogs
+from utils.addressBook import AddressBook
+
+def first_difference(expected, actual):
+    # Position of the first row that differs (None if the rows are the same, in the same order)
+    for position, (expected_row, actual_row) in enumerate(zip(expected, actual)):
+        if (expected_row != actual_row):
+            return position
+    if (len(expected) != len(actual)):
+        return min(len(expected), len(actual))
+    return None
+
+def decode_both(decoder, record, rows, page_size):
+    # Pages are decoded into the same array, so that duplicate checks (Maker) also compare against the last row of the previous page, as
+    # with one call of the per-row handler on all rows
+    expected = decoder.process_rows(rows, record, [])
+    actual = []
+    for k in range(0, len(rows), page_size):
+        actual = decoder.process_page(rows[k:k+page_size], record, actual)
+    return expected, actual
+
+class DecoderCheck:
+    """
+    A class that compares the rows of the batch decoder to the rows of the per-row handlers, on synthetic logs
+
+    Attributes
+    ----------
+    rows (Integer)              Number of rows decoded by each check
+    page_size (Integer)         Number of rows per page of the batch decoder
+    only (String)               Only runs the checks whose name starts with this text (None for all)
+    failures (Array)            Names of the checks whose rows differ
+    _logs (SyntheticLogs)       Generator of the synthetic rows
+
+    Methods
+    -------
+    __init__                    Creates the generator of synthetic rows
+    run                         Runs every check, and returns the names of the checks whose rows differ
+    _check                      Compares the rows of a record (or RecordSet) in every mode
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, snapshot_path, rows = 5000, page_size = 777, seed = 0, only = None):
+        self.rows = rows
+        self.page_size = page_size
+        self.only = only
+        self.failures = []
+        self._logs = SyntheticLogs(snapshot_path, seed = seed)
+
+    def run(self):
+        for protocol in self._logs.protocols():
+            decoder = BatchDecoder(protocol)
+            if (not decoder.supported):
+                continue
+            for record in self._logs.records(protocol) + [RecordSet(protocol)]:
+                self._check(decoder, record)
+        return self.failures
+
+    def _check(self, decoder, record):
+        protocol = decoder.protocol
+        name = f'{protocol.name}{protocol.version}/{record.name}'
+        if (self.only is not None and not name.startswith(self.only)):
+            return
+        rows = self._logs.rows(protocol, record, self.rows)
+        for fixed_point, address_book, suffix in [(False, None, ''), (True, None, ' (fixed point)'), (False, AddressBook(None), ' (address IDs)')]:
+            protocol.fixed_point = fixed_point
+            protocol.address_book = address_book
+            expected, actual = decode_both(decoder, record, rows, self.page_size)
+            position = first_difference(expected, actual)
+            if (position is None):
+                print(f'{name + suffix:<50} {len(expected):>8} rows  same')
+            else:
+                self.failures.append(name + suffix)
+                print(f'{name + suffix:<50} {len(expected):>8} rows  DIFFERENT from row {position} ({len(actual)} batch rows)')
+        protocol.fixed_point = False
+        protocol.address_book = None
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.rows} rows, {self.page_size} rows per page)')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Compares the batch decoder to the per-row handlers on synthetic logs')
+    parser.add_argument('--rows', type = int, default = 5000, help = 'rows decoded by each check')
+    parser.add_argument('--page-size', type = int, default = 777, help = 'rows per page of the batch decoder')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the synthetic rows')
+    parser.add_argument('--only', default = None, help = 'only run checks whose name starts with this text (e.g. Maker2)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        failures = DecoderCheck(os.path.join(snapshot_dir, 'refData.json'), args.rows, args.page_size, args.seed, args.only).run()
+    if (len(failures) > 0):
+        print(f'Batch rows differ from per-row rows: {", ".join(failures)}')
+        return 1
+    print('Batch rows are the same as per-row rows')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,13 +6,17 @@ import defiEvents
 try:
     explorer = defiEvents.RecordExplorer()
 
-    # Connect to MySQL
+    # Connect to MySQL. To save the rows fetched from BigQuery to a local cache (and read them from it on reruns), call
+    # explorer.set_log_cache() before connecting
     explorer.connect()
 
     # Set protocol and version, event type, and stage
     explorer.set_protocol('Maker', '2')
     explorer.set_record('frob')
+    # To collect all records of the protocol in a single scan, use set_records() instead of set_record()
     explorer.set_stage(0)
+    # In Stage 3, set_incremental() only ingests blocks above the last committed block (watermark) of the record
+    # A JSON metrics report is written to 1-scrape/cache/metrics after each run. set_metrics(profile = True) also samples the decode loop
 
     # Print information on production environment
     explorer.print_environ()
@@ -0,0 +1,80 @@
+# Removal of duplicate log rows before decoding. The logs table can contain the same log more than once; the per-row handlers only drop a
+# duplicate when it directly follows the original, so duplicates further apart (or across pages) were inserted twice. Here rows are keyed
+# by (transaction hash, log index, record). A duplicate is always in the same block as the original (same transaction), so when rows
+# arrive in block order, only the keys of the current block are kept. Otherwise, every key is kept in an exact set (a probabilistic filter
+# would drop real logs on a false positive). Keys are packed into bytes to limit memory, and the set stops growing once it holds its
+# capacity: later rows are still compared to the keys kept and to the rows of their page, so no real log is dropped and the run goes on,
+# but some duplicates may be kept. Large ranges should be run in sharded or incremental mode, where rows are ordered.
+# Only copies of the same log (same log index) are found. Maker LogNote calls that are logged twice have different log indexes, so they
+# are not removed here: the per-row and batch handlers skip them, when the repeated row follows the original
+
+class LogDeduplicator:
+    """
+    A class that removes duplicate log rows from a stream of pages, with bounded memory
+
+    Attributes
+    ----------
+    ordered (Boolean)           Whether rows arrive in block order (keys of the current block) or not (keys of all rows)
+    capacity (Integer)          Maximum number of keys kept (unordered rows)
+    full (Boolean)              Whether the capacity was reached (keys of later rows are no longer kept)
+    duplicates (Integer)        Number of duplicate rows removed so far
+    _block (Integer)            Block of the keys kept (ordered rows)
+    _block_keys (Set)           Keys seen in the current block (ordered rows)
+    _keys (Set)                 Keys seen so far (unordered rows)
+
+    Methods
+    -------
+    __init__                    Sets the mode and the capacity
+    expect                      Warns, before the first page, if the query has more rows than the capacity
+    filter                      Returns the rows of a page whose key was not seen before
+    _key                        Returns the key of a row (transaction hash, log index and record, packed into bytes)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, ordered, capacity = 10000000):
+        self.ordered = ordered
+        self.capacity = capacity
+        self.full = False
+        self.duplicates = 0
+        self._block = None
+        self._block_keys = set()
+        self._keys = set()
+
+    def expect(self, total_rows):
+        if (not self.ordered and total_rows is not None and total_rows > self.capacity):
+            print(
+                f'WARNING: {total_rows:,} rows, more than the {self.capacity:,} logs whose keys can be kept. Duplicates are only removed '
+                'among the first logs and within each page. Run the range in sharded or incremental mode to remove all duplicates'
+            )
+
+    def filter(self, rows, record):
+        # Duplicates within the page are removed exactly, keeping the first row of each key
+        page_keys = {}
+        for item in rows:
+            page_keys.setdefault(self._key(item, record), item)
+
+        if (self.ordered):
+            unique_rows = []
+            for key, item in page_keys.items():
+                if (item['block_number'] != self._block):
+                    self._block = item['block_number']
+                    self._block_keys = set()
+                if (key not in self._block_keys):
+                    self._block_keys.add(key)
+                    unique_rows.append(item)
+        else:
+            unique_rows = [item for key, item in page_keys.items() if key not in self._keys]
+            if (not self.full):
+                self._keys.update(page_keys.keys())
+                if (len(self._keys) >= self.capacity):
+                    self.full = True
+                    print(f'WARNING: {len(self._keys):,} distinct logs: the keys of later logs are not kept (see set_dedup())')
+
+        self.duplicates += len(rows) - len(unique_rows)
+        return unique_rows
+
+    def _key(self, item, record):
+        # 32-byte transaction hash and 4-byte log index (fixed widths), then the record name: about half the size of the key as a string
+        return bytes.fromhex(item['transaction_hash'][2:]) + item['log_index'].to_bytes(4, 'big') + record.record_for(item).name.encode()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({"ordered" if self.ordered else "exact"}, {self.capacity})')
@@ -1,17 +1,24 @@
-# Import all needed modules. This could be done in the classes, but is done globally, in order to avoid duplicate calls.
-# The overhead requirement is not significant
+# Import all needed modules. They are imported globally, in order to avoid duplicate calls, except the heavy modules only needed by one
+# backend or step (mysql.connector, google.cloud.bigquery, tqdm, web3, and the NumPy decoders): they are imported where they are first
+# used, so that short runs (and scripts importing this module) don't pay for them
 
 # Need to complete this action so that files can be imported from the parent directory structure
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
-from web3 import Web3
-import mysql.connector
-from google.cloud import bigquery
-from tqdm import tqdm
+from timeit import default_timer as timer
 
 # The pylint comment disables pylint on the next line, because it doesn't recognize a properly working import
 from utils import secrets # pylint:disable=F0401
+from refRegistry import ReferenceRegistry
+from pageWriter import PageWriter, InsertSink
+from bulkLoader import BulkLoadSink
+from watermarks import Watermark
+from logSources import LogQuery, BigQueryLogSource, LocalLogSource, LIVE_TABLE
+from logCache import LogCache, CachedLogSource, CachingJob, LOG_CACHE_DIR, DEFAULT_MAX_BYTES
+from runMetrics import RunMetrics, SamplingProfiler, REPORT_DIR
+from fixedPoint import scale_units, to_wei, from_wei
+from topicTable import topic_hash
 
 class DataValidationError(Exception):
     """
@@ -43,10 +50,12 @@ class Record:
     signature (String)              The record signature, in plain text
     params (String)                 The parameters used to instantiate the object
     stored_method_name (String)     The record's signature, formatted for Ethereum
+    records (Array)                 The records fetched by the query (only this record)
 
     Methods
     -------
     __init__                Performs data validation checks and creates all attributes
+    record_for              Returns the record of a row (always this record)
     __repr__                Returns string output of the call by which the object was instantiated
     """
     def __init__(self, record_name, protocol):
@@ -75,16 +84,55 @@ class Record:
             # Protocol is not saved, so the text version of the protocol is saved, in order to show in __repr__
             self.params = '{self.name}, {protocol})' 
 
-            # The format of the signature in the Ethereum data set depends on whether we are querying an event or a log
+            # The format of the signature in the Ethereum data set depends on whether we are querying an event or a log. Hashes of the
+            # valid records are precomputed (topicTable.py)
             if (self.data_type == 'event'):
-                self.stored_method_name = Web3.toHex(Web3.keccak(text=self.signature))
+                self.stored_method_name = topic_hash(self.signature)
             elif (self.data_type == 'log'):
-                methodName = Web3.toHex(Web3.keccak(text=self.signature))
+                methodName = topic_hash(self.signature)
                 self.stored_method_name = methodName[0:10].ljust(66,"0")
 
+            self.records = [self]
+
+    def record_for(self, item):
+        return self
+
     def __repr__(self):
         return (f'{self.__class__.__name__}({self.params})')
 
+class RecordSet:
+    """
+    A class representing several records of a protocol, fetched in a single scan and dispatched to their handlers by signature
+
+    Attributes
+    ----------
+    name (String)                   The name of the set (e.g. allCompound2, or Mint+Borrow)
+    records (Array)                 The records fetched by the query
+    stored_method_name (Array)      The records' signatures, formatted for Ethereum
+    _by_topic (Dictionary)          The records, by signature (first topic)
+
+    Methods
+    -------
+    __init__                Creates the records (all valid records of the protocol if no names are given)
+    record_for              Returns the record of a row, from its first topic
+    __repr__                Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, protocol, record_names = None):
+        if (record_names is None):
+            record_names = [record['name'] for record in protocol.valid_records]
+            self.name = f'all{protocol.name}{protocol.version}'
+        else:
+            self.name = '+'.join(record_names)
+        self.records = [Record(record_name, protocol) for record_name in record_names]
+        self.stored_method_name = [record.stored_method_name for record in self.records]
+        self._by_topic = {record.stored_method_name: record for record in self.records}
+
+    def record_for(self, item):
+        return self._by_topic[item['topics'][0]]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.name})')
+
 class Protocol:
     """
     A class representing a specific version of a DeFi protocol
@@ -94,8 +142,12 @@ class Protocol:
     name (String)               The name of the protocol
     version (Integer)           The version of the protocol
     valid_records (Array)       An array of the records that can be queried for the protocol
-    addr (String or Array)      A single address should be queried on the blockchain (can also be an array)
+    addr (String or Array)      A single address should be queried on the blockchain (can also be an array, loaded from the registry
+                                when first used)
     insert_query (String)       String of SQL query that will be used to update the SQL table
+    registry (ReferenceRegistry)    Token, cToken and pair information, indexed by address
+    fixed_point (Boolean)       Whether amounts are decoded as integers in units of 10^-18 (fixedPoint.Wei) instead of Decimal objects
+    address_book (AddressBook)  Dictionary in which addresses are interned as integer IDs (None if addresses are decoded as strings)
 
     Methods
     -------
@@ -108,6 +160,12 @@ class Protocol:
      _process_results_uniswap1      Function to process results from BigQuery, for Uniswap version 1
      _process_results_uniswap2      Function to process results from BigQuery, for Uniswap version 2
      _process_results_aave1         Function to process results from BigQuery, for Aave version 1
+    _convert_dec                    Converts a hex word to an amount, normalized to 18 decimals
+    _chunk_data                     Splits the data field into words (64 characters, or custom lengths)
+    _twos_comp                      Converts a signed hex word to an absolute value and a sign
+    _from_wei                       Converts an integer number of units of 10^-18 to an amount (Decimal, or Wei in fixed-point mode)
+    _address                        Returns an address as it is decoded (string, or ID in address ID mode)
+    __getstate__                    Returns the state sent to other processes (without the address book)
     __repr__                        Returns string output of the call by which the object was instantiated
     """    
     def __init__(self, protocol_name, protocol_version, ex_sources):
@@ -116,9 +174,14 @@ class Protocol:
         elif (protocol_version not in [1, 2]):
             raise DataValidationError(f'Protocol version "{protocol_version}" is invalid". Only valid protocol versions are 1 or 2')
         else:
-            # 1. Set protocol name
+            # 1. Set protocol name, and the reference data shared with the external sources
             self.name = protocol_name
             self.version = protocol_version
+            self.registry = ex_sources.registry
+            self.fixed_point = False
+            self.address_book = None
+            self._addr = None
+            self._addr_table = None
 
             # 2. Set function that will process results
             func_name = f'_process_results_{self.name.lower()}{self.version}'
@@ -137,7 +200,7 @@ class Protocol:
                     {'name': 'wipe', 'data_type': 'log', 'signature':'wipe(bytes32,uint256)'}
                 ]
 
-                self.addr = '0x448a5065aebb8e423f0896e6c5d525c040f59af3' # SaiTub
+                self._addr = '0x448a5065aebb8e423f0896e6c5d525c040f59af3' # SaiTub
                 self.insert_query = "INSERT INTO makerV1(blockTime, blockNumber, trxHash, usrAddr, dinkAmount, dartAmount, cdpIndex, collateralName, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s)"
             elif (self.name == 'Compound' and self.version == 1):
                 self.valid_records = [
@@ -148,7 +211,7 @@ class Protocol:
                     {'name': 'BorrowLiquidated', 'data_type': 'event', 'signature':'BorrowLiquidated(address,address,uint256,uint256,uint256,uint256,address,address,uint256,uint256,uint256,uint256)'}
                 ]
 
-                self.addr = '0x3fda67f7583380e67ef93072294a7fac882fd7e7' # MoneyMarket
+                self._addr = '0x3fda67f7583380e67ef93072294a7fac882fd7e7' # MoneyMarket
                 self.insert_query = """INSERT INTO compoundV1(blockTime, blockNumber, trxHash, usrAddr, liquidatorAddr, tokenAddr, amount, startingBalance, newBalance, borrowAmountWithFee, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
             elif (self.name == 'Uniswap' and self.version == 1):
                 self.valid_records = [
@@ -159,13 +222,7 @@ class Protocol:
                 ]
 
                 # For Uniswap V1, we need to query multiple exchanges, so we create an array for the addressess
-                self.addr = []
-
-                temp_query = f"SELECT exchangeAddr FROM tokensWithExchanges"
-                ex_sources.cursor.execute(temp_query)
-                temp_record = ex_sources.cursor.fetchall()
-                for item in temp_record:
-                    self.addr.append(item[0].lower())
+                self._addr_table = 'exchangeAddrs' # Loaded from the registry when first needed (see addr)
 
                 self.insert_query = "INSERT INTO uniswapV1(blockTime, blockNumber, trxHash, callingAddr, exchangeAddr, tokenAmount, ethAmount, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s, %s)"
             elif (self.name == 'Aave' and self.version == 1):
@@ -178,7 +235,7 @@ class Protocol:
                     {'name': 'LiquidationCall', 'data_type': 'event', 'signature': 'LiquidationCall(address,address,address,uint256,uint256,uint256,address,bool,uint256)'},
                 ]
 
-                self.addr = '0x398ec7346dcd622edc5ae82352f02be94c62d119' # Lending pool
+                self._addr = '0x398ec7346dcd622edc5ae82352f02be94c62d119' # Lending pool
 
                 self.insert_query = "INSERT INTO aaveV1(blockTime, blockNumber, trxHash, usrAddr, liquidatorAddr, reserveAddr, tokenAmount, originationFee, liquidateCollateralAmt, liquidateCollateralAddr, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
             elif (self.name == 'Maker' and self.version == 2):
@@ -193,7 +250,7 @@ class Protocol:
                     # between 10M and 11.7M blocks. Therefore, we only gather data on the 'flux' function actually called
                 ]
 
-                self.addr = '0x35d1b3f3d7966a1dfe207aa4514c12a259a0492b' # Vat
+                self._addr = '0x35d1b3f3d7966a1dfe207aa4514c12a259a0492b' # Vat
                 self.insert_query = "INSERT INTO makerV2(blockTime, blockNumber, trxHash, usrAddr, dinkAmount, dartAmount, vaultID, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s, %s)"
             elif (self.name == 'Compound' and self.version == 2):
                 self.valid_records = [
@@ -205,13 +262,7 @@ class Protocol:
                 ]
 
                 # For Compound V2, we need to query multiple cTokens, so we create an array for the addressess
-                self.addr = []
-
-                temp_query = f"SELECT cTokenAddr FROM addrTokens"
-                ex_sources.cursor.execute(temp_query)
-                temp_record = ex_sources.cursor.fetchall()
-                for item in temp_record:
-                    self.addr.append(item[0].lower())
+                self._addr_table = 'cTokenAddrs' # Loaded from the registry when first needed (see addr)
 
                 # Set a constant for the number of decimals in a cToken
                 self._cTokenDecimals = 8
@@ -226,16 +277,16 @@ class Protocol:
                 ]
 
                 # For Uniswap V2, we need to query multiple exchanges, so we create an array for the addressess
-                self.addr = []
-
-                temp_query = f"SELECT pairAddr FROM addrUniPairs"
-                ex_sources.cursor.execute(temp_query)
-                temp_record = ex_sources.cursor.fetchall()
-                for item in temp_record:
-                    self.addr.append(item[0].lower())
+                self._addr_table = 'pairAddrs' # Loaded from the registry when first needed (see addr)
 
                 self.insert_query = "INSERT INTO uniswapV2(blockTime, blockNumber, trxHash, sendAddr, receiveAddr, pairID, token0In, token1In, token0Out, token1Out, trxType) VALUES(STR_TO_DATE(%s, '%Y-%m-%d %T'), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
 
+    @property
+    def addr(self):
+        if (self._addr is None and self._addr_table is not None):
+            self._addr = self.registry.addresses(self._addr_table)
+        return self._addr
+
     def _process_results_maker1(self, item, partial_list, record, sqlArr):
         # cdpIndex
         if (record.name == 'open'):
@@ -246,12 +297,12 @@ class Protocol:
         # callingAddr
         if(record.name == 'give'):
             # NOTE: the calling address is the original owner. To avoid needing two columns, we will just input the new column
-            callingAddr = "0x" + item['topics'][3][26:]
+            callingAddr = self._address("0x" + item['topics'][3][26:])
         else: 
             # NOTE: for bite, the calling address is the biter, not the owner. Also, some calls are made through a proxy contract, so the 
             # calling address is the contract, not the actual owner. The real owner would need to be deduced from historical open/give
             # transactions
-            callingAddr = "0x" + item['topics'][1][26:]
+            callingAddr = self._address("0x" + item['topics'][1][26:])
             
         # amount
         if (record.name == 'give' or record.name == 'shut' or record.name == 'bite' or record.name == 'open'):
@@ -260,9 +311,9 @@ class Protocol:
             weiAmount = int(item['topics'][3], 16)
             # Convert decimal amount into negative if freeing/wiping
             if(record.name == 'free' or record.name == 'wipe'):
-                amount = -Web3.fromWei(weiAmount, 'ether')
+                amount = -self._from_wei(weiAmount)
             else:
-                amount = Web3.fromWei(weiAmount, 'ether')
+                amount = self._from_wei(weiAmount)
 
         # If cdpIndex is larger than largest unsigned int value (in SQL), then set to 0. The value must have been erroneously entered
         if (cdpIndex > 4294967295):
@@ -275,7 +326,7 @@ class Protocol:
             sqlArr.append(allFields)
         else:
             # Only append if the value is different than the previous row
-            if (sqlArr[len(sqlArr)] != allFields):
+            if (sqlArr[len(sqlArr) - 1] != allFields):
                 sqlArr.append(allFields)
 
         return sqlArr
@@ -283,12 +334,12 @@ class Protocol:
     def _process_results_compound1(self, item, partial_list, record, sqlArr):
         chunks = self._chunk_data(item['data'])
 
-        usrAddr = '0x' + chunks[0][24:]
+        usrAddr = self._address('0x' + chunks[0][24:])
 
         if (record.name == 'BorrowLiquidated'):
             # usrAddr = targetAddress (owner - already set above)
             # Liquidator address = liquidator
-            liquidatorAddr = '0x' + chunks[6][24:]
+            liquidatorAddr = self._address('0x' + chunks[6][24:])
             # borrowAmtWithFee
             borrowAmtWithFee = 0
 
@@ -296,12 +347,12 @@ class Protocol:
             # amount = amountRepaid (neg.), tokenAddr = assetBorrow
             # startingBalance = borrowBalanceAccumulated, newBalance = borrowBalanceAfter
             weiAmount = int(chunks[4], 16)
-            amount = -Web3.fromWei(weiAmount, 'ether')
-            tokenAddr = '0x' + chunks[1][24:]
+            amount = -self._from_wei(weiAmount)
+            tokenAddr = self._address('0x' + chunks[1][24:])
             weiStartBal = int(chunks[3], 16)
-            startBal = Web3.fromWei(weiStartBal, 'ether')
+            startBal = self._from_wei(weiStartBal)
             weiNewBal = int(chunks[5], 16)
-            newBal = Web3.fromWei(weiNewBal, 'ether')
+            newBal = self._from_wei(weiNewBal)
 
             allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], usrAddr, liquidatorAddr, tokenAddr, amount, startBal, newBal, borrowAmtWithFee, 'BorrowRepaidLiquidate']
             sqlArr.append(allFields)
@@ -310,12 +361,12 @@ class Protocol:
             # amount = amountSeized (neg.), tokenAddr = assetCollateral
             # startingBalance = collateralBalanceAccumulated, newBalance = collateralBalanceAfter
             weiAmount = int(chunks[10], 16)
-            amount = -Web3.fromWei(weiAmount, 'ether')
-            tokenAddr = '0x' + chunks[7][24:]
+            amount = -self._from_wei(weiAmount)
+            tokenAddr = self._address('0x' + chunks[7][24:])
             weiStartBal = int(chunks[9], 16)
-            startBal = Web3.fromWei(weiStartBal, 'ether')
+            startBal = self._from_wei(weiStartBal)
             weiNewBal = int(chunks[11], 16)
-            newBal = Web3.fromWei(weiNewBal, 'ether')
+            newBal = self._from_wei(weiNewBal)
 
             allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], usrAddr, liquidatorAddr, tokenAddr, amount, startBal, newBal, borrowAmtWithFee, 'SupplyWithdrawnLiquidate']
             sqlArr.append(allFields)
@@ -325,7 +376,7 @@ class Protocol:
             # The collateralBalance before/after is not the liquidator's actual balance, it's the owner's balance. There's no way to know the 
             # liquidator's balance from the event or other logs. Therefore, we insert as 0
             weiAmount = int(chunks[10], 16)
-            amount = Web3.fromWei(weiAmount, 'ether')
+            amount = self._from_wei(weiAmount)
             startBal = 0
             newBal = 0
 
@@ -333,31 +384,31 @@ class Protocol:
             sqlArr.append(allFields)
         else:
             # Addresses
-            tokenAddr = '0x' + chunks[1][24:]
+            tokenAddr = self._address('0x' + chunks[1][24:])
             # Starting balance
             weiStartBal = int(chunks[3], 16)
-            startBal = Web3.fromWei(weiStartBal, 'ether')
+            startBal = self._from_wei(weiStartBal)
             
             # Amount
             weiAmount = int(chunks[2], 16)
             # Record as negative for SupplyWithdrawn and BorrowRepaid
             if (record.name == 'SupplyWithdrawn' or record.name == 'BorrowRepaid'):
-                amount = -Web3.fromWei(weiAmount, 'ether')
+                amount = -self._from_wei(weiAmount)
             else:
-                amount = Web3.fromWei(weiAmount, 'ether')
+                amount = self._from_wei(weiAmount)
             
             # borrowAmtWithFee
             # BorrowTaken has different fields in the last two slots
             if (record.name == 'BorrowTaken'):
                 weiBorrowAmtWithFee = int(chunks[4], 16)
-                borrowAmtWithFee = Web3.fromWei(weiBorrowAmtWithFee, 'ether')
+                borrowAmtWithFee = self._from_wei(weiBorrowAmtWithFee)
 
                 weiNewBal = int(chunks[5], 16)
-                newBal = Web3.fromWei(weiNewBal, 'ether')
+                newBal = self._from_wei(weiNewBal)
             else:
                 borrowAmtWithFee = 0
                 weiNewBal = int(chunks[4], 16)
-                newBal = Web3.fromWei(weiNewBal, 'ether')
+                newBal = self._from_wei(weiNewBal)
             
             # Append row only once, for all non-liquidation transactions
             allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], usrAddr, None, tokenAddr, amount, startBal, newBal, borrowAmtWithFee, record.name]
@@ -368,10 +419,10 @@ class Protocol:
 
     def _process_results_uniswap1(self, item, partial_list, record, sqlArr):        
         # callingAddr
-        callingAddr = "0x" + item['topics'][1][26:]
+        callingAddr = self._address("0x" + item['topics'][1][26:])
 
         # exchangeAddr
-        exchangeAddr = item['address']
+        exchangeAddr = self._address(item['address'])
 
         # tokenAmount and ethAmount
         if (record.name == 'ethPurchase'):
@@ -396,16 +447,16 @@ class Protocol:
             ethSign = 1
 
         weiTokenAmount = int(item['topics'][tokenPosInArray], 16)
-        tokenAmount = Web3.fromWei(weiTokenAmount, 'ether') * tokenSign
+        tokenAmount = self._from_wei(weiTokenAmount) * tokenSign
         weiEthAmount = int(item['topics'][ethPosInArray], 16)
-        ethAmount = Web3.fromWei(weiEthAmount, 'ether') * ethSign
+        ethAmount = self._from_wei(weiEthAmount) * ethSign
 
         # Append row and return the array
         allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], callingAddr, exchangeAddr, tokenAmount, ethAmount, record.name]
         sqlArr.append(allFields)
         return sqlArr
 
-    def _process_results_aave1(self, item, partial_list, record, sqlArr, tokenArr):
+    def _process_results_aave1(self, item, partial_list, record, sqlArr):
         chunks = self._chunk_data(item['data'])
 
         # 1. Reserve asset address
@@ -429,20 +480,9 @@ class Protocol:
         # NOTE: can't convert address to a token ID, because we're getting all token transactions, not just for the ones we're concerned with
         # Compound can be easily filtered for specific addresses (specific contracts for each cToken), but Aave has one address, and filtering
         # would be harder.
-        found1 = False
-        found2 = False
-        for token in tokenArr:
-            if (reserveAddr == token[1]):
-                reserveDecimals = token[2]
-                found1 = True
-            if (liquidateCollateralAddr == token[1]):
-                liquidateDecimals = token[2]
-                found2 = True
-        # If corresponding token not found, then just assume 18 decimals. May not always be correct, but will be sufficient to record amounts
-        if not found1:
-            reserveDecimals = 18
-        if not found2:
-            liquidateDecimals = 18
+        # If corresponding token not found, then the registry assumes 18 decimals
+        reserveDecimals = self.registry.reserve_decimals(reserveAddr)
+        liquidateDecimals = self.registry.reserve_decimals(liquidateCollateralAddr)
 
         # tokenAmount
         # Must come after search loops above
@@ -462,7 +502,8 @@ class Protocol:
             originationFee = 0
         
         # Append row and return the array
-        allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], usrAddr, liquidatorAddr, reserveAddr, tokenAmount, originationFee, liquidateCollateralAmt, liquidateCollateralAddr, record.name]
+        # Addresses are only interned after the decimals are looked up (the registry is indexed by address string)
+        allFields = [partial_list['blockTime'], partial_list['blockNumber'], partial_list['trxHash'], self._address(usrAddr), self._address(liquidatorAddr), self._address(reserveAddr), tokenAmount, originationFee, liquidateCollateralAmt, self._address(liquidateCollateralAddr), record.name]
         sqlArr.append(allFields)
         return sqlArr
 
@@ -478,9 +519,9 @@ class Protocol:
         
         # usrAddr
         if (record.name == 'give'):
-            usrAddr = "0x" + item['topics'][3][26:]
+            usrAddr = self._address("0x" + item['topics'][3][26:])
         else:
-            usrAddr = "0x" + item['topics'][2][26:]
+            usrAddr = self._address("0x" + item['topics'][2][26:])
 
         # amount
         if (record.name == 'frob2'):
@@ -488,8 +529,8 @@ class Protocol:
             dinkWei, dinkSign = self._twos_comp(chunks[7])
             dartWei, dartSign = self._twos_comp(chunks[8])
 
-            dinkAmt = Web3.fromWei(dinkWei, 'ether') * dinkSign
-            dartAmt = Web3.fromWei(dartWei, 'ether') * dartSign
+            dinkAmt = self._from_wei(dinkWei) * dinkSign
+            dartAmt = self._from_wei(dartWei) * dartSign
         else: # Add amounts later
             dinkAmt = 0
             dartAmt = 0
@@ -506,32 +547,27 @@ class Protocol:
 
         return sqlArr
 
-    def _process_results_compound2(self, item, partial_list, record, sqlArr, tokenArr):
+    def _process_results_compound2(self, item, partial_list, record, sqlArr):
         chunks = self._chunk_data(item['data'])
 
         # cTokenID
-        cTokenAddr = item['address']
-        for token in tokenArr:
-            if (cTokenAddr == token[1]):
-                cTokenID = token[0]
-                tokenDecimals = token[2]
-                break
+        cTokenID, tokenDecimals = self.registry.ctoken(item['address'])
 
         # usrAddr and tokenAmount
         # NOTE: We could convert tokenAmount to negative. However, actions are simultaneously positive and negative
         # For example, depositing tokens to Compound would be negative for user's wallet, positive for Compound wallet
         # Therefore, we leave as all amounts as positive. Algorithm will decide how to handle amounts
         if (record.name in ['RepayBorrow', 'LiquidateBorrow']):
-            usrAddr = "0x" + chunks[1][24:]
+            usrAddr = self._address("0x" + chunks[1][24:])
             tokenAmount = self._convert_dec(chunks[2], tokenDecimals)
         else:
-            usrAddr = "0x" + chunks[0][24:]
+            usrAddr = self._address("0x" + chunks[0][24:])
             tokenAmount = self._convert_dec(chunks[1], tokenDecimals)
         
         # liquidatorAddr and liquidateCollateralAddr
         if (record.name == 'LiquidateBorrow'):
-            liquidatorAddr = "0x" + chunks[0][24:]
-            liquidateCollateralAddr = "0x" + chunks[3][24:]
+            liquidatorAddr = self._address("0x" + chunks[0][24:])
+            liquidateCollateralAddr = self._address("0x" + chunks[3][24:])
         else:
             liquidatorAddr = None
             liquidateCollateralAddr = None           
@@ -563,18 +599,13 @@ class Protocol:
         sqlArr.append(allFields)
         return sqlArr
 
-    def _process_results_uniswap2(self, item, partial_list, record, sqlArr, pairArr):
+    def _process_results_uniswap2(self, item, partial_list, record, sqlArr):
         # pairID
-        pairAddr = item['address']
-        for pair in pairArr:
-            if pairAddr == pair[1]:
-                pairID = pair[0]
-                token0Decimals = pair[2]
-                token1Decimals = pair[3]
+        pairID, token0Decimals, token1Decimals = self.registry.pair(item['address'])
         
         # send/receiveAddr
-        sendAddr = "0x" + item['topics'][1][26:]
-        receiveAddr = "0x" + item['topics'][2][26:]
+        sendAddr = self._address("0x" + item['topics'][1][26:])
+        receiveAddr = self._address("0x" + item['topics'][2][26:])
 
         # split data into chunks, for processing
         chunks = self._chunk_data(item['data'])
@@ -594,24 +625,13 @@ class Protocol:
         pass
 
     def _convert_dec(self, value, decimals, positive = True):
-        value1 = int(value, 16)                         # Convert hexadecimal to integer
-        value2 = str(value1)                            # Convert to string
-        pad_len = 18 - decimals                         # Determine how many characters to pad
-        total_string_len = len(value2) + pad_len        # Pad to the right
-        if decimals > 18:                               # Delete the excess values past 18 decimals. We lose ray precision, but can get decimals 
-            if (total_string_len <= 0):                 
-                value3 = 0                              # If the string length less than excess decimals, we set to zero
-            else:
-                value3 = value2[:total_string_len]
+        # The amount is normalized to 18 decimals with integer arithmetic (see fixedPoint.scale_units). Digits past 18 decimals are
+        # dropped: we lose ray precision, but can get decimals
+        amount = self._from_wei(scale_units(int(value, 16), decimals))
+        if (positive):
+            return amount
         else:
-            value3 = value2.ljust(total_string_len,"0")
-        value4 = int(value3)                            # Convert back to integer
-        if (positive):                                  # Convert to decimal
-            value5 = Web3.fromWei(value4, 'ether')      # Positive conversion
-        else:
-            value5 = -Web3.fromWei(value4, 'ether')     # Negative conversion
-
-        return value5
+            return -amount
 
     def _chunk_data(self, item_data, custom_length = []):
         dataField = item_data
@@ -640,60 +660,143 @@ class Protocol:
         else:
             sign = 1
         return decoded_value, sign
+
+    def _from_wei(self, value):
+        # In fixed-point mode, amounts are kept as integers in units of 10^-18 (fixedPoint.Wei), instead of Decimal objects
+        if (self.fixed_point):
+            return to_wei(value)
+        return from_wei(value)
+
+    def _address(self, addr):
+        # In address ID mode, addresses are interned in the address book (utils/addressBook.py) and rows hold their IDs. The writers
+        # convert them back to strings
+        if (self.address_book is None or addr is None):
+            return addr
+        return self.address_book.id(addr)
+
+    def __getstate__(self):
+        # The address book stays in the process that owns it (its file can only have one writer): rows decoded in other processes
+        # (shardRunner.py) keep their address strings
+        state = self.__dict__.copy()
+        state['address_book'] = None
+        return state
     
     def __repr__(self):
         return (f'{self.__class__.__name__}({self.name}, {self.version})')
 
 class ExternalSources:
     """
-    A class representing the connection to both SQL and BigQuery
+    A class representing the connection to both SQL and the source of logs (BigQuery, or local log files)
 
     Attributes
     ----------
     _db (Connector)             Connection to MySQL
     cursor (Cursor)             MySQL cursor
-    _bq_client (Client)         Connection to BigQuery
-    temp_used                   Whether the BigQuery data is already present as a temporary table
+    log_source (LogSource)      Source of logs: BigQueryLogSource (in a CachedLogSource, with a log cache), or LocalLogSource if a folder
+                                of exported logs is given
+    registry (ReferenceRegistry)    Token, cToken and pair information, loaded once and saved to a local snapshot
+    temp_used                   Whether the BigQuery data is already present as a temporary table (always True for local log files)
+    metrics (RunMetrics)        Timers and counters of the run (SQL connection, dry run, query wait and page fetch)
     _query (String)             Text of query to execute on Google BigCloud
+    _log_query (LogQuery)       Parameters of the query
     
     Methods
     -------
     __init__                    Connects to the SQL database
+    connect_sql                 Opens a new connection to the SQL database (options override the default connection parameters)
     create_bq_query             Creates the BigQuery query
+    create_shard_query          Creates the last query, for a range of blocks only
+    estimate_bq_query           Returns the number of bytes the BigQuery query would scan (dry run)
     execute_bq_query            Executes the BigQuery query
+    execute_shard_query         Executes the query for a range of blocks, and returns all rows
+    last_existing_block         Returns the last block of a query's range that exists (the head, if the range goes past it)
     _job_config                 Parameters for BigQuery query
     __repr__                    Returns string output of the call by which the object was instantiated
     """
-    def __init__(self):
+    def __init__(self, log_path = None, metrics = None, log_cache = None):
+        self.metrics = metrics if metrics is not None else RunMetrics()
+
         # Start MySQL connection
         print('1. Connecting to SQL database')
-        self._db = mysql.connector.connect(
-            host = secrets.sqlHost,
-            user = secrets.sqlUser,
-            password = secrets.sqlPass,
-            database = 'defiData',
-            autocommit = True
-        )
+        with self.metrics.timer('sql_connect'):
+            self._db = self.connect_sql()
         self.cursor = self._db.cursor()
 
-        # Start the Google BigCloud connection
-        self._bq_client = bigquery.Client()
+        # Reference data is loaded from the local snapshot (or from MySQL, the first time it is needed)
+        self.registry = ReferenceRegistry(self.cursor)
+
+        # Start the Google BigCloud connection, or read exported logs from local disk
+        if (log_path is None):
+            self.log_source = BigQueryLogSource()
+        else:
+            self.log_source = LocalLogSource(log_path)
+        # Rows fetched from BigQuery are saved to the log cache, and read from it when a query is run again (local log files are already
+        # on disk)
+        if (log_cache is not None and not self.log_source.is_local):
+            self.log_source = CachedLogSource(self.log_source, log_cache)
     
-    def create_bq_query(self, last_block, decrement, record, protocol, stage):
-        # 1. Determine whether a temp table is set up for this record type
-        temp_query = f"SELECT tempTable FROM bqTempTables WHERE trxType = '{record.name}'"
-        self.cursor.execute(temp_query)
-        temp_record = self.cursor.fetchall()
+    def connect_sql(self, **options):
+        # Options override the default connection parameters (e.g. bulk loads need allow_local_infile, and commit each chunk themselves)
+        params = {
+            'host': secrets.sqlHost,
+            'user': secrets.sqlUser,
+            'password': secrets.sqlPass,
+            'database': 'defiData',
+            'autocommit': True,
+        }
+        params.update(options)
+        import mysql.connector
+        return mysql.connector.connect(**params)
 
+    def create_bq_query(self, last_block, decrement, record, protocol, stage, incremental = False):
+        # If querying Maker V1 or Uniswap V1, we only need the log
+        # For all others, we need the data field as well
+        include_data = not (
+            (protocol.name == 'Uniswap' and protocol.version == 1) or 
+            (protocol.name == 'Maker' and protocol.version == 1)
+        )
+        
+        # Uniswap and Compound query multiple addresses, so the address is always passed as an array
+        addresses = protocol.addr if isinstance(protocol.addr, list) else [protocol.addr]
+
+        # Parameters are saved, so that the same query can be split into block ranges (see create_shard_query). The table and LIMIT are
+        # set below
+        self._log_query = LogQuery(None, last_block - decrement, last_block, addresses, record.stored_method_name, include_data)
+
+        # 1. Determine whether the rows are in the log cache, or whether a temp table is set up for this record type
+        # Local log files are always processed directly, like a temp table (there is no destination table to record). In incremental mode,
+        # the blocks above the watermark are usually not in the temp table, so the live table is also processed directly. Cached rows are
+        # read from disk like local log files, even if the temp table has expired. Segments only hold rows of the live table, up to the
+        # head at the time, so a covered range (also in incremental mode) has all of its rows
+        cached = isinstance(self.log_source, CachedLogSource) and self.log_source.covers(self._log_query)
+        if (self.log_source.is_local or incremental or cached):
+            temp_record = []
+        else:
+            temp_query = f"SELECT tempTable FROM bqTempTables WHERE trxType = '{record.name}'"
+            self.cursor.execute(temp_query)
+            temp_record = self.cursor.fetchall()
+
+        if (self.log_source.is_local):
+            print('2. Querying local log files')
+            bq_table_name = self.log_source.path
+            self.temp_used = True
+        elif (cached):
+            print('2. Querying log cache')
+            bq_table_name = LIVE_TABLE
+            self.temp_used = True
+        elif (incremental):
+            print('2. Querying live table (incremental)')
+            bq_table_name = LIVE_TABLE
+            self.temp_used = True
         # A. If yes, then query the temp table
-        if (len(temp_record) > 0):
+        elif (len(temp_record) > 0):
             print('2. Querying temp table')
             bq_table_name = temp_record[0][0]
             self.temp_used = True
         # B. If no, then execute query on live table
         else:
             print('2. Querying live table')
-            bq_table_name = 'bigquery-public-data.crypto_ethereum.logs'
+            bq_table_name = LIVE_TABLE
             self.temp_used = False
 
         # 2. Add custom parameters
@@ -701,57 +804,51 @@ class ExternalSources:
         if (stage < 2 and self.temp_used):
             # BorrowLiquidated for Compound produces 3 rows for every record, so only use 4 records
             if (protocol.name == 'Compound' and protocol.version == 2 and record.name == 'BorrowLiquidated'):
-                limit_param = ' LIMIT 4'
+                limit = 4
             # For all other records, use LIMIT 10
             else:
-                limit_param = ' LIMIT 10'
+                limit = 10
         # If querying a live table, or in stage 1, then do not LIMIT
         else:
-            limit_param = ''
+            limit = None
 
-        # If querying Maker V1 or Uniswap V1, we only need the log
-        # For all others, we need the data field as well
-        if (
-            (protocol.name == 'Uniswap' and protocol.version == 1) or 
-            (protocol.name == 'Maker' and protocol.version == 1)
-        ):
-            data_param = ''
-        else:
-            data_param = ', data'
-        
-        # Uniswap queries multiple addresses, so we need to append an array of addresses properly, searching with the IN condition
-        if isinstance(protocol.addr, list):
-            address = '('
-            for addr in protocol.addr:
-                address += f"address = '{addr}' OR "
+        # 3. Create query
+        self._log_query.table_name = bq_table_name
+        self._log_query.limit = limit
+        self._query = self._log_query.text()
+        print(self._query)
+        print(f'   Parameters: blocks {last_block - decrement} to {last_block}, {len(addresses)} address(es), {len(self._log_query.signatures)} signature(s)')
 
-            address = address[:-4] + ')'
-        else:
-            address = f"address = '{protocol.addr}'"
-
-        select_params = {
-            'firstBlock': last_block - decrement,
-            'lastBlock': last_block,
-            'signature': record.stored_method_name,
-            'address': address.lower(),
-            'tableName': bq_table_name,
-            'limit': limit_param,
-            'data': data_param,
-        }
+    def create_shard_query(self, first_block, last_block):
+        # Same query as the last one created, limited to a range of blocks. Rows are ordered by block, so that shards can be merged in
+        # block order
+        return self._log_query.shard(first_block, last_block)
 
-        # 3. Create query text
-        self._query = """
-            SELECT transaction_hash, address, topics, block_timestamp, block_number {data}
-            FROM `{tableName}`
-            WHERE block_number >= {firstBlock} AND block_number <= {lastBlock}
-            AND {address}
-            AND topics[SAFE_OFFSET(0)] = {signature}
-            {limit};
-        """.format(**select_params)
-        print(self._query)
+    def estimate_bq_query(self):
+        with self.metrics.timer('dry_run'):
+            return self.log_source.estimate(self._log_query)
 
     def execute_bq_query(self, protocol):
-        self.results = self._bq_client.query(self._query)
+        with self.metrics.timer('query_wait'):
+            self.results = self.log_source.execute(self._log_query)
+
+    def execute_shard_query(self, query):
+        # Shard queries run in several threads, and the metrics add their times together
+        with self.metrics.timer('query_wait'):
+            job = self.log_source.execute(query)
+            iterator = job.result()
+
+        # Rows are converted to dictionaries, so that they can be sent to other processes for decoding
+        start = timer()
+        rows = [dict(row.items()) for row in iterator]
+        self.metrics.add('page_fetch', timer() - start, len(rows))
+        return job, rows
+
+    def last_existing_block(self, query):
+        # Local log files are a fixed export: their range is taken as complete
+        if (self.log_source.is_local):
+            return query.last_block
+        return self.log_source.last_existing_block(query)
 
     def __repr__(self):
         return (f'{self.__class__.__name__}()')
@@ -763,28 +860,82 @@ class RecordExplorer:
     Attributes
     ----------
     protocol (Protocol)             An object representing a DeFi protocol
-    record (record)                 An object representing the record being queried
+    record (record)                 An object representing the record being queried (or a RecordSet, for several records)
     ex_sources (ExternalSources)    An object representing the SQL connection, as well as the SQL query that will be executed
     stage (Int)                     An integer representing the testing stage
 
+    decode_mode (String)            Whether results are decoded row by row ('row') or one page at a time ('batch')
+    page_size (Int)                 Number of BigQuery rows fetched, decoded and inserted at a time
+    queue_size (Int)                Maximum number of decoded pages waiting to be inserted
+    sharding (Dictionary)           Options for the sharded mode (None if the block range is queried at once)
+    bulk_load (Dictionary)          Options for the bulk-load write path (None if rows are inserted in small batches)
+    incremental (Boolean)           Whether only blocks above the watermark are ingested, committed one block chunk at a time
+    watermark (Watermark)           Last committed block of the record (None if not in incremental mode)
+    max_bytes (Int)                 Maximum number of bytes a query may scan (None for no limit)
+    dedup (Dictionary)              Options for the removal of duplicate logs (None if duplicate logs are kept)
+    metrics (RunMetrics)            Timers and counters of each stage of the run (query wait, page fetch, dedup, decode, insert)
+    report_dir (String)             Folder of the JSON metrics report written after each run (None to not write reports)
+    fixed_point (Boolean)           Whether amounts are decoded as integers in units of 10^-18, and written without Decimal objects
+    log_cache (LogCache)            Local cache of the rows fetched from BigQuery (None if rows are always fetched)
+    address_book (AddressBook)      Dictionary in which decoded addresses are interned as integer IDs (None if addresses are decoded as strings)
+
     Methods
     -------
+    __init__                Sets default options
     set_protocol            Creates the protocol object
     set_record              Creates the record object
+    set_records             Creates a set of records (all valid records by default), fetched in a single scan
     set_stage               Creates the testing stage
-    connect                 Creates the query object and connects to SQL database
+    set_decode_mode         Sets whether results are decoded row by row or in batches
+    set_page_size           Sets the number of rows per page, and the number of pages that can wait to be inserted
+    set_sharding            Splits the block range into shards, queried concurrently and decoded in a process pool
+    set_bulk_load           Loads rows in large transactional chunks (LOAD DATA LOCAL INFILE or multi-row INSERT) instead of small batches
+    set_incremental         Only ingests blocks above the record's watermark, and commits rows and watermark one block chunk at a time
+    set_max_bytes           Sets the maximum number of bytes a query may scan (checked with a dry run before the query runs)
+    set_dedup               Sets the options for the removal of duplicate logs (by transaction hash, log index and record), or disables it
+    set_metrics             Sets the folder of the JSON metrics reports, and enables the sampling profiler of the decode loop
+    set_fixed_point         Decodes amounts as exact integers in units of 10^-18 (fixedPoint.Wei) instead of Decimal objects
+    set_log_cache           Saves the rows fetched from BigQuery to a local cache, and reads them from it when queried again
+    set_address_ids         Decodes addresses as integer IDs of the persistent address book (utils/addressBook.py) instead of strings
+    _create_writer          Creates the background writer, with the sink matching the write options
+    refresh_reference_data  Reloads token, cToken and pair information from SQL (replacing the local snapshot)
+    connect                 Creates the query object and connects to SQL database (and reads logs from log_path, if given)
     run_query               Creates the SQL query text and executes the query
-    transform_results       Processes the results and adds information to SQL database
-    print_results           Prints information about the SQL query that was processed
+    transform_results       Processes the results and adds information to SQL database, one page at a time
+    _result_pages           Fetches and processes the pages of a single query
+    _decode_page            Processes one page of results
+    write_metrics           Writes the JSON metrics report of the run
+    print_results           Prints information about the SQL query that was processed, and the time spent in each stage
     print_environ           Prints information about the testing environment
     __repr__                Returns string output of the call by which the object was instantiated
     """    
+    def __init__(self):
+        self.decode_mode = 'row'
+        self.page_size = 10000
+        self.queue_size = 4
+        self.sharding = None
+        self.bulk_load = None
+        self.incremental = False
+        self.watermark = None
+        self.max_bytes = None
+        self.dedup = {'capacity': 10000000}
+        self.metrics = RunMetrics()
+        self.report_dir = REPORT_DIR
+        self.fixed_point = False
+        self.log_cache = None
+        self.address_book = None
+
     def set_protocol(self, protocol_name, protocol_version):
         self.protocol = Protocol(protocol_name, protocol_version, self.ex_sources)
+        self.protocol.fixed_point = self.fixed_point
+        self.protocol.address_book = self.address_book
 
     def set_record(self, record_name):
         self.record = Record(record_name, self.protocol)
 
+    def set_records(self, record_names = None):
+        self.record = RecordSet(self.protocol, record_names)
+
     def set_stage(self, stage):
         # Filter out incorrect values for stage
         if (isinstance(stage, int)):
@@ -795,80 +946,190 @@ class RecordExplorer:
         else:
             raise DataValidationError('Incorrect, non-numeric value for "stage" variable. Please choose an integer between 0 and 3.')
 
-    def connect(self):
-        self.ex_sources = ExternalSources()
+    def set_decode_mode(self, decode_mode):
+        if (decode_mode not in ['row', 'batch']):
+            raise DataValidationError(f'Decode mode "{decode_mode}" is invalid. Only valid decode modes are "row" or "batch"')
+        self.decode_mode = decode_mode
+
+    def set_page_size(self, page_size, queue_size = 4):
+        if (not isinstance(page_size, int) or page_size <= 0 or not isinstance(queue_size, int) or queue_size <= 0):
+            raise DataValidationError('Incorrect value for "page_size" or "queue_size" variables. Please choose positive integers.')
+        self.page_size = page_size
+        self.queue_size = queue_size
+
+    def set_sharding(self, max_workers = 4, target_rows = 200000, initial_blocks = 10000):
+        if (not all(isinstance(x, int) and x > 0 for x in [max_workers, target_rows, initial_blocks])):
+            raise DataValidationError('Incorrect value for sharding options. Please choose positive integers.')
+        self.sharding = {'max_workers': max_workers, 'target_rows': target_rows, 'initial_blocks': initial_blocks}
+
+    def set_bulk_load(self, method = 'load', chunk_rows = 500000, rebuild_indexes = False):
+        if (method not in ['load', 'insert']):
+            raise DataValidationError(f'Bulk-load method "{method}" is invalid. Only valid methods are "load" or "insert"')
+        if (not isinstance(chunk_rows, int) or chunk_rows <= 0):
+            raise DataValidationError('Incorrect value for "chunk_rows" variable. Please choose a positive integer.')
+        self.bulk_load = {'method': method, 'chunk_rows': chunk_rows, 'rebuild_indexes': rebuild_indexes}
+
+    def set_incremental(self, incremental = True):
+        self.incremental = incremental
+
+    def set_max_bytes(self, max_bytes):
+        if (max_bytes is not None and (not isinstance(max_bytes, int) or max_bytes <= 0)):
+            raise DataValidationError('Incorrect value for "max_bytes" variable. Please choose a positive integer, or None for no limit.')
+        self.max_bytes = max_bytes
+
+    def set_dedup(self, enabled = True, capacity = 10000000):
+        if (not isinstance(capacity, int) or capacity <= 0):
+            raise DataValidationError('Incorrect value for "capacity" variable. Please choose a positive integer.')
+        self.dedup = {'capacity': capacity} if enabled else None
+
+    def set_metrics(self, report_dir = REPORT_DIR, profile = False, interval = 0.005):
+        if (profile and (not isinstance(interval, (int, float)) or interval <= 0)):
+            raise DataValidationError('Incorrect value for "interval" variable. Please choose a positive number of seconds.')
+        self.report_dir = report_dir
+        # The profiler only samples the decode loop of this process (in sharded mode, rows are decoded in other processes)
+        if (self.metrics.profiler is not None):
+            self.metrics.profiler.stop()
+        self.metrics.profiler = SamplingProfiler(interval) if profile else None
+
+    def set_fixed_point(self, enabled = True):
+        # Applies to the protocol already set, and to any protocol set afterwards
+        self.fixed_point = enabled
+        if (hasattr(self, 'protocol')):
+            self.protocol.fixed_point = enabled
+
+    def set_log_cache(self, enabled = True, max_bytes = DEFAULT_MAX_BYTES, path = LOG_CACHE_DIR):
+        if (not isinstance(max_bytes, int) or max_bytes <= 0):
+            raise DataValidationError('Incorrect value for "max_bytes" variable. Please choose a positive integer.')
+        # Must be set before connect(), which creates the log source
+        self.log_cache = LogCache(path, max_bytes) if enabled else None
+
+    def set_address_ids(self, enabled = True, address_book = None):
+        # The address book of the repository (1-scrape/cache/addressBook.bin) is used by default, so that 2-transform gets the same IDs.
+        # Applies to the protocol already set, and to any protocol set afterwards
+        if (enabled and address_book is None):
+            from utils.addressBook import AddressBook
+            address_book = AddressBook()
+        self.address_book = address_book if enabled else None
+        if (hasattr(self, 'protocol')):
+            self.protocol.address_book = self.address_book
+
+    def refresh_reference_data(self):
+        self.ex_sources.registry.refresh()
+
+    def connect(self, log_path = None):
+        self.ex_sources = ExternalSources(log_path, self.metrics, self.log_cache)
     
     def run_bq_query(self, last_block, decrement):
+        # In incremental mode, the query starts right after the watermark (or covers the full window, the first time). Block chunks are the
+        # shards of the sharded mode: each one is committed with its last block as the new watermark
+        if (self.incremental):
+            if (self.stage != 3):
+                raise DataValidationError('Incremental mode only applies to Stage 3. Please set the stage to 3.')
+            self.watermark = Watermark(self.ex_sources.cursor, self.protocol, self.record)
+            last_committed = self.watermark.read()
+            if (last_committed is not None):
+                print(f'1. Resuming after block {last_committed} (watermark)')
+                decrement = last_block - (last_committed + 1)
+                if (decrement < 0):
+                    print(f'   Record is up to date: no blocks above the watermark, up to block {last_block}')
+        else:
+            self.watermark = None
+
         # We call run_query so that we can internally pass the right parameters to the Query object, and not have to do it on the external call
-        self.ex_sources.create_bq_query(last_block, decrement, self.record, self.protocol, self.stage)
-        self.ex_sources.execute_bq_query(self.protocol)
+        self.ex_sources.create_bq_query(last_block, decrement, self.record, self.protocol, self.stage, self.incremental)
+
+        # Each block chunk is committed with its last block as the watermark, so the chunks must end at the last block that exists now
+        # (looked up before any chunk is queried). Blocks above the head, or not yet in BigQuery, are left above the watermark for the
+        # next run, instead of being skipped forever
+        if (self.incremental and decrement >= 0):
+            head = self.ex_sources.last_existing_block(self.ex_sources.create_shard_query(last_block - decrement, last_block))
+            if (head < last_block):
+                print(f'   Blocks after {head} are not available yet: ingesting up to block {head}')
+                decrement -= last_block - head
+                last_block = head
+
+        # Dry run: the query (or all shards together) is refused before it runs if it would scan more than the budget
+        bytes_estimate = self.ex_sources.estimate_bq_query()
+        print(f'   Dry run: {bytes_estimate:,} bytes to be scanned')
+        if (self.max_bytes is not None and bytes_estimate > self.max_bytes):
+            raise DataValidationError(f'Query would scan {bytes_estimate:,} bytes, over the budget of {self.max_bytes:,} bytes. Narrow the block range, or raise the budget with set_max_bytes().')
+
+        # Sharded mode only applies to the temp table without a LIMIT (Stage 2 or 3). Queries on the live table only record the destination
+        # table, so there is nothing to decode in parallel
+        from shardRunner import ShardRunner
+        if (self.incremental):
+            sharding = self.sharding if self.sharding is not None else {}
+            print(f'2. Splitting blocks {last_block - decrement} to {last_block} into block chunks')
+            self.ex_sources.results = ShardRunner(
+                self.ex_sources, self.protocol, self.record, self.decode_mode, last_block - decrement, last_block, self.dedup is not None,
+                **sharding
+            )
+        elif (self.sharding is not None and self.ex_sources.temp_used and self.stage >= 2):
+            print(f'2. Splitting blocks {last_block - decrement} to {last_block} into shards')
+            self.ex_sources.results = ShardRunner(
+                self.ex_sources, self.protocol, self.record, self.decode_mode, last_block - decrement, last_block, self.dedup is not None,
+                **self.sharding
+            )
+        else:
+            self.ex_sources.execute_bq_query(self.protocol)
         
     def transform_results(self):
         results = self.ex_sources.results
 
-        # Pair info for UniswapV2
-        if (self.protocol.name == 'Uniswap' and self.protocol.version == 2):
-            temp_query = f"SELECT pairID, LOWER(pairAddr), token0Decimals, token1Decimals FROM pairsTokens"
-            self.ex_sources.cursor.execute(temp_query)
-            pairArr = self.ex_sources.cursor.fetchall()
-
-        # Token info for CompoundV2
-        if (self.protocol.name == 'Compound' and self.protocol.version == 2):
-            temp_query = f"SELECT id, LOWER(cTokenAddr), decimals FROM addrTokens"
-            self.ex_sources.cursor.execute(temp_query)
-            tokenArr = self.ex_sources.cursor.fetchall()
-
-        # Token info for AaveV1
-        if (self.protocol.name == 'Aave' and self.protocol.version == 1):
-            temp_query = f"SELECT id, LOWER(aReserveAddr), decimals FROM addrTokens"
-            self.ex_sources.cursor.execute(temp_query)
-            tokenArr = self.ex_sources.cursor.fetchall()
-
         # Variables needs to be set first, so we can access even if calling a live table
-        j = 0          # tracks number of rows processed from BQ
-        sqlArr = []    # sqlArr will be added to SQL tables
+        j = 0               # tracks number of rows processed from BQ
+        rows_added = 0      # tracks number of rows added to SQL tables
 
         # A. If we queried the temp table, then add the rows to SQL
         if (self.ex_sources.temp_used):
             print('3. Processing results from temp table')
 
-            # Process events
-            for item in results:
-                partial_list = {
-                    'blockTime': item['block_timestamp'],
-                    'blockNumber': item['block_number'],
-                    'trxHash': item['transaction_hash']
-                }
-
-                args = [item, partial_list, self.record, sqlArr]
-                # Additional info for certain protocols
-                if (self.protocol.name == 'Uniswap' and self.protocol.version == 2):
-                    args.append(pairArr)
-                elif (
-                    (self.protocol.name == 'Compound' and self.protocol.version == 2) or 
-                    (self.protocol.name == 'Aave' and self.protocol.version == 1)
-                ):
-                    args.append(tokenArr)
-                
-                sqlArr = self.protocol.process_results(*args)
-
-                # Update # of rows (no way to know how many rows in total)
-                j = j + 1
-                print(j)
-
-            # Only log query if we're in initial testing mode
-            if (self.stage == 0 or self.stage == 1):
-                print(sqlArr)
-            # Only insert if in Stage 1 (LIMIT 10) or Stage 3 (all)
+            # Only insert if in Stage 1 (LIMIT 10) or Stage 3 (all). Rows are inserted one page at a time by a separate thread, while the
+            # next page is fetched and decoded. The queue between both is bounded, so memory does not grow with the block range
             if (self.stage == 1 or self.stage == 3):
-                print('4. Recording results to local database')
-                # Could do one insert query (and may be more efficient), but it would be impossible to track progress, and MySQL may time out while
-                # processing very large query
-                step = 100 # Optimal balance between too large queries and too many queries, per testing
-
-                # Do SQL queries in batches. 
-                for i in tqdm(range(0, len(sqlArr), step)):
-                    self.ex_sources.cursor.executemany(self.protocol.insert_query, sqlArr[i:i+step])
+                print('4. Recording results to local database (while processing results)')
+                writer = self._create_writer()
+            else:
+                writer = None
+
+            # Decoded pages come either from the shards (decoded in other processes), or from the pages of the single query
+            from shardRunner import ShardRunner
+            if (isinstance(results, ShardRunner)):
+                pages = results.pages()
+            else:
+                pages = self._result_pages(results)
+
+            sample = []         # first decoded rows, printed in initial testing mode (Stage 0 or 1)
+            from tqdm import tqdm
+            progress = tqdm(unit = ' rows processed')
+            try:
+                for num_rows, sqlArr, last_block in pages:
+                    # Only keep rows to print if we're in initial testing mode. They are printed once all pages are processed, so that
+                    # printing doesn't slow down the loop
+                    if ((self.stage == 0 or self.stage == 1) and len(sample) < 10):
+                        sample += sqlArr[:10 - len(sample)]
+                    if (writer is not None and len(sqlArr) > 0):
+                        writer.put(sqlArr)
+                    # In incremental mode, the rows of the block chunk are committed together with the new watermark
+                    if (writer is not None and self.watermark is not None):
+                        writer.checkpoint(last_block)
+
+                    # Update # of rows (no way to know how many rows in total)
+                    j = j + num_rows
+                    rows_added = rows_added + len(sqlArr)
+                    progress.update(num_rows)
+            finally:
+                progress.close()
+                # Wait for the remaining pages to be inserted
+                if (writer is not None):
+                    writer.close()
+                # New addresses keep their IDs in later runs (and in 2-transform)
+                if (self.address_book is not None):
+                    self.address_book.save()
+            for row in sample:
+                if (self.address_book is not None):
+                    row = [self.address_book.sql_value(value) for value in row]
+                print(row)
                
         # B. If we query the live database, then just add the destination to SQL database
         else: 
@@ -880,11 +1141,107 @@ class RecordExplorer:
             
             print('4. Recording destination table to local database')
             self.ex_sources.cursor.execute(insert_query)
+
+            # Later runs of the record query the temp table, whose rows are not cached. With a log cache, the rows are read now instead
+            # (reading the destination table scans nothing), so that later runs read them from disk
+            if (isinstance(results, CachingJob)):
+                print('5. Saving rows to the log cache')
+                cached_rows = results.save(self.page_size)
+                print(f'   {cached_rows:,} rows saved')
         
         self.ex_sources.cursor.close()
         self.ex_sources.results.j = j
-        self.ex_sources.results.len = len(sqlArr)
+        self.ex_sources.results.len = rows_added
+        self.metrics.count('rows_processed', j)
+        self.metrics.count('rows_added', rows_added)
+        self.metrics.count('duplicates', getattr(self.ex_sources.results, 'duplicates', 0))
+        if (self.report_dir is not None):
+            self.write_metrics()
+
+    def _create_writer(self):
+        if (self.bulk_load is None and self.watermark is None):
+            sink = InsertSink(self.protocol.insert_query, fixed_point = self.fixed_point, address_book = self.address_book)
+            return PageWriter(self.ex_sources.connect_sql, sink, self.queue_size, self.metrics)
+
+        # Bulk loads and block chunks are committed by the sink, and LOAD DATA LOCAL INFILE must be allowed by the client
+        if (self.bulk_load is None):
+            sink = InsertSink(
+                self.protocol.insert_query, watermark = self.watermark, fixed_point = self.fixed_point, address_book = self.address_book
+            )
+        else:
+            sink = BulkLoadSink(self.protocol.insert_query, watermark = self.watermark, address_book = self.address_book, **self.bulk_load)
+        connect = lambda: self.ex_sources.connect_sql(autocommit = False, allow_local_infile = True)
+        return PageWriter(connect, sink, self.queue_size, self.metrics)
+
+    def _result_pages(self, results):
+        from batchDecoder import BatchDecoder
+        from dedup import LogDeduplicator
+        decoder = BatchDecoder(self.protocol)
+        decode_stage = f'decode/{decoder.handler_name(self.decode_mode)}'
+        last_row = None     # last row of the previous page, so that duplicate rows can also be found across pages
+
+        # Rows of a single query are not ordered by block, so the keys of all rows are kept (up to the capacity)
+        dedup = LogDeduplicator(False, **self.dedup) if self.dedup is not None else None
+        results.duplicates = 0
+
+        # Waits for the query to finish (BigQuery). The number of rows is known before the first page, so a query too large to remove all
+        # duplicates is reported before anything is inserted
+        with self.metrics.timer('query_wait'):
+            iterator = results.result(page_size = self.page_size)
+            pages = iter(iterator.pages)
+        if (dedup is not None):
+            dedup.expect(getattr(iterator, 'total_rows', None))
+
+        while True:
+            # Pages are downloaded as they are needed
+            start = timer()
+            page = next(pages, None)
+            if (page is None):
+                break
+            rows = list(page)
+            num_rows = len(rows)
+            self.metrics.add('page_fetch', timer() - start, num_rows)
+
+            if (dedup is not None):
+                with self.metrics.timer('dedup', num_rows):
+                    rows = dedup.filter(rows, self.record)
+                results.duplicates = dedup.duplicates
+
+            start = timer()
+            with self.metrics.profile():
+                sqlArr = self._decode_page(rows, decoder, last_row)
+            self.metrics.add(decode_stage, timer() - start, len(rows))
+
+            if (len(sqlArr) > 0):
+                last_row = sqlArr[len(sqlArr) - 1]
+            yield num_rows, sqlArr, None
+
+    def _decode_page(self, rows, decoder, last_row):
+        # The page starts with the last row of the previous page, so that duplicate checks (Maker) compare against it. It is removed
+        # before the page is returned
+        sqlArr = [] if (last_row is None) else [last_row]
+
+        # Process events, one page at a time
+        if (self.decode_mode == 'batch'):
+            sqlArr = decoder.process_page(rows, self.record, sqlArr)
+
+        # Process events, one row at a time
+        else:
+            sqlArr = decoder.process_rows(rows, self.record, sqlArr)
+
+        return sqlArr if (last_row is None) else sqlArr[1:]
     
+    def write_metrics(self, path = None):
+        # One report per run, named after the record and the time the run started
+        if (path is None):
+            path = os.path.join(self.report_dir, f'{self.protocol.name}{self.protocol.version}-{self.record.name}-{self.metrics.started:%Y%m%d-%H%M%S}.json')
+        self.metrics.write(
+            path, protocol = self.protocol.name, version = self.protocol.version, record = self.record.name, stage = self.stage,
+            decode_mode = self.decode_mode, page_size = self.page_size, sharding = self.sharding, bulk_load = self.bulk_load,
+            incremental = self.incremental, dedup = self.dedup
+        )
+        print(f'Metrics report written to {path}')
+
     def print_results(self):
         results = self.ex_sources.results
 
@@ -895,8 +1252,19 @@ class RecordExplorer:
         if (self.ex_sources.temp_used):
                 print('-'*60)
                 print(f'Number of rows processed: {results.j}')
+                print(f'Number of duplicate logs removed: {results.duplicates}')
                 print(f'Number of rows added to local DB: {results.len}')
 
+        # Time spent in each stage. Stages run concurrently (e.g. inserts while the next page is decoded), so their times can add up to
+        # more than the total time
+        print('-'*60)
+        for name, stage in self.metrics.stages.items():
+            rate = f'{stage["rows"] / stage["seconds"]:>12,.0f} rows/s' if stage['seconds'] > 0 and stage['rows'] > 0 else ''
+            print(f'{name:<40} {stage["seconds"]:>9.2f} s {rate}')
+        peak = self.metrics.peak_memory()
+        if (peak is not None):
+            print(f'Peak memory: {peak / 2 ** 20:,.0f} MiB')
+
     def print_environ(self):
         noteText = f'---- Production environment for {self.protocol.name} ----\n    Live table:\n\tQueries on live table (BQ) have no limits (because of high resource utilization for live queries), and the destination table is added to tempTables (local DB)'
         # Set "Added or Not" variable, on whether values are recorded to a local database
@@ -0,0 +1,87 @@
+# Exact fixed-point amounts. Every amount column holds 18 decimals: amounts with another number of decimals (e.g. USDC, cTokens, Aave
+# rays) are normalized to 18 decimals when they are decoded, as in Protocol._convert_dec. In fixed-point mode (RecordExplorer.set_fixed_point),
+# amounts are therefore kept as integers in units of 10^-18 (Wei), instead of Decimal objects created for every amount. They are written to
+# the DECIMAL columns as exact decimal literals, and are only converted to floats where they are valued in USD (usdValuation.py)
+from decimal import Decimal, localcontext
+
+# Number of decimals of the amount columns, and number of units per token
+SCALE = 18
+UNIT = 10 ** SCALE
+# Largest amount accepted by Web3.fromWei
+MAX_WEI = 2 ** 256 - 1
+# Same divisor as Web3.fromWei (ether)
+_WEI_PER_ETHER = Decimal(UNIT)
+
+class Wei(int):
+    """
+    A class representing an amount as an integer number of units of 10^-18 (the scale of every amount column)
+
+    Methods
+    -------
+    __neg__                     Returns the opposite amount (as Wei)
+    __mul__                     Returns the amount multiplied by an integer, e.g. a sign (as Wei)
+    __float__                   Returns the amount in tokens, as a float (for USD values)
+    literal                     Returns the amount in tokens, as an exact decimal literal (e.g. '-1.500000000000000000')
+    to_decimal                  Returns the amount in tokens, as a Decimal (same value as Web3.fromWei)
+    __str__                     Returns the decimal literal
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    __slots__ = ()
+
+    def __neg__(self):
+        return Wei(-int(self))
+
+    def __mul__(self, other):
+        # Only integers (signs) keep the scale. Anything else is multiplied as a plain integer
+        if (type(other) is int):
+            return Wei(int(self) * other)
+        return int.__mul__(self, other)
+
+    __rmul__ = __mul__
+
+    def __float__(self):
+        # Integer division is correctly rounded, so this is the nearest float to the exact amount
+        return int(self) / UNIT
+
+    def literal(self):
+        units, fraction = divmod(abs(int(self)), UNIT)
+        return f'{"-" if self < 0 else ""}{units}.{fraction:0{SCALE}d}'
+
+    def to_decimal(self):
+        return Decimal(self.literal())
+
+    def __str__(self):
+        return self.literal()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({int(self)})')
+
+def scale_units(value, decimals):
+    # Normalizes an integer amount with the given number of decimals to 18 decimals: a multiplication by a power of ten for fewer decimals,
+    # and an integer division (dropping the excess digits) for more decimals. Same result as the string padding of the original
+    # _convert_dec, without the string round trip
+    if (decimals <= SCALE):
+        return value * 10 ** (SCALE - decimals)
+    return value // 10 ** (decimals - SCALE)
+
+def to_wei(value):
+    # Same range check as Web3.fromWei
+    if (value < 0 or value > MAX_WEI):
+        raise ValueError("value must be between 1 and 2**256 - 1")
+    return Wei(value)
+
+def from_wei(value):
+    # Same result as Web3.fromWei(value, 'ether'): a Decimal (int 0 for zero amounts), without importing web3
+    if (value == 0):
+        return 0
+    if (value < 0 or value > MAX_WEI):
+        raise ValueError("value must be between 1 and 2**256 - 1")
+    with localcontext() as ctx:
+        ctx.prec = 999
+        return Decimal(value) / _WEI_PER_ETHER
+
+def sql_value(value):
+    # Wei amounts are passed to MySQL as decimal literals, which DECIMAL columns store exactly (other values are passed as they are)
+    if (isinstance(value, Wei)):
+        return value.literal()
+    return value
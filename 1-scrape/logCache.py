@@ -0,0 +1,384 @@
+# Local cache of log query results. The rows of each BigQuery log query are saved to disk as they are fetched, in Parquet files (columnar,
+# compressed), so that reruns of the same records (Stages 0 to 3, decode and insert experiments) read them from disk instead of running the
+# query again, even after the temp table has expired. Files are content-addressed: the key is a hash of the normalized query (sorted
+# signatures and addresses, and whether the data column is needed), and each file (segment) holds all rows of the key for a block range.
+# Only rows of the live table are saved (a temp table may hold only part of a range), and a segment ends at the last block that existed
+# when the query started, so that blocks above the head are fetched again later instead of being read as empty. The first run of a record
+# (Stage 0 to 3) only records the destination table of its live query, so its rows are read then to fill the cache (see CachingJob.save)
+# A query is served from the cache when its block range is covered by the segments of its key, even if it is only part of a segment or
+# spans several segments (e.g. the shards of an earlier sharded run). The total size of the segments is kept under a byte budget by
+# removing the least recently used segments first
+import os, json, hashlib, threading
+from datetime import datetime, timezone
+
+from logSources import LocalQueryJob, log_schema, LIVE_TABLE
+
+# Default folder of the cached segments and their index, and default byte budget
+LOG_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'logs')
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+class LogCache:
+    """
+    A class representing the cached segments of log query results, on local disk
+
+    Attributes
+    ----------
+    path (String)               Folder of the segments (one folder per key) and of the index
+    max_bytes (Integer)         Byte budget: least recently used segments are removed once the segments are larger in total
+    _segments (Dictionary)      Segments of each key: file, first and last block, number of rows, size and time of last use
+    _lock (Lock)                Lock for the index (shard queries read and write segments from several threads)
+
+    Methods
+    -------
+    __init__                    Sets the folder and budget, and reads the index
+    key                         Returns the key of a query (hash of its normalized signatures, addresses and columns)
+    covers                      Returns whether the block range of a query is covered by cached segments
+    read                        Returns the cached rows of a query, as a finished job (None if the range is not covered)
+    writer                      Returns a SegmentWriter, which saves the rows of a query (up to a last block) as they are fetched
+    add                         Records a new segment, removes the segments it replaces, and applies the byte budget
+    size                        Returns the total size of the segments
+    _cover                      Returns the segments (and block range of each) needed to cover a block range
+    _evict                      Removes the least recently used segments until the segments fit in the budget
+    _remove                     Removes a segment file
+    _load_index                 Reads the index from disk
+    _save_index                 Writes the index to disk
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, path = LOG_CACHE_DIR, max_bytes = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._segments = self._load_index()
+
+    def key(self, query):
+        # The table is not part of the key, because only rows of the live table are saved (see CachedLogSource.execute)
+        normalized = {
+            'signatures': sorted(set(query.signatures)),
+            'addresses': sorted(set(query.addresses)),
+            'columns': query.columns(),
+        }
+        return hashlib.sha256(json.dumps(normalized).encode('ascii')).hexdigest()[:32]
+
+    def covers(self, query):
+        with self._lock:
+            return self._cover(self.key(query), query.first_block, query.last_block) is not None
+
+    def read(self, query):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        created = datetime.now(timezone.utc)
+        with self._lock:
+            pieces = self._cover(self.key(query), query.first_block, query.last_block)
+            if (pieces is None):
+                return None
+            now = created.timestamp()
+            for segment, _, _ in pieces:
+                segment['last_used'] = now
+            self._save_index()
+
+        # Segments can overlap: each one is only read for the blocks not read from the previous one. Files are memory-mapped, and row
+        # groups outside the blocks are skipped using the Parquet statistics
+        tables = []
+        try:
+            for segment, first_block, last_block in pieces:
+                tables.append(pq.read_table(
+                    os.path.join(self.path, segment['file']), columns = query.columns(), memory_map = True,
+                    filters = [('block_number', '>=', first_block), ('block_number', '<=', last_block)],
+                ))
+        except FileNotFoundError:
+            # The segment was removed in the meantime (budget applied by another shard query): the query runs again
+            return None
+        table = pa.concat_tables([t.cast(log_schema(query.columns())) for t in tables])
+
+        if (query.ordered):
+            table = table.sort_by([('block_number', 'ascending'), ('transaction_hash', 'ascending')])
+        if (query.limit is not None):
+            table = table.slice(0, query.limit)
+        # Nothing is scanned by BigQuery
+        return LocalQueryJob(table, created, 0)
+
+    def writer(self, query, last_block):
+        return SegmentWriter(self, query, last_block)
+
+    def add(self, key, file, first_block, last_block, rows):
+        with self._lock:
+            segments = self._segments.setdefault(key, [])
+            # Segments inside the new block range are replaced by it
+            for segment in [s for s in segments if s['first_block'] >= first_block and s['last_block'] <= last_block]:
+                segments.remove(segment)
+                # The same block range is saved to the same file, which now holds the new rows
+                if (segment['file'] != file):
+                    self._remove(segment)
+            segment = {
+                'file': file, 'first_block': first_block, 'last_block': last_block, 'rows': rows,
+                'bytes': os.path.getsize(os.path.join(self.path, file)), 'last_used': datetime.now(timezone.utc).timestamp(),
+            }
+            segments.append(segment)
+            self._evict(keep = segment)
+            self._save_index()
+
+    def size(self):
+        with self._lock:
+            return sum(segment['bytes'] for segments in self._segments.values() for segment in segments)
+
+    def _cover(self, key, first_block, last_block):
+        # Greedy cover of the block range: from the first block not yet covered, the segment that reaches the furthest block is used
+        segments = self._segments.get(key, [])
+        pieces = []
+        block = first_block
+        while (block <= last_block):
+            candidates = [s for s in segments if s['first_block'] <= block <= s['last_block']]
+            if (len(candidates) == 0):
+                return None
+            segment = max(candidates, key = lambda s: s['last_block'])
+            pieces.append((segment, block, min(segment['last_block'], last_block)))
+            block = segment['last_block'] + 1
+        return pieces
+
+    def _evict(self, keep = None):
+        segments = [(segment, key) for key, key_segments in self._segments.items() for segment in key_segments if segment is not keep]
+        total = sum(segment['bytes'] for segment, _ in segments) + (keep['bytes'] if keep is not None else 0)
+        for segment, key in sorted(segments, key = lambda s: s[0]['last_used']):
+            if (total <= self.max_bytes):
+                break
+            self._segments[key].remove(segment)
+            self._remove(segment)
+            total -= segment['bytes']
+            print(f'Removed cached logs {segment["file"]} (blocks {segment["first_block"]} to {segment["last_block"]}) from the log cache')
+        self._segments = {key: key_segments for key, key_segments in self._segments.items() if len(key_segments) > 0}
+
+    def _remove(self, segment):
+        try:
+            os.remove(os.path.join(self.path, segment['file']))
+        except FileNotFoundError:
+            pass
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, 'index.json')
+        if (not os.path.exists(index_path)):
+            return {}
+        with open(index_path) as f:
+            segments = json.load(f)['segments']
+        # Segments whose file was removed by hand are forgotten
+        return {
+            key: [s for s in key_segments if os.path.exists(os.path.join(self.path, s['file']))] for key, key_segments in segments.items()
+        }
+
+    def _save_index(self):
+        os.makedirs(self.path, exist_ok = True)
+        # Write to a temporary file first, so that an interrupted run never leaves a partial index
+        index_path = os.path.join(self.path, 'index.json')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({'segments': self._segments}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.path}, {self.max_bytes})')
+
+class SegmentWriter:
+    """
+    A class that saves the rows of a query to a new segment, one page at a time
+
+    Attributes
+    ----------
+    rows (Integer)              Number of rows written so far
+    _cache (LogCache)           Cache the segment is added to
+    _query (LogQuery)           Query whose rows are saved
+    _key (String)               Key of the query
+    _last_block (Integer)       Last block covered by the segment (the query's last block, or the head if the range goes past it)
+    _file (String)              Segment file, relative to the cache folder
+    _schema (Schema)            Types of the columns of the query
+    _writer (ParquetWriter)     Writer of the temporary segment file
+
+    Methods
+    -------
+    __init__                    Opens the temporary segment file, for the blocks of the query up to the last block
+    write                       Writes a page of rows (BigQuery rows or dictionaries)
+    commit                      Closes the file and adds the segment to the cache (once all rows of the query are written)
+    abort                       Closes and removes the temporary file (the rows are incomplete)
+    _path                       Returns the location of the segment file
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, cache, query, last_block):
+        import pyarrow.parquet as pq
+
+        self.rows = 0
+        self._cache = cache
+        self._query = query
+        self._key = cache.key(query)
+        self._last_block = last_block
+        self._file = os.path.join(self._key, f'{query.first_block}-{last_block}.parquet')
+        self._schema = log_schema(query.columns())
+        os.makedirs(os.path.join(cache.path, self._key), exist_ok = True)
+        self._writer = pq.ParquetWriter(self._path() + '.tmp', self._schema, compression = 'zstd')
+
+    def write(self, rows):
+        import pyarrow as pa
+
+        if (len(rows) == 0):
+            return
+        records = [row if isinstance(row, dict) else dict(row.items()) for row in rows]
+        self._writer.write_table(pa.Table.from_pylist(records, schema = self._schema))
+        self.rows += len(rows)
+
+    def commit(self):
+        self._writer.close()
+        os.replace(self._path() + '.tmp', self._path())
+        self._cache.add(self._key, self._file, self._query.first_block, self._last_block, self.rows)
+
+    def abort(self):
+        self._writer.close()
+        os.remove(self._path() + '.tmp')
+
+    def _path(self):
+        return os.path.join(self._cache.path, self._file)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self._file})')
+
+class CachedLogSource:
+    """
+    A class representing a source of logs (BigQueryLogSource) with a local cache of the query results
+
+    Attributes
+    ----------
+    is_local (Boolean)          Whether the source reads local files (same as the source)
+    source (LogSource)          Source of the rows that are not cached
+    cache (LogCache)            Cached query results
+
+    Methods
+    -------
+    __init__                    Sets the source and the cache
+    covers                      Returns whether the rows of a query are all cached
+    estimate                    Returns the number of bytes the query would scan (0 if the rows are cached)
+    execute                     Returns the cached rows of the query, or runs the query and saves its rows as they are fetched
+    last_existing_block         Returns the last block of the query's range that exists (looked up by the source)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+        self.is_local = source.is_local
+
+    def covers(self, query):
+        return self.cache.covers(query)
+
+    def estimate(self, query):
+        if (self.cache.covers(query)):
+            return 0
+        return self.source.estimate(query)
+
+    def execute(self, query):
+        job = self.cache.read(query)
+        if (job is not None):
+            return job
+        # Rows of a query with a LIMIT, or of a temp table, may only be part of the block range, so they are not saved. The head is looked
+        # up before the query starts, so that blocks added while it runs are not counted as fetched
+        if (query.limit is not None or query.table_name != LIVE_TABLE):
+            return self.source.execute(query)
+        last_block = self.source.last_existing_block(query)
+        job = self.source.execute(query)
+        if (last_block < query.first_block):
+            return job
+        return CachingJob(job, self.cache, query, last_block)
+
+    def last_existing_block(self, query):
+        return self.source.last_existing_block(query)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.source}, {self.cache})')
+
+class CachingJob:
+    """
+    A class representing a query job whose rows are saved to the log cache as they are fetched. Other attributes are the job's
+
+    Attributes
+    ----------
+    _job (Job)                  Query job
+    _cache (LogCache)           Cache the rows are saved to
+    _query (LogQuery)           Query of the job
+    _last_block (Integer)       Last block the saved rows cover
+
+    Methods
+    -------
+    __init__                    Sets the job
+    result                      Returns the rows of the job, in pages, saving them as they are fetched
+    save                        Fetches all rows of the job only to save them, and returns the number of rows
+    __iter__                    Returns the rows one at a time
+    __getattr__                 Returns the attributes of the job (e.g. destination, total_bytes_processed)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, job, cache, query, last_block):
+        self._job = job
+        self._cache = cache
+        self._query = query
+        self._last_block = last_block
+
+    def result(self, page_size = None):
+        return CachingRowIterator(self._job.result(page_size = page_size), self._cache, self._query, self._last_block)
+
+    def save(self, page_size = None):
+        # Pages are dropped once written, so memory does not grow with the number of rows
+        rows = 0
+        for page in self.result(page_size = page_size).pages:
+            rows += len(page)
+        return rows
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self._job})')
+
+class CachingRowIterator:
+    """
+    A class representing the rows of a job, with the same interface as a BigQuery row iterator. The segment is only added to the cache
+    once all pages are fetched
+
+    Attributes
+    ----------
+    _iterator (RowIterator)     Rows of the job
+    _cache (LogCache)           Cache the rows are saved to
+    _query (LogQuery)           Query of the job
+    _last_block (Integer)       Last block the saved rows cover
+
+    Methods
+    -------
+    __init__                    Sets the rows, and where they are saved
+    pages                       Returns the rows in pages (lists), saving each page
+    __iter__                    Returns the rows one at a time
+    __getattr__                 Returns the attributes of the row iterator (e.g. total_rows)
+    """
+    def __init__(self, iterator, cache, query, last_block):
+        self._iterator = iterator
+        self._cache = cache
+        self._query = query
+        self._last_block = last_block
+
+    @property
+    def pages(self):
+        writer = self._cache.writer(self._query, self._last_block)
+        complete = False
+        try:
+            for page in self._iterator.pages:
+                rows = list(page)
+                writer.write(rows)
+                yield rows
+            complete = True
+        finally:
+            # Pages that were not all fetched (error, or stopped early) are not saved
+            if (complete):
+                writer.commit()
+            else:
+                writer.abort()
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
@@ -0,0 +1,321 @@
+# Sources of Ethereum log rows. A LogQuery describes which rows are needed (block range, addresses, signatures); a log source executes it.
+# BigQueryLogSource runs the query on Google BigQuery (crypto_ethereum.logs, or a temp table). LocalLogSource reads exported log files
+# (Parquet or NDJSON, same columns as the BigQuery table) from local disk, so that runs and reruns do not need a remote scan.
+# BigQuery queries are planned by QueryPlanner (queryPlanner.py): addresses and signatures are passed as array parameters, the block range
+# is also given as block_timestamp bounds (so that BigQuery only scans the partitions of the range), and a dry run estimates the bytes
+# scanned before the query runs. google.cloud.bigquery is only imported when a BigQuery query is planned or run, so that local runs (and
+# importing defiEvents) don't load it
+import os, glob, copy
+from datetime import datetime, timezone
+
+from queryPlanner import QueryPlanner
+
+# Live logs table on BigQuery (temp tables are copies of part of it)
+LIVE_TABLE = 'bigquery-public-data.crypto_ethereum.logs'
+# Columns of the logs table used by the decoders
+LOG_COLUMNS = ['transaction_hash', 'log_index', 'address', 'topics', 'block_timestamp', 'block_number', 'data']
+
+def log_schema(columns):
+    # Types of the logs table columns (Arrow), for local log files and the log cache (logCache.py)
+    import pyarrow as pa
+
+    types = {
+        'transaction_hash': pa.string(),
+        'log_index': pa.int64(),
+        'address': pa.string(),
+        'topics': pa.list_(pa.string()),
+        'block_timestamp': pa.timestamp('us', tz = 'UTC'),
+        'block_number': pa.int64(),
+        'data': pa.string(),
+    }
+    return pa.schema([(column, types[column]) for column in columns])
+
+class LogQuery:
+    """
+    A class representing a query on the logs table
+
+    Attributes
+    ----------
+    table_name (String)         Name of the table queried (BigQuery table, or local folder)
+    first_block (Integer)       First block of the range
+    last_block (Integer)        Last block of the range (included)
+    addresses (Array)           Lowercase contract addresses that emitted the logs
+    signatures (Array)          Signatures of the records (first topic). Several records are fetched in a single scan
+    include_data (Boolean)      Whether the data column is needed
+    limit (Integer)             Maximum number of rows (None for no limit)
+    ordered (Boolean)           Whether rows are ordered by block and transaction
+    time_bounds (Tuple)         Timestamps of the first and last blocks (set by QueryPlanner; None until the query is planned)
+
+    Methods
+    -------
+    __init__                    Sets the query parameters
+    columns                     Returns the columns selected
+    text                        Returns the SQL text of the query (BigQuery), with named parameters
+    parameters                  Returns the values of the named parameters (BigQuery)
+    shard                       Returns the same query, limited to a range of blocks and ordered by block
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, table_name, first_block, last_block, addresses, signatures, include_data = True, limit = None, ordered = False):
+        self.table_name = table_name
+        self.first_block = first_block
+        self.last_block = last_block
+        self.addresses = [addr.lower() for addr in addresses]
+        self.signatures = signatures if isinstance(signatures, list) else [signatures]
+        self.include_data = include_data
+        self.limit = limit
+        self.ordered = ordered
+        self.time_bounds = None
+
+    def columns(self):
+        return LOG_COLUMNS if self.include_data else LOG_COLUMNS[:-1]
+
+    def text(self):
+        # Addresses and signatures are array parameters, so the text does not grow with the number of addresses (Uniswap V2 pairs,
+        # Compound V2 cTokens). The timestamp bounds are only added once known, because the logs table is partitioned by block_timestamp
+        time_bounds = ''
+        if (self.time_bounds is not None):
+            if (self.time_bounds[0] is not None):
+                time_bounds += '\n            AND block_timestamp >= @first_time'
+            if (self.time_bounds[1] is not None):
+                time_bounds += '\n            AND block_timestamp <= @last_time'
+
+        select_params = {
+            'columns': ', '.join(self.columns()),
+            'tableName': self.table_name,
+            'timeBounds': time_bounds,
+            'order': 'ORDER BY block_number, transaction_hash' if self.ordered else '',
+            'limit': f' LIMIT {self.limit}' if self.limit is not None else '',
+        }
+
+        return """
+            SELECT {columns}
+            FROM `{tableName}`
+            WHERE block_number >= @first_block AND block_number <= @last_block{timeBounds}
+            AND address IN UNNEST(@addresses)
+            AND topics[SAFE_OFFSET(0)] IN UNNEST(@signatures)
+            {order}
+            {limit};
+        """.format(**select_params)
+
+    def parameters(self):
+        from google.cloud import bigquery
+        params = [
+            bigquery.ScalarQueryParameter('first_block', 'INT64', self.first_block),
+            bigquery.ScalarQueryParameter('last_block', 'INT64', self.last_block),
+            bigquery.ArrayQueryParameter('addresses', 'STRING', self.addresses),
+            bigquery.ArrayQueryParameter('signatures', 'STRING', self.signatures),
+        ]
+        if (self.time_bounds is not None):
+            if (self.time_bounds[0] is not None):
+                params.append(bigquery.ScalarQueryParameter('first_time', 'TIMESTAMP', self.time_bounds[0]))
+            if (self.time_bounds[1] is not None):
+                params.append(bigquery.ScalarQueryParameter('last_time', 'TIMESTAMP', self.time_bounds[1]))
+        return params
+
+    def shard(self, first_block, last_block):
+        shard_query = copy.copy(self)
+        shard_query.first_block = first_block
+        shard_query.last_block = last_block
+        shard_query.ordered = True
+        return shard_query
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.table_name}, {self.first_block}, {self.last_block})')
+
+class BigQueryLogSource:
+    """
+    A class representing Google BigQuery as a source of logs
+
+    Attributes
+    ----------
+    is_local (Boolean)          Whether the source reads local files (always False)
+    _client (Client)            Connection to BigQuery
+    _planner (QueryPlanner)     Sets the timestamp bounds and parameters of each query, and runs dry runs
+
+    Methods
+    -------
+    __init__                    Connects to BigQuery
+    estimate                    Returns the number of bytes the query would scan (dry run)
+    execute                     Starts the query, and returns the BigQuery job
+    last_existing_block         Returns the last block of the query's range that exists (the head, if the range goes past it)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    is_local = False
+
+    def __init__(self):
+        from google.cloud import bigquery
+        self._client = bigquery.Client()
+        self._planner = QueryPlanner(self._client)
+
+    def estimate(self, query):
+        return self._planner.dry_run(query)
+
+    def execute(self, query):
+        return self._client.query(query.text(), job_config = self._planner.plan(query))
+
+    def last_existing_block(self, query):
+        return self._planner.last_existing_block(query)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
+
+class LocalLogSource:
+    """
+    A class representing exported log files (Parquet or NDJSON) on local disk as a source of logs
+
+    Attributes
+    ----------
+    is_local (Boolean)          Whether the source reads local files (always True)
+    path (String)               Folder with the exported log files
+    _parquet_files (Array)      Parquet files in the folder
+    _json_files (Array)         NDJSON files in the folder
+
+    Methods
+    -------
+    __init__                    Finds the log files in the folder
+    estimate                    Returns the number of bytes the query would read (size of the log files)
+    execute                     Reads the rows matching the query, and returns them as a finished job
+    _scan_parquet               Reads Parquet files, with block range and address filters pushed down to the scan
+    _scan_json                  Reads NDJSON files and applies the block range and address filters
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    is_local = True
+
+    def __init__(self, path):
+        self.path = path
+        self._parquet_files = sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive = True))
+        self._json_files = sorted(
+            glob.glob(os.path.join(path, '**', '*.json'), recursive = True) + glob.glob(os.path.join(path, '**', '*.ndjson'), recursive = True)
+        )
+        if (len(self._parquet_files) + len(self._json_files) == 0):
+            raise FileNotFoundError(f'No Parquet or NDJSON log files found in {path}')
+
+    def estimate(self, query):
+        return sum(os.path.getsize(f) for f in self._parquet_files + self._json_files)
+
+    def execute(self, query):
+        # pyarrow is only needed for local files, so it is imported here
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        created = datetime.now(timezone.utc)
+        tables = []
+        if (len(self._parquet_files) > 0):
+            tables.append(self._scan_parquet(query))
+        if (len(self._json_files) > 0):
+            tables.append(self._scan_json(query))
+        # Files exported in different formats can use slightly different types (e.g. timestamp units), so all tables are cast to the types
+        # of the BigQuery logs table
+        schema = log_schema(query.columns())
+        table = pa.concat_tables([t.cast(schema) for t in tables])
+
+        # Signature filter (first topic, one of the query's signatures). Lists can't be filtered in the scan, so this filter runs on the rows already filtered by block and
+        # address
+        table = table.filter(pc.greater(pc.list_value_length(table['topics']), 0))
+        first_topics = pc.list_element(table['topics'], 0)
+        table = table.filter(pc.fill_null(pc.is_in(first_topics, value_set = pa.array(query.signatures)), False))
+
+        if (query.ordered):
+            table = table.sort_by([('block_number', 'ascending'), ('transaction_hash', 'ascending')])
+        if (query.limit is not None):
+            table = table.slice(0, query.limit)
+
+        return LocalQueryJob(table, created, self.estimate(query))
+
+    def _scan_parquet(self, query):
+        import pyarrow.dataset as ds
+        import pyarrow.fs as fs
+
+        # Files are memory-mapped, and only the needed columns are read. Block range and address filters are pushed down to the scan, so
+        # that row groups outside the range are skipped using the Parquet statistics
+        dataset = ds.dataset(self._parquet_files, format = 'parquet', filesystem = fs.LocalFileSystem(use_mmap = True))
+        row_filter = (
+            (ds.field('block_number') >= query.first_block) & (ds.field('block_number') <= query.last_block) &
+            ds.field('address').isin(query.addresses)
+        )
+        return dataset.to_table(columns = query.columns(), filter = row_filter)
+
+    def _scan_json(self, query):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.json as pj
+
+        # Types are given explicitly, because they can't always be inferred from JSON (e.g. timestamps, or empty topic lists)
+        parse_options = pj.ParseOptions(explicit_schema = log_schema(LOG_COLUMNS))
+        tables = []
+        for json_file in self._json_files:
+            table = pj.read_json(pa.memory_map(json_file), parse_options = parse_options).select(query.columns())
+            row_filter = pc.and_(
+                pc.and_(pc.greater_equal(table['block_number'], query.first_block), pc.less_equal(table['block_number'], query.last_block)),
+                pc.is_in(table['address'], value_set = pa.array(query.addresses))
+            )
+            tables.append(table.filter(row_filter))
+        return pa.concat_tables(tables)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.path})')
+
+class LocalQueryJob:
+    """
+    A class representing the result of a query on local log files, with the same interface as a BigQuery job
+
+    Attributes
+    ----------
+    created (Datetime)              Time the query started
+    ended (Datetime)                Time the query ended
+    total_bytes_processed (Integer) Size of the files read
+    destination (String)            Destination table (None, because the rows are not saved)
+    _table (Table)                  Arrow table with the matching rows
+
+    Methods
+    -------
+    __init__                        Saves the rows and statistics
+    result                          Returns the rows, in pages
+    __iter__                        Returns the rows one at a time
+    __repr__                        Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, table, created, bytes_processed):
+        self._table = table
+        self.created = created
+        self.ended = datetime.now(timezone.utc)
+        self.total_bytes_processed = bytes_processed
+        self.destination = None
+
+    def result(self, page_size = None):
+        return LocalRowIterator(self._table, page_size)
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self._table.num_rows} rows)')
+
+class LocalRowIterator:
+    """
+    A class representing the rows of a local query, with the same interface as a BigQuery row iterator
+
+    Attributes
+    ----------
+    total_rows (Integer)        Number of rows
+    _table (Table)              Arrow table with the rows
+    _page_size (Integer)        Number of rows per page
+
+    Methods
+    -------
+    __init__                    Saves the rows
+    pages                       Returns the rows in pages (lists of dictionaries)
+    __iter__                    Returns the rows one at a time
+    """
+    def __init__(self, table, page_size = None):
+        self._table = table
+        self._page_size = page_size or 10000
+        self.total_rows = table.num_rows
+
+    @property
+    def pages(self):
+        for batch in self._table.to_batches(max_chunksize = self._page_size):
+            yield batch.to_pylist()
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
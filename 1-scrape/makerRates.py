@@ -0,0 +1,204 @@
+# Interest adjustment of Maker frob debt amounts (newToken2Amt of mergeRecordsCache), replacing calcCumulativeRates and updateFrobTrx in
+# mkrRateAdjust.js. The cumulative rate of each ilk is computed once for every duty change (makerV2EthRates), with the same integer ray
+# arithmetic as the Jug contract (rpow and rmul, 27 decimals), instead of Decimal calls to a Python process for every row. Each frob is
+# matched to the last duty change of its ilk before its block with a binary search (searchsorted), and the adjusted amounts are written
+# back in bulk
+from datetime import datetime
+from decimal import Decimal, Context
+from timeit import default_timer as timer
+
+import numpy as np
+
+# Fixed-point units of the Maker contracts
+WAD = 10 ** 18
+RAY = 10 ** 27
+# Precision large enough for exact conversions between decimals and units
+_EXACT = Context(prec = 100)
+
+def rpow(x, n, base = RAY):
+    # x ** n in fixed point, rounding each product to the nearest unit (same as rpow in the Jug contract)
+    if (x == 0):
+        return base if n == 0 else 0
+    z = x if n % 2 == 1 else base
+    half = base // 2
+    n //= 2
+    while (n > 0):
+        x = (x * x + half) // base
+        if (n % 2 == 1):
+            z = (z * x + half) // base
+        n //= 2
+    return z
+
+def rmul(x, y):
+    # Product of two rays, rounded toward zero (same as rmul in the Jug contract, for positive values)
+    product = abs(x) * abs(y) // RAY
+    return -product if (x < 0) != (y < 0) else product
+
+def _to_units(value, decimals):
+    # Exact conversion of a decimal amount to an integer number of units (e.g. wei), whatever the number of digits
+    return int(Decimal(value).scaleb(decimals, context = _EXACT))
+
+def _from_units(value, decimals):
+    return Decimal(value).scaleb(-decimals, context = _EXACT)
+
+def _seconds(time):
+    return int((time - datetime(1970, 1, 1)).total_seconds())
+
+class RateCurve:
+    """
+    A class representing the cumulative rate of each Maker ilk, after each duty change
+
+    Attributes
+    ----------
+    ilks (Array)                Ilk types with duty changes
+    _blocks (Dictionary)        Block of each duty change (sorted), by ilk type
+    _times (Dictionary)         Timestamp (seconds) of each duty change, by ilk type
+    _duties (Dictionary)        Duty (ray) set by each duty change, by ilk type
+    _rates (Dictionary)         Cumulative rate (ray) at each duty change, by ilk type
+    _ids (Dictionary)           ID (makerV2EthRates) of each duty change, by ilk type
+
+    Methods
+    -------
+    __init__                    Loads the duty changes of each ilk, and computes the cumulative rates
+    rates                       Returns the cumulative rate (ray) of each ilk at each block and time (None before the first duty change)
+    adjust                      Returns the debt amounts adjusted for the cumulative rate of their ilk (dart * rate)
+    rows                        Returns the ID and cumulative rate of each duty change (to record in makerV2EthRates)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _ilk_query = "SELECT ilkType, firstBlockTime FROM makerV2Ilks"
+    _duty_query = "SELECT id, blockTime, blockNumber, ilkType, newDuty FROM makerV2EthRates ORDER BY ilkType, blockNumber, id"
+
+    def __init__(self, cursor):
+        cursor.execute(self._ilk_query)
+        first_times = {ilk: first_time for ilk, first_time in cursor.fetchall()}
+        cursor.execute(self._duty_query)
+        changes = {}
+        for change_id, time, block, ilk, duty in cursor.fetchall():
+            changes.setdefault(ilk, []).append((change_id, _seconds(time), block, _to_units(duty, 27)))
+
+        self.ilks = list(changes)
+        self._blocks, self._times, self._duties, self._rates, self._ids = {}, {}, {}, {}, {}
+        for ilk, ilk_changes in changes.items():
+            # Before the first duty change, the duty is 1 (no interest) and the rate starts at 1, from the time the ilk was created
+            prev_time = _seconds(first_times[ilk]) if first_times.get(ilk) is not None else ilk_changes[0][1]
+            prev_duty = RAY
+            rate = RAY
+            rates = []
+            for _, time, _, duty in ilk_changes:
+                rate = rmul(rpow(prev_duty, time - prev_time), rate)
+                rates.append(rate)
+                prev_time = time
+                prev_duty = duty
+            self._ids[ilk] = [change[0] for change in ilk_changes]
+            self._times[ilk] = [change[1] for change in ilk_changes]
+            self._blocks[ilk] = np.array([change[2] for change in ilk_changes], dtype = np.int64)
+            self._duties[ilk] = [change[3] for change in ilk_changes]
+            self._rates[ilk] = rates
+
+    def rates(self, ilks, blocks, times):
+        ilks = np.asarray(ilks, dtype = object)
+        blocks = np.asarray(blocks, dtype = np.int64)
+        result = [None] * len(ilks)
+        for ilk in self.ilks:
+            rows = np.nonzero(ilks == ilk)[0]
+            if (len(rows) == 0):
+                continue
+            # Last duty change strictly before the block
+            positions = np.searchsorted(self._blocks[ilk], blocks[rows], side = 'left') - 1
+            change_times = self._times[ilk]
+            duties = self._duties[ilk]
+            rates = self._rates[ilk]
+            for row, position in zip(rows.tolist(), positions.tolist()):
+                if (position >= 0):
+                    result[row] = rmul(rpow(duties[position], _seconds(times[row]) - change_times[position]), rates[position])
+        return result
+
+    def adjust(self, ilks, blocks, times, amounts):
+        adjusted = []
+        for amount, rate in zip(amounts, self.rates(ilks, blocks, times)):
+            if (rate is None or amount is None):
+                adjusted.append(None)
+            else:
+                # Amounts are in DAI with 18 decimals (wad)
+                adjusted.append(_from_units(rmul(_to_units(amount, 18), rate), 18))
+        return adjusted
+
+    def rows(self):
+        return [(change_id, _from_units(rate, 27)) for ilk in self.ilks for change_id, rate in zip(self._ids[ilk], self._rates[ilk])]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.ilks)} ilks)')
+
+class RateAdjustment:
+    """
+    A class that adjusts the debt amounts of Maker frobs in mergeRecordsCache for the cumulative rate, one batch of rows at a time
+
+    Attributes
+    ----------
+    step (Integer)              Number of rows per batch
+    rows_adjusted (Integer)     Number of rows updated so far
+    curve (RateCurve)           Cumulative rates of each ilk
+    _db (Connection)            MySQL connection
+
+    Methods
+    -------
+    __init__                    Sets the connection and options, and computes the cumulative rates
+    run                         Adjusts every frob without an adjusted amount, and writes the amounts back
+    write_rates                 Records the cumulative rate of each duty change in makerV2EthRates
+    _write                      Writes rows in one statement
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    # mergeRecordsCache has the vault ID of each frob (makerV2 doesn't), so adjusted amounts are only recorded there
+    _select_query = """
+        SELECT mrc.id, mrc.blockTime, mrc.blockNumber, mrc.token2Amt, mv.ilkType FROM mergeRecordsCache mrc
+        LEFT JOIN makerVaults mv ON mrc.vaultID = mv.vaultID
+        WHERE mrc.id > %s AND mrc.trxType = 'frob' AND mrc.token2Amt <> 0 AND mrc.newToken2Amt IS NULL
+        ORDER BY mrc.id LIMIT %s
+    """
+
+    def __init__(self, db, step = 50000):
+        self._db = db
+        self.step = step
+        self.rows_adjusted = 0
+        cursor = db.cursor()
+        self.curve = RateCurve(cursor)
+        cursor.close()
+
+    def run(self):
+        # Rows are read by increasing id, so that rows without a rate (left empty) are not read again
+        cursor = self._db.cursor()
+        last_id = 0
+        start = timer()
+        while True:
+            cursor.execute(self._select_query, (last_id, self.step))
+            rows = cursor.fetchall()
+            if (len(rows) == 0):
+                break
+            ids, times, blocks, amounts, ilks = zip(*rows)
+            adjusted = self.curve.adjust(ilks, blocks, times, amounts)
+            values = [(row_id, amount) for row_id, amount in zip(ids, adjusted) if amount is not None]
+            if (len(values) > 0):
+                self._write(cursor, 'mergeRecordsCache', 'newToken2Amt', values)
+            last_id = ids[-1]
+            self.rows_adjusted += len(values)
+            print(f'Adjusted {self.rows_adjusted} frobs (up to id {last_id})')
+        cursor.close()
+        print(f'Adjustment done in {timer() - start:.1f} s')
+
+    def write_rates(self):
+        cursor = self._db.cursor()
+        rows = self.curve.rows()
+        for i in range(0, len(rows), self.step):
+            self._write(cursor, 'makerV2EthRates', 'cumulativeRate', rows[i:i+self.step])
+        cursor.close()
+
+    def _write(self, cursor, table, column, values):
+        # Decimals are passed in fixed-point notation, so that no digits are lost. Rows are matched by id with a join, so ids that are no
+        # longer in the table are skipped, and the other (NOT NULL) columns are left alone
+        rows = ' UNION ALL '.join(['SELECT %s AS id, %s AS value'] + ['SELECT %s, %s'] * (len(values) - 1))
+        query = f"UPDATE {table} t JOIN ({rows}) v ON t.id = v.id SET t.{column} = v.value"
+        cursor.execute(query, [field for row_id, value in values for field in (row_id, format(value, 'f'))])
+        self._db.commit()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.curve.ilks)} ilks)')
@@ -297,6 +297,8 @@ async function updateFrobTrx(inProd) {
     con.close()
 }
 
+// NOTE: cumulative rates and adjusted frob amounts are now computed by makerRates.py (calcCumulativeRates and updateFrobTrx are kept for
+// reference). getFirstTimestamp and gatherRates are still used to collect makerV2Ilks and makerV2EthRates
 var firstBlock = 8928160 // block when Jug contract first created
 
 // getFirstTimestamp(true)
@@ -0,0 +1,189 @@
+# Background writer for decoded rows. Pages of rows are passed through a bounded queue to a separate thread, which writes them to MySQL
+# on its own connection. Writing therefore overlaps with fetching and decoding the next page, and memory is limited to the pages waiting
+# in the queue. How rows are written depends on the sink: InsertSink (below) inserts rows in small batches, BulkLoadSink (bulkLoader.py)
+# loads them in large chunks. With a watermark (watermarks.py), rows are committed one block chunk at a time, together with the watermark.
+# Time spent writing and committing is added to the metrics of the run (runMetrics.py), if given
+import threading, queue
+from timeit import default_timer as timer
+
+from fixedPoint import sql_value
+
+class InsertSink:
+    """
+    A class that inserts rows with the protocol's insert query, in batches
+
+    Attributes
+    ----------
+    insert_query (String)       SQL query used to insert each row
+    step (Integer)              Number of rows per executemany call
+    watermark (Watermark)       Watermark updated at each checkpoint (None if rows are committed as they are inserted)
+    fixed_point (Boolean)       Whether rows have fixed-point amounts (fixedPoint.Wei), passed to MySQL as decimal literals
+    address_book (AddressBook)  Address book of the address IDs in the rows, written as address strings (None if rows hold strings)
+
+    Methods
+    -------
+    __init__                    Sets the insert query
+    open                        Creates the cursor used to insert rows
+    write                       Inserts a page of rows
+    checkpoint                  Commits the rows inserted since the last checkpoint, together with the watermark
+    abort                       Rolls back the rows inserted since the last checkpoint
+    close                       Closes the cursor
+    _value                      Converts a value to a type accepted by the MySQL connector
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, insert_query, step = 100, watermark = None, fixed_point = False, address_book = None):
+        self.insert_query = insert_query
+        self.step = step # Optimal balance between too large queries and too many queries, per testing
+        self.watermark = watermark
+        self.fixed_point = fixed_point
+        self.address_book = address_book
+
+    def open(self, db):
+        self._db = db
+        self._cursor = db.cursor()
+
+    def write(self, rows):
+        # The MySQL connector only converts built-in types, so fixed-point amounts and address IDs are converted here, in the writer thread
+        if (self.fixed_point or self.address_book is not None):
+            rows = [[self._value(value) for value in row] for row in rows]
+        # Do SQL queries in batches. Could do one insert query per page, but MySQL may time out while processing very large query
+        for i in range(0, len(rows), self.step):
+            self._cursor.executemany(self.insert_query, rows[i:i+self.step])
+
+    def checkpoint(self, block):
+        self.watermark.write(self._cursor, block)
+        self._db.commit()
+
+    def abort(self):
+        self._db.rollback()
+        self._cursor.close()
+
+    def close(self):
+        self._cursor.close()
+
+    def _value(self, value):
+        if (self.address_book is not None):
+            value = self.address_book.sql_value(value)
+        return sql_value(value)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.insert_query})')
+
+class PageWriter:
+    """
+    A class that writes pages of rows to MySQL from a background thread
+
+    Attributes
+    ----------
+    sink (Sink)                 Object that writes the rows (InsertSink or BulkLoadSink)
+    rows_written (Integer)      Number of rows written so far
+    elapsed (Float)             Seconds spent writing rows
+    metrics (RunMetrics)        Metrics of the run, with the insert and commit times (None if not recorded)
+    _queue (Queue)              Bounded queue of pages waiting to be written
+    _error (Exception)          Error raised in the writer thread, if any (raised again in the calling thread)
+    _thread (Thread)            Writer thread
+
+    Methods
+    -------
+    __init__                    Starts the writer thread
+    put                         Adds a page of rows to the queue (waits while the queue is full)
+    checkpoint                  Adds a checkpoint to the queue: all rows up to the block are committed once the pages before it are written
+    close                       Waits for all queued pages to be written, stops the thread and reports rows/sec
+    _run                        Writes pages until the queue is closed
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    # Marks the end of the queue
+    _DONE = object()
+
+    def __init__(self, connect, sink, queue_size = 4, metrics = None):
+        self.sink = sink
+        self.rows_written = 0
+        self.elapsed = 0
+        self.metrics = metrics
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._error = None
+
+        # The writer uses its own connection, because MySQL connections can't be shared between threads
+        self._thread = threading.Thread(target = self._run, args = (connect,), daemon = True)
+        self._thread.start()
+
+    def put(self, rows):
+        # If the writer failed, stop here instead of waiting for space in the queue forever
+        while True:
+            if (self._error is not None):
+                raise self._error
+            try:
+                self._queue.put(rows, timeout = 1)
+                return
+            except queue.Full:
+                continue
+
+    def checkpoint(self, block):
+        self.put(_Checkpoint(block))
+
+    def close(self):
+        if (self._thread.is_alive()):
+            self.put(self._DONE)
+            self._thread.join()
+        if (self._error is not None):
+            raise self._error
+        if (self.elapsed > 0):
+            print(f'Wrote {self.rows_written} rows in {self.elapsed:.1f} s ({self.rows_written / self.elapsed:,.0f} rows/s)')
+
+    def _run(self, connect):
+        db = None
+        opened = False
+        # tqdm is only imported once rows are written, so that importing the writer stays fast
+        from tqdm import tqdm
+        progress = tqdm(unit = ' rows written')
+        try:
+            db = connect()
+            start = timer()
+            self.sink.open(db)
+            opened = True
+            self.elapsed += timer() - start
+            while True:
+                rows = self._queue.get()
+                if (rows is self._DONE):
+                    break
+                start = timer()
+                if (isinstance(rows, _Checkpoint)):
+                    self.sink.checkpoint(rows.block)
+                    stage, num_rows = 'commit', 0
+                else:
+                    self.sink.write(rows)
+                    self.rows_written += len(rows)
+                    progress.update(len(rows))
+                    stage, num_rows = 'insert', len(rows)
+                seconds = timer() - start
+                self.elapsed += seconds
+                if (self.metrics is not None):
+                    self.metrics.add(stage, seconds, num_rows)
+            start = timer()
+            opened = False
+            self.sink.close()
+            seconds = timer() - start
+            self.elapsed += seconds
+            # Bulk loads commit (and rebuild indexes) when the sink is closed
+            if (self.metrics is not None):
+                self.metrics.add('commit', seconds)
+        except Exception as error:
+            self._error = error
+            # Rows written since the last commit are rolled back, so that nothing is committed past the last checkpoint
+            if (opened):
+                try:
+                    self.sink.abort()
+                except Exception:
+                    pass
+        finally:
+            progress.close()
+            if (db is not None):
+                db.close()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.sink})')
+
+class _Checkpoint:
+    # Queue entry marking the end of a block chunk
+    def __init__(self, block):
+        self.block = block
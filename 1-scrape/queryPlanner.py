@@ -0,0 +1,119 @@
+# Planning of BigQuery log queries. The logs table is partitioned by block_timestamp, but the queries select a block range. The planner
+# looks up the timestamps of the first and last blocks (once, then from a local cache), so that the query can also be bounded by
+# block_timestamp and BigQuery only scans the partitions of the range. Dry runs report the bytes a query would scan, before it runs. The
+# last existing block of a range (the chain head, if the range goes past it) tells the log cache which blocks a query actually covered.
+# google.cloud.bigquery is imported when it is first used (see logSources.py)
+import os, json, threading
+from datetime import datetime
+
+# Default location of the local cache of block timestamps
+BLOCK_TIMES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'blockTimes.json')
+
+class QueryPlanner:
+    """
+    A class that plans BigQuery log queries: timestamp bounds, query parameters and dry runs
+
+    Attributes
+    ----------
+    cache_path (String)         Location of the local cache of block timestamps (JSON)
+    _client (Client)            Connection to BigQuery
+    _block_times (Dictionary)   Timestamp of each block looked up so far, by block number
+    _lock (Lock)                Lock on the cache, because shard queries are planned from several threads
+
+    Methods
+    -------
+    __init__                    Sets the BigQuery client and loads the cache
+    plan                        Sets the timestamp bounds of a query, and returns the job configuration with its parameters
+    dry_run                     Returns the number of bytes a query would scan, without running it
+    last_existing_block         Returns the last block of a query's range that exists (the head, if the range goes past it)
+    _time_bounds                Returns the timestamps of the first and last blocks of a query
+    _lookup_blocks              Queries the timestamps of blocks not in the cache
+    _load_cache                 Reads the cache from disk
+    _save_cache                 Writes the cache to disk
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _blocks_query = """
+        SELECT number, timestamp
+        FROM `bigquery-public-data.crypto_ethereum.blocks`
+        WHERE number IN UNNEST(@numbers)
+    """
+    _head_query = """
+        SELECT MAX(number) AS number
+        FROM `bigquery-public-data.crypto_ethereum.blocks`
+        WHERE number >= @first_block AND number <= @last_block AND timestamp >= @first_time
+    """
+
+    def __init__(self, client, cache_path = BLOCK_TIMES_PATH):
+        self._client = client
+        self.cache_path = cache_path
+        self._block_times = self._load_cache()
+        self._lock = threading.Lock()
+
+    def plan(self, query):
+        # Shards are copies of a planned query. Their bounds cover the whole range, which still prunes the partitions outside of it, so
+        # they are not looked up again
+        if (query.time_bounds is None):
+            query.time_bounds = self._time_bounds(query.first_block, query.last_block)
+        from google.cloud import bigquery
+        return bigquery.QueryJobConfig(query_parameters = query.parameters())
+
+    def dry_run(self, query):
+        job_config = self.plan(query)
+        job_config.dry_run = True
+        job_config.use_query_cache = False
+        job = self._client.query(query.text(), job_config = job_config)
+        return job.total_bytes_processed
+
+    def last_existing_block(self, query):
+        # The head is not cached, because it moves. It is only looked up when the last block has no timestamp (above the head when it
+        # was looked up), and the first block's timestamp bounds the scan to the partitions of the range
+        first_time, last_time = self._time_bounds(query.first_block, query.last_block)
+        if (last_time is not None):
+            return query.last_block
+        if (first_time is None):
+            return query.first_block - 1
+        from google.cloud import bigquery
+        job_config = bigquery.QueryJobConfig(query_parameters = [
+            bigquery.ScalarQueryParameter('first_block', 'INT64', query.first_block),
+            bigquery.ScalarQueryParameter('last_block', 'INT64', query.last_block),
+            bigquery.ScalarQueryParameter('first_time', 'TIMESTAMP', first_time),
+        ])
+        rows = list(self._client.query(self._head_query, job_config = job_config).result())
+        return rows[0]['number'] if len(rows) > 0 and rows[0]['number'] is not None else query.first_block - 1
+
+    def _time_bounds(self, first_block, last_block):
+        with self._lock:
+            missing = [block for block in [first_block, last_block] if str(block) not in self._block_times]
+            if (len(missing) > 0):
+                self._lookup_blocks(missing)
+
+        # Blocks that don't exist yet (e.g. a last block above the current block) have no timestamp, so that side is not bounded
+        bounds = []
+        for block in [first_block, last_block]:
+            timestamp = self._block_times.get(str(block))
+            bounds.append(datetime.fromisoformat(timestamp) if timestamp is not None else None)
+        return tuple(bounds)
+
+    def _lookup_blocks(self, blocks):
+        from google.cloud import bigquery
+        job_config = bigquery.QueryJobConfig(query_parameters = [bigquery.ArrayQueryParameter('numbers', 'INT64', blocks)])
+        for row in self._client.query(self._blocks_query, job_config = job_config).result():
+            self._block_times[str(row['number'])] = row['timestamp'].isoformat()
+        self._save_cache()
+
+    def _load_cache(self):
+        if (not os.path.exists(self.cache_path)):
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+        # Write to a temporary file first, so that an interrupted run never leaves a partial cache
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._block_times, f)
+        os.replace(temp_path, self.cache_path)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.cache_path})')
@@ -0,0 +1,132 @@
+# Reference data (token, cToken and pair information) used while decoding. Each table is loaded once, indexed by lowercase address, and
+# saved to a local snapshot, so that later runs do not query MySQL again. Nothing is read (snapshot or MySQL) until a table is first needed
+import os, json
+from datetime import datetime, timezone
+
+# Default location of the local snapshot
+SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'refData.json')
+
+class ReferenceRegistry:
+    """
+    A class representing the reference data needed to query and decode records, indexed by address
+
+    Attributes
+    ----------
+    _cursor (Cursor)            MySQL cursor, only used if a table is not found in the snapshot
+    snapshot_path (String)      Location of the local snapshot (JSON)
+    _tables (Dictionary)        Rows of each reference table, by table name (None until the snapshot is read)
+    _indexes (Dictionary)       Rows of each reference table, indexed by lowercase address
+
+    Methods
+    -------
+    __init__                    Sets the cursor and snapshot location. The snapshot and tables are only loaded when first needed
+    addresses                   Returns the list of lowercase addresses to query for a protocol
+    pair                        Returns pairID, token0Decimals and token1Decimals of a Uniswap V2 pair
+    ctoken                      Returns id and decimals of a Compound V2 cToken
+    reserve_decimals            Returns decimals of an Aave V1 reserve (18 if the reserve is not found)
+    refresh                     Queries all loaded tables again from MySQL and updates the snapshot
+    load_all                    Loads every table (before the registry is sent to other processes)
+    _table                      Returns the rows of a table, from the snapshot if possible, otherwise from MySQL
+    _index                      Returns a table indexed by address
+    _load_snapshot              Reads the snapshot from disk
+    _save_snapshot              Writes the snapshot to disk
+    __getstate__                Drops the MySQL cursor when the registry is sent to other processes
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    # Query for each reference table. The address is always the second column (or the only column)
+    _queries = {
+        'exchangeAddrs': "SELECT LOWER(exchangeAddr) FROM tokensWithExchanges",
+        'cTokenAddrs': "SELECT LOWER(cTokenAddr) FROM addrTokens",
+        'pairAddrs': "SELECT LOWER(pairAddr) FROM addrUniPairs",
+        'pairsTokens': "SELECT pairID, LOWER(pairAddr), token0Decimals, token1Decimals FROM pairsTokens",
+        'cTokens': "SELECT id, LOWER(cTokenAddr), decimals FROM addrTokens",
+        'aReserves': "SELECT id, LOWER(aReserveAddr), decimals FROM addrTokens",
+    }
+
+    def __init__(self, cursor, snapshot_path = SNAPSHOT_PATH):
+        self._cursor = cursor
+        self.snapshot_path = snapshot_path
+        self._tables = None
+        self._indexes = {}
+
+    def addresses(self, table_name):
+        return [row[0] for row in self._table(table_name)]
+
+    def pair(self, pair_addr):
+        pair = self._index('pairsTokens')[pair_addr.lower()]
+        return pair[0], pair[2], pair[3]
+
+    def ctoken(self, ctoken_addr):
+        token = self._index('cTokens', first_match = True)[ctoken_addr.lower()]
+        return token[0], token[2]
+
+    def reserve_decimals(self, reserve_addr):
+        if (reserve_addr is None):
+            return 18
+        token = self._index('aReserves').get(reserve_addr.lower())
+        # If corresponding token not found, then just assume 18 decimals. May not always be correct, but will be sufficient to record amounts
+        if (token is None):
+            return 18
+        return token[2]
+
+    def refresh(self):
+        print('Refreshing reference data from SQL database')
+        if (self._tables is None):
+            self._tables = self._load_snapshot()
+        for table_name in list(self._tables.keys()):
+            del self._tables[table_name]
+            self._table(table_name)
+        self._indexes = {}
+
+    def load_all(self):
+        for table_name in self._queries:
+            self._table(table_name)
+
+    def _table(self, table_name):
+        if (self._tables is None):
+            self._tables = self._load_snapshot()
+        if (table_name not in self._tables):
+            self._cursor.execute(self._queries[table_name])
+            self._tables[table_name] = [list(row) for row in self._cursor.fetchall()]
+            self._save_snapshot()
+        return self._tables[table_name]
+
+    def _index(self, table_name, first_match = False):
+        # Duplicate addresses keep the same row the previous linear scans returned: the first match for cTokens (the scan stopped at the
+        # first match), the last match for pairs and reserves (the scan continued to the end of the table)
+        key = (table_name, first_match)
+        if (key not in self._indexes):
+            index = {}
+            for row in self._table(table_name):
+                if (first_match):
+                    index.setdefault(row[1], row)
+                else:
+                    index[row[1]] = row
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def _load_snapshot(self):
+        if (not os.path.exists(self.snapshot_path)):
+            return {}
+        with open(self.snapshot_path) as f:
+            snapshot = json.load(f)
+        print(f'Loaded reference data snapshot from {snapshot["created"]}')
+        return snapshot['tables']
+
+    def _save_snapshot(self):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok = True)
+        snapshot = {'created': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), 'tables': self._tables}
+        # Write to a temporary file first, so that an interrupted run never leaves a partial snapshot
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, self.snapshot_path)
+
+    def __getstate__(self):
+        # Cursors can't be sent to other processes. Tables must therefore be loaded first (see load_all)
+        state = self.__dict__.copy()
+        state['_cursor'] = None
+        return state
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.snapshot_path})')
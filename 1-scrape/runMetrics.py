@@ -0,0 +1,208 @@
+# Metrics of a run of RecordExplorer: time spent in each stage (query wait, page fetch, dedup, decode per handler, insert), number of rows
+# and calls, rows per second, and peak memory of the process. Stages can be timed from several threads (the page writer, shard queries).
+# The report is a JSON file per run, so that runs can be compared without reading the console output. An optional sampling profiler
+# records the call stacks of the decode loop at a fixed interval, and adds the functions where most time is spent to the report
+import os, sys, json, threading, time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+# resource is not available on Windows. Peak memory is then not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Default folder of the JSON reports
+REPORT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'metrics')
+
+class RunMetrics:
+    """
+    A class representing the timers and counters of a run
+
+    Attributes
+    ----------
+    started (Datetime)          Time the metrics were created
+    stages (Dictionary)         Seconds, number of calls and number of rows, by stage name
+    counters (Dictionary)       Other counts (e.g. duplicate logs), by name
+    profiler (SamplingProfiler) Sampling profiler of the decode loop (None if profiling is not enabled)
+    _lock (Lock)                Lock for updates from other threads
+
+    Methods
+    -------
+    __init__                    Creates empty timers and counters
+    add                         Adds time (and rows) to a stage
+    timer                       Times the code in a with block, as a stage
+    count                       Adds to a counter
+    profile                     Samples the call stacks of the code in a with block, if profiling is enabled
+    peak_memory                 Returns the peak resident memory of the process, in bytes (None if unknown)
+    report                      Returns the metrics as a dictionary (JSON)
+    write                       Writes the report to a JSON file
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, profiler = None):
+        self.started = datetime.now(timezone.utc)
+        self.stages = {}
+        self.counters = {}
+        self.profiler = profiler
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, rows = 0):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'rows': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            stage['rows'] += rows
+
+    @contextmanager
+    def timer(self, name, rows = 0):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.add(name, timer() - start, rows)
+
+    def count(self, name, n = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def profile(self):
+        if (self.profiler is None):
+            yield
+            return
+        self.profiler.resume()
+        try:
+            yield
+        finally:
+            self.profiler.pause()
+
+    def peak_memory(self):
+        if (resource is None):
+            return None
+        # ru_maxrss is in kilobytes on Linux, and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def report(self, **run):
+        ended = datetime.now(timezone.utc)
+        with self._lock:
+            stages = {
+                name: {**stage, 'rows_per_sec': stage['rows'] / stage['seconds'] if stage['seconds'] > 0 and stage['rows'] > 0 else None}
+                for name, stage in self.stages.items()
+            }
+            counters = dict(self.counters)
+        report = {
+            'run': {**run, 'started': self.started.isoformat(), 'ended': ended.isoformat(), 'seconds': (ended - self.started).total_seconds()},
+            'peak_memory_bytes': self.peak_memory(),
+            'stages': stages,
+            'counters': counters,
+        }
+        if (self.profiler is not None):
+            report['profile'] = self.profiler.report()
+        return report
+
+    def write(self, path, **run):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        with open(path, 'w') as f:
+            json.dump(self.report(**run), f, indent = 2, default = str)
+        # Full call stacks are written next to the report, in the "folded" format read by flame graph tools
+        if (self.profiler is not None):
+            self.profiler.write_folded(os.path.splitext(path)[0] + '.folded')
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.stages)} stages)')
+
+class SamplingProfiler:
+    """
+    A class that samples the call stack of a thread at a fixed interval, while it is resumed (e.g. during the decode loop)
+
+    Attributes
+    ----------
+    interval (Float)            Seconds between samples
+    samples (Integer)           Number of samples taken
+    _stacks (Counter)           Number of samples of each call stack (outermost call first)
+    _thread_id (Integer)        Thread sampled (the thread that last resumed the profiler)
+    _active (Event)             Set while samples are taken
+    _stopped (Boolean)          Whether the sampling thread should end
+    _thread (Thread)            Sampling thread
+
+    Methods
+    -------
+    __init__                    Starts the sampling thread (paused)
+    resume                      Samples the calling thread until paused
+    pause                       Stops sampling, until resumed
+    stop                        Ends the sampling thread
+    report                      Returns the functions with the most samples (own time, and total time including calls)
+    write_folded                Writes every call stack with its number of samples (folded format)
+    _run                        Takes samples while resumed
+    _frame_name                 Returns the name of a frame (file and function)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = Counter()
+        self._thread_id = None
+        self._active = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def resume(self):
+        self._thread_id = threading.get_ident()
+        self._active.set()
+
+    def pause(self):
+        self._active.clear()
+
+    def stop(self):
+        self._stopped = True
+        self._active.set()
+        self._thread.join()
+
+    def report(self, top = 25):
+        own = Counter()
+        total = Counter()
+        for stack, n in self._stacks.items():
+            own[stack[-1]] += n
+            # A recursive function is only counted once per sample
+            for name in set(stack):
+                total[name] += n
+        share = lambda n: round(n / self.samples, 4) if self.samples > 0 else 0
+        return {
+            'interval': self.interval,
+            'samples': self.samples,
+            'own': [{'function': name, 'samples': n, 'share': share(n)} for name, n in own.most_common(top)],
+            'total': [{'function': name, 'samples': n, 'share': share(n)} for name, n in total.most_common(top)],
+        }
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for stack, n in self._stacks.most_common():
+                f.write(f"{';'.join(stack)} {n}\n")
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            if (self._stopped):
+                return
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while (frame is not None):
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if (len(stack) > 0):
+                self._stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+            del frame
+            time.sleep(self.interval)
+
+    def _frame_name(self, frame):
+        # Lines are left out, so that all samples of a function are added together
+        code = frame.f_code
+        return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.interval} s)')
@@ -0,0 +1,170 @@
+# Sharded execution of a BigQuery query. The block range is split into shards, which are queried concurrently (threads) and decoded in
+# a process pool. Shard sizes adapt to the number of rows per block seen so far, because some records (e.g. Uniswap swaps) are far denser
+# than others (e.g. Maker frobs). Decoded shards are returned in block order, with the last block they cover (used as checkpoints by the
+# incremental mode)
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+from batchDecoder import BatchDecoder
+from dedup import LogDeduplicator
+
+# State of each decoding process, set once when the process starts (see _init_worker)
+_worker = {}
+
+def _init_worker(protocol, record, decode_mode):
+    # IDs are only given by the main process, which owns the address book (utils/addressBook.py): rows decoded here keep their address
+    # strings. The rows written are the same
+    protocol.address_book = None
+    _worker['decoder'] = BatchDecoder(protocol)
+    _worker['record'] = record
+    _worker['decode_mode'] = decode_mode
+
+def _decode_shard(rows):
+    # The decode time is returned with the rows, because the metrics of the run are in the main process
+    decoder = _worker['decoder']
+    start = timer()
+    if (_worker['decode_mode'] == 'batch'):
+        sqlArr = decoder.process_page(rows, _worker['record'], [])
+    else:
+        sqlArr = decoder.process_rows(rows, _worker['record'], [])
+    return sqlArr, timer() - start
+
+class ShardRunner:
+    """
+    A class that queries and decodes a block range in shards
+
+    Attributes
+    ----------
+    first_block (Integer)           First block of the range
+    last_block (Integer)            Last block of the range (included)
+    max_workers (Integer)           Number of concurrent queries, and number of decoding processes
+    target_rows (Integer)           Number of rows each shard should contain
+    initial_blocks (Integer)        Number of blocks in each shard, until the density of rows is known
+    dedup (Boolean)                 Whether duplicate logs are removed before decoding
+    duplicates (Integer)            Number of duplicate logs removed
+    created (Datetime)              Time the first shard query was started
+    ended (Datetime)                Time the last shard query ended
+    total_bytes_processed (Integer) Bytes processed by all shard queries
+    _rows_seen (Integer)            Number of rows returned by completed shard queries
+    _blocks_seen (Integer)          Number of blocks covered by completed shard queries
+
+    Methods
+    -------
+    __init__                        Sets the block range and options
+    pages                           Queries and decodes all shards, and returns decoded rows and last block one shard at a time, in block order
+    _next_shard_size                Returns the number of blocks for the next shard, based on the density of rows seen so far
+    __repr__                        Returns string output of the call by which the object was instantiated
+    """
+    # Shards are never smaller or larger than these values (in blocks)
+    _min_blocks = 100
+    _max_blocks = 500000
+
+    def __init__(self, ex_sources, protocol, record, decode_mode, first_block, last_block, dedup = True, max_workers = 4,
+        target_rows = 200000, initial_blocks = 10000):
+        self._ex_sources = ex_sources
+        self._protocol = protocol
+        self._record = record
+        self._decode_mode = decode_mode
+        self.first_block = first_block
+        self.last_block = last_block
+        self.max_workers = max_workers
+        self.target_rows = target_rows
+        self.initial_blocks = initial_blocks
+        self.dedup = dedup
+        self.duplicates = 0
+
+        self.created = None
+        self.ended = None
+        self.total_bytes_processed = 0
+        self._rows_seen = 0
+        self._blocks_seen = 0
+
+    def pages(self):
+        # Reference data is sent to each decoding process, so it must be fully loaded first
+        self._protocol.registry.load_all()
+        self.created = datetime.now(timezone.utc)
+
+        query_pool = ThreadPoolExecutor(max_workers = self.max_workers)
+        decode_pool = ProcessPoolExecutor(
+            max_workers = self.max_workers, initializer = _init_worker, initargs = (self._protocol, self._record, self._decode_mode)
+        )
+        queries = {}            # running queries: future -> (shard index, first block, last block)
+        decodes = {}            # running decodes: future -> (shard index, number of rows decoded, number of rows, last block)
+        done = {}               # decoded shards waiting for earlier shards: shard index -> (number of rows, rows, last block)
+        next_block = self.first_block
+        next_index = 0          # index of the next shard to create
+        next_yield = 0          # index of the next shard to return
+        last_row = None         # last row returned, to remove duplicate rows across shard boundaries
+        # Decode times are measured in the decoding processes, and added to the metrics of the run here. Query and fetch times are added
+        # by the queries (ExternalSources.execute_shard_query)
+        metrics = self._ex_sources.metrics
+        decode_stage = f'decode/{BatchDecoder(self._protocol).handler_name(self._decode_mode)}'
+
+        try:
+            while (next_block <= self.last_block or queries or decodes or done):
+                # 1. Start new shard queries. Shards waiting to be merged also count, so that memory stays bounded while an early shard
+                # is slow
+                while (next_block <= self.last_block and len(queries) + len(decodes) + len(done) < 2 * self.max_workers):
+                    shard_last = min(next_block + self._next_shard_size() - 1, self.last_block)
+                    query = self._ex_sources.create_shard_query(next_block, shard_last)
+                    future = query_pool.submit(self._ex_sources.execute_shard_query, query)
+                    queries[future] = (next_index, next_block, shard_last)
+                    next_index += 1
+                    next_block = shard_last + 1
+
+                # 2. Return decoded shards in block order
+                if (next_yield in done):
+                    num_rows, sqlArr, shard_last = done.pop(next_yield)
+                    next_yield += 1
+
+                    # Maker logs can be duplicated. Duplicates are only removed when they follow each other, so the first row of a shard
+                    # is compared to the last row of the previous shard, as if all rows had been decoded in one pass
+                    if (self._protocol.name == 'Maker' and last_row is not None and len(sqlArr) > 0 and sqlArr[0] == last_row):
+                        sqlArr = sqlArr[1:]
+                    if (len(sqlArr) > 0):
+                        last_row = sqlArr[len(sqlArr) - 1]
+                    yield num_rows, sqlArr, shard_last
+                    continue
+
+                # 3. Wait for the next query or decode to finish
+                finished, _ = wait(list(queries) + list(decodes), return_when = FIRST_COMPLETED)
+                for future in finished:
+                    if (future in queries):
+                        index, shard_first, shard_last = queries.pop(future)
+                        job, rows = future.result()
+                        num_rows = len(rows)
+                        self.total_bytes_processed += job.total_bytes_processed or 0
+                        self._rows_seen += num_rows
+                        self._blocks_seen += shard_last - shard_first + 1
+                        # A duplicate log is in the same block as the original, so it is always in the same shard. Shard rows are
+                        # ordered by block, so only the keys of the current block are kept
+                        if (self.dedup):
+                            dedup = LogDeduplicator(True)
+                            with metrics.timer('dedup', num_rows):
+                                rows = dedup.filter(rows, self._record)
+                            self.duplicates += dedup.duplicates
+                        decodes[decode_pool.submit(_decode_shard, rows)] = (index, len(rows), num_rows, shard_last)
+                    else:
+                        index, decoded_rows, num_rows, shard_last = decodes.pop(future)
+                        sqlArr, seconds = future.result()
+                        metrics.add(decode_stage, seconds, decoded_rows)
+                        done[index] = (num_rows, sqlArr, shard_last)
+        finally:
+            self.ended = datetime.now(timezone.utc)
+            query_pool.shutdown(wait = False, cancel_futures = True)
+            decode_pool.shutdown(wait = False, cancel_futures = True)
+
+    def _next_shard_size(self):
+        if (self._blocks_seen == 0):
+            return self.initial_blocks
+        # No rows seen yet: grow the shards until rows are found
+        if (self._rows_seen == 0):
+            blocks = 2 * self._blocks_seen
+        else:
+            density = self._rows_seen / self._blocks_seen
+            blocks = int(self.target_rows / density)
+        return max(self._min_blocks, min(blocks, self._max_blocks))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.first_block}, {self.last_block})')
@@ -0,0 +1,248 @@
+# Deterministic generator of synthetic Ethereum logs, for benchmarks of the decoders (benchDecoders.py). Rows have the same columns as
+# crypto_ethereum.logs, and are ABI-encoded like the logs of the real contracts: indexed parameters in the topics, other parameters in
+# 32-byte data words, and Maker LogNote calls (e.g. frob) as dynamic bytes after the offset and length words. Amounts have the decimals of
+# their token (e.g. Uniswap V2 pairs with 6 and 18 decimals), signed amounts are encoded in two's complement, and some amounts are zero.
+# The same seed always gives the same rows, so that the timings of two runs can be compared
+import os, json, random
+from datetime import datetime, timedelta, timezone
+
+from defiEvents import Protocol, Record
+from refRegistry import ReferenceRegistry
+
+# Protocol versions with valid records (Aave V2 has none)
+PROTOCOLS = [('Maker', 1), ('Compound', 1), ('Uniswap', 1), ('Aave', 1), ('Maker', 2), ('Compound', 2), ('Uniswap', 2)]
+
+# Layout of each record: (indexed parameters after the signature, data parameters). Each parameter is a kind of value (see
+# SyntheticLogs._word). Maker LogNote logs encode the call in the data as dynamic bytes: ('note', call arguments)
+LAYOUTS = {
+    ('Maker', 1): {
+        'open': (['user'], ['id']),                             # LogNewCup(address indexed lad, bytes32 cup)
+        'give': (['user', 'id', 'user'], ('note', ['id', 'user'])),
+        'shut': (['user', 'id', 'zero'], ('note', ['id'])),
+        'lock': (['user', 'id', 'wad'], ('note', ['id', 'wad'])),
+        'free': (['user', 'id', 'wad'], ('note', ['id', 'wad'])),
+        'bite': (['user', 'id', 'zero'], ('note', ['id'])),
+        'draw': (['user', 'id', 'wad'], ('note', ['id', 'wad'])),
+        'wipe': (['user', 'id', 'wad'], ('note', ['id', 'wad'])),
+    },
+    ('Compound', 1): {
+        'SupplyReceived': ([], ['user', 'token0', 'amount', 'amount', 'amount']),
+        'SupplyWithdrawn': ([], ['user', 'token0', 'amount', 'amount', 'amount']),
+        'BorrowTaken': ([], ['user', 'token0', 'amount', 'amount', 'amount', 'amount']),
+        'BorrowRepaid': ([], ['user', 'token0', 'amount', 'amount', 'amount']),
+        'BorrowLiquidated': ([], [
+            'user', 'token0', 'amount', 'amount', 'amount', 'amount', 'user', 'token1', 'amount1', 'amount1', 'amount1', 'amount1'
+        ]),
+    },
+    ('Uniswap', 1): {
+        'EthPurchase': (['user', 'amount', 'wad'], []),
+        'TokenPurchase': (['user', 'wad', 'amount'], []),
+        'AddLiquidity': (['user', 'wad', 'amount'], []),
+        'RemoveLiquidity': (['user', 'wad', 'amount'], []),
+    },
+    ('Aave', 1): {
+        'Deposit': (['token0', 'user', 'small'], ['amount', 'time']),
+        'RedeemUnderlying': (['token0', 'user'], ['amount', 'time']),
+        'Borrow': (['token0', 'user', 'small'], ['amount', 'small', 'ray', 'amount', 'amount', 'time']),
+        'Repay': (['token0', 'user', 'user'], ['amount', 'amount', 'amount', 'time']),
+        'OriginationFeeLiquidated': (['token1', 'token0', 'user'], ['amount', 'amount1', 'time']),
+        'LiquidationCall': (['token1', 'token0', 'user'], ['amount', 'amount1', 'amount', 'user', 'small', 'time']),
+    },
+    ('Maker', 2): {
+        'frob2': (['ilk', 'user', 'user'], ('note', ['ilk', 'user', 'user', 'user', 'signed', 'signed'])),
+    },
+    ('Compound', 2): {
+        'Mint': ([], ['user', 'amount', 'ctokens']),
+        'Redeem': ([], ['user', 'amount', 'ctokens']),
+        'Borrow': ([], ['user', 'amount', 'amount', 'amount']),
+        'RepayBorrow': ([], ['user', 'user', 'amount', 'amount', 'amount']),
+        'LiquidateBorrow': ([], ['user', 'user', 'amount', 'ctoken', 'ctokens']),
+    },
+    ('Uniswap', 2): {
+        'Swap': (['user', 'user'], ['in0', 'in1', 'out0', 'out1']),
+    },
+}
+
+# Decimals of the synthetic tokens. Pairs mix tokens with different decimals (e.g. USDC/WETH)
+_TOKEN_DECIMALS = [18, 18, 6, 8, 18, 6, 18, 27]
+_PAIR_DECIMALS = [(6, 18), (18, 6), (8, 18), (18, 18), (18, 8), (6, 6)]
+_ILKS = ['ETH-A', 'ETH-B', 'BAT-A', 'USDC-A', 'WBTC-A', 'LINK-A']
+
+class SyntheticLogs:
+    """
+    A class that generates synthetic log rows for every valid record of every protocol
+
+    Attributes
+    ----------
+    seed (Integer)              Seed of the generator. The same seed always gives the same rows
+    first_block (Integer)       Block of the first row
+    duplicate_rate (Float)      Share of Maker LogNote rows that are repeated (same call logged twice, as in nested calls)
+    registry (ReferenceRegistry)    Synthetic token, cToken and pair information (saved to snapshot_path)
+    _users (Array)              Addresses of the synthetic users
+    _tokens (Array)             Addresses of the synthetic tokens
+
+    Methods
+    -------
+    __init__                    Creates the synthetic addresses and reference data
+    protocols                   Returns a Protocol object for every protocol version with valid records
+    records                     Returns a Record object for every valid record of a protocol
+    rows                        Returns rows of a record (or of several records, mixed in block order, for a RecordSet)
+    _row                        Returns one row of a record
+    _context                    Returns the contract and tokens of a row
+    _word                       Returns the 32-byte word (64 hex characters) of a kind of value
+    _amount                     Returns a random amount with the given number of decimals
+    _note                       Returns the data of a Maker LogNote log (the call, as dynamic bytes)
+    _address                    Returns a random address
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, snapshot_path, seed = 0, first_block = 10000000, duplicate_rate = 0.05):
+        self.seed = seed
+        self.first_block = first_block
+        self.duplicate_rate = duplicate_rate
+        self._random = random.Random(seed)
+        self._users = [self._address() for _ in range(1000)]
+        self._tokens = [self._address() for _ in range(len(_TOKEN_DECIMALS))]
+
+        # Reference data is written as a registry snapshot, so that the protocols load it without a MySQL connection. One token is left
+        # out of the Aave reserves, so that the default of 18 decimals is also used
+        ctokens = [[k + 1, self._address(), decimals] for k, decimals in enumerate(_TOKEN_DECIMALS)]
+        pairs = [[k + 1, self._address(), d0, d1] for k, (d0, d1) in enumerate(_PAIR_DECIMALS)]
+        tables = {
+            'exchangeAddrs': [[self._address()] for _ in range(10)],
+            'cTokenAddrs': [[row[1]] for row in ctokens],
+            'pairAddrs': [[row[1]] for row in pairs],
+            'pairsTokens': pairs,
+            'cTokens': ctokens,
+            'aReserves': [[k + 1, addr, decimals] for k, (addr, decimals) in enumerate(zip(self._tokens[:-1], _TOKEN_DECIMALS))],
+        }
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok = True)
+        with open(snapshot_path, 'w') as f:
+            json.dump({'created': f'synthetic (seed {seed})', 'tables': tables}, f)
+        self.registry = ReferenceRegistry(None, snapshot_path)
+
+    def protocols(self):
+        # The generator stands in for the external sources, which only provide the registry to the protocols
+        return [Protocol(name, version, self) for name, version in PROTOCOLS]
+
+    def records(self, protocol):
+        return [Record(record['name'], protocol) for record in protocol.valid_records]
+
+    def rows(self, protocol, record, n):
+        # Each record has its own sequence of random values, so that its rows don't depend on the rows generated before
+        self._random = random.Random(f'{self.seed}/{protocol.name}{protocol.version}/{record.name}')
+        layouts = LAYOUTS[(protocol.name, protocol.version)]
+        block = self.first_block
+        time = datetime(2020, 5, 1, tzinfo = timezone.utc)
+        rows = []
+        while (len(rows) < n):
+            # A few logs per block, one to three per transaction
+            block += self._random.randint(1, 3)
+            time += timedelta(seconds = 13 * self._random.randint(1, 3))
+            for _ in range(self._random.randint(1, 4)):
+                trx_hash = '0x' + format(self._random.getrandbits(256), '064x')
+                for _ in range(self._random.randint(1, 3)):
+                    item_record = self._random.choice(record.records)
+                    row = self._row(protocol, item_record, layouts[item_record.name], block, time, trx_hash, len(rows))
+                    rows.append(row)
+                    # Some LogNote calls are logged twice, with another log index. The handlers skip the repeated row
+                    if (isinstance(layouts[item_record.name][1], tuple) and self._random.random() < self.duplicate_rate):
+                        rows.append(dict(row, log_index = len(rows)))
+        return rows[:n]
+
+    def _row(self, protocol, record, layout, block, time, trx_hash, log_index):
+        topic_kinds, data_kinds = layout
+        context = self._context(protocol, time)
+
+        # Anonymous LogNote logs have the signature padded to 32 bytes as first topic (stored_method_name). The call in the data has the
+        # 4-byte selector of the function
+        topics = [record.stored_method_name] + ['0x' + self._word(kind, context) for kind in topic_kinds]
+        if (isinstance(data_kinds, tuple)):
+            data = self._note(record.stored_method_name[2:10], [self._word(kind, context) for kind in data_kinds[1]])
+        else:
+            data = '0x' + ''.join([self._word(kind, context) for kind in data_kinds])
+
+        return {
+            'transaction_hash': trx_hash,
+            'log_index': log_index,
+            'address': context['contract'],
+            'topics': topics,
+            'block_timestamp': time,
+            'block_number': block,
+            'data': data,
+        }
+
+    def _context(self, protocol, time):
+        context = {'time': time, 'side': self._random.random() < 0.5}
+        if (protocol.name == 'Uniswap' and protocol.version == 2):
+            context['contract'] = self._random.choice(protocol.addr)
+            _, context['decimals0'], context['decimals1'] = self.registry.pair(context['contract'])
+        elif (protocol.name == 'Compound' and protocol.version == 2):
+            context['contract'] = self._random.choice(protocol.addr)
+            context['decimals0'] = self.registry.ctoken(context['contract'])[1]
+            context['decimals1'] = protocol._cTokenDecimals
+        else:
+            context['contract'] = self._random.choice(protocol.addr) if isinstance(protocol.addr, list) else protocol.addr
+            context['token0'], context['token1'] = self._random.sample(self._tokens, 2)
+            if (protocol.name == 'Aave'):
+                context['decimals0'] = self.registry.reserve_decimals(context['token0'])
+                context['decimals1'] = self.registry.reserve_decimals(context['token1'])
+            else:
+                context['decimals0'] = context['decimals1'] = 18
+        return context
+
+    def _word(self, kind, context):
+        if (kind == 'user'):
+            value = int(self._random.choice(self._users), 16)
+        elif (kind in ['token0', 'token1']):
+            value = int(context[kind], 16)
+        elif (kind == 'ctoken'):
+            value = int(self._random.choice(self.registry.addresses('cTokenAddrs')), 16)
+        elif (kind == 'amount'):
+            value = self._amount(context['decimals0'])
+        elif (kind == 'amount1'):
+            value = self._amount(context['decimals1'])
+        elif (kind == 'wad'):
+            value = self._amount(18)
+        elif (kind == 'ctokens'):
+            value = self._amount(8)
+        elif (kind == 'ray'):
+            value = self._amount(27)
+        elif (kind == 'signed'):
+            # Maker dink and dart: negative when collateral is freed or debt is repaid
+            value = self._amount(18) * self._random.choice([1, -1]) % (1 << 256)
+        elif (kind in ['in0', 'out1']):
+            # A swap pays in one token and out the other
+            value = self._amount(context['decimals0' if kind == 'in0' else 'decimals1']) if context['side'] else 0
+        elif (kind in ['in1', 'out0']):
+            value = 0 if context['side'] else self._amount(context['decimals1' if kind == 'in1' else 'decimals0'])
+        elif (kind == 'id'):
+            value = self._random.randint(1, 30000)
+        elif (kind == 'ilk'):
+            return self._random.choice(_ILKS).encode('ascii').hex().ljust(64, '0')
+        elif (kind == 'small'):
+            value = self._random.randint(0, 2)
+        elif (kind == 'time'):
+            value = int(context['time'].timestamp())
+        else: # zero
+            value = 0
+        return format(value, '064x')
+
+    def _amount(self, decimals):
+        # Amounts from 0.001 to 10 million tokens, with every digit random. Some amounts are zero
+        if (self._random.random() < 0.05):
+            return 0
+        digits = max(1, decimals + self._random.randint(-3, 7))
+        return self._random.randrange(10 ** (digits - 1), 10 ** digits)
+
+    def _note(self, selector, words):
+        # Dynamic bytes: offset and length words, then the call (selector and arguments), padded to a multiple of 32 bytes
+        call = selector + ''.join(words)
+        length = len(call) // 2
+        padding = '0' * (-len(call) % 64)
+        return '0x' + format(32, '064x') + format(length, '064x') + call + padding
+
+    def _address(self):
+        return '0x' + format(self._random.getrandbits(160), '040x')
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(seed {self.seed})')
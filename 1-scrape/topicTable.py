@@ -0,0 +1,65 @@
+# Event topics of every valid record (Protocol.valid_records in defiEvents.py): the keccak-256 hash of each signature, precomputed so that
+# creating a Record does not need web3 (or a hash) at all. Signatures that are not in the table (e.g. a record added to valid_records
+# but not here) are hashed with web3, imported only then. The table can be checked against web3 with: python topicTable.py
+
+# keccak-256 hash of each signature, by signature
+TOPICS = {
+    # Maker V1
+    'LogNewCup(address,bytes32)': '0x89b8893b806db50897c8e2362c71571cfaeb9761ee40727f683f1793cda9df16',
+    'give(bytes32,address)': '0xbaa8529ca16040ce2368358580d7d0c3ea41f57ec325450cba44fbe2674862ed',
+    'shut(bytes32)': '0xb84d2106eec94f3239f300a53a63a5ab2b65ee166ac0ca3a2ca7715a4baea640',
+    'lock(bytes32,uint256)': '0xb3b77a518d238ce7d3231fdebc547c57d2981cbcd82bfe41fc75164539320e76',
+    'free(bytes32,uint256)': '0xa5cd184eca4551d5b42cee3b8f08e82c51812d4085057544bc9540ead1087b3a',
+    'bite(bytes32)': '0x40cc8854a15b32d00c76a5266fb4bbb63a94a897c68eef94602f3f94bf848d84',
+    'draw(bytes32,uint256)': '0x440f19ba839af3015e02ee34a5a45cc29d4f3166b28e4f26b023b8db4910400c',
+    'wipe(bytes32,uint256)': '0x73b381010c44550ac0072d6c901c1fdb2e0360808d7527f4d83160a199e00874',
+    # Maker V2
+    'frob(bytes32,address,address,address,int256,int256)': '0x7608870335497de07dcbe6e81ea8b80ba07e558f715c9dc3370fcf2672212732',
+    # Compound V1
+    'SupplyReceived(address,address,uint256,uint256,uint256)': '0x4ea5606ff36959d6c1a24f693661d800a98dd80c0fb8469a665d2ec7e8313c21',
+    'SupplyWithdrawn(address,address,uint256,uint256,uint256)': '0x56559a17e3aa8ea4b05036eaf31aeaf9fb71fc1b8865b6389647639940bed030',
+    'BorrowTaken(address,address,uint256,uint256,uint256,uint256)': '0x6b69190ebbb96f162b04dc222ef96416f9dca9a415b6dd183c79424501113e18',
+    'BorrowRepaid(address,address,uint256,uint256,uint256)': '0x550e7e464126359c6adc43831f011682856b177df6c49c0af6675dd2a063649d',
+    'BorrowLiquidated(address,address,uint256,uint256,uint256,uint256,address,address,uint256,uint256,uint256,uint256)': '0x0938b1e79e1fd5816573487e5bd6a1e1329ec26f94f401a7b49d4b71d479657a',
+    # Compound V2
+    'Mint(address,uint256,uint256)': '0x4c209b5fc8ad50758f13e2e1088ba56a560dff690a1c6fef26394f4c03821c4f',
+    'Redeem(address,uint256,uint256)': '0xe5b754fb1abb7f01b499791d0b820ae3b6af3424ac1c59768edb53f4ec31a929',
+    'Borrow(address,uint256,uint256,uint256)': '0x13ed6866d4e1ee6da46f845c46d7e54120883d75c5ea9a2dacc1c4ca8984ab80',
+    'RepayBorrow(address,address,uint256,uint256,uint256)': '0x1a2a22cb034d26d1854bdc6666a5b91fe25efbbb5dcad3b0355478d6f5c362a1',
+    'LiquidateBorrow(address,address,uint256,address,uint256)': '0x298637f684da70674f26509b10f07ec2fbc77a335ab1e7d6215a4b2484d8bb52',
+    # Uniswap V1
+    'EthPurchase(address,uint256,uint256)': '0x7f4091b46c33e918a0f3aa42307641d17bb67029427a5369e54b353984238705',
+    'TokenPurchase(address,uint256,uint256)': '0xcd60aa75dea3072fbc07ae6d7d856b5dc5f4eee88854f5b4abf7b680ef8bc50f',
+    'AddLiquidity(address,uint256,uint256)': '0x06239653922ac7bea6aa2b19dc486b9361821d37712eb796adfd38d81de278ca',
+    'RemoveLiquidity(address,uint256,uint256)': '0x0fbf06c058b90cb038a618f8c2acbf6145f8b3570fd1fa56abb8f0f3f05b36e8',
+    # Uniswap V2
+    'Swap(address,uint256,uint256,uint256,uint256,address)': '0xd78ad95fa46c994b6551d0da85fc275fe613ce37657fb8d5e3d130840159d822',
+    # Aave V1
+    'Deposit(address,address,uint256,uint16,uint256)': '0xc12c57b1c73a2c3a2ea4613e9476abb3d8d146857aab7329e24243fb59710c82',
+    'RedeemUnderlying(address,address,uint256,uint256)': '0x9c4ed599cd8555b9c1e8cd7643240d7d71eb76b792948c49fcb4d411f7b6b3c6',
+    'Borrow(address,address,uint256,uint256,uint256,uint256,uint256,uint16,uint256)': '0x1e77446728e5558aa1b7e81e0cdab9cc1b075ba893b740600c76a315c2caa553',
+    'Repay(address,address,address,uint256,uint256,uint256,uint256)': '0xb718f0b14f03d8c3adf35b15e3da52421b042ac879e5a689011a8b1e0036773d',
+    'OriginationFeeLiquidated(address,address,address,uint256,uint256,uint256)': '0x36ca8b16d61dc13b1062adff83e3778ab92d14f9e35bfe9fd1283e02b13fb0a1',
+    'LiquidationCall(address,address,address,uint256,uint256,uint256,address,bool,uint256)': '0x56864757fd5b1fc9f38f5f3a981cd8ae512ce41b902cf73fc506ee369c6bc237',
+}
+
+def _keccak(signature):
+    from web3 import Web3
+    return Web3.toHex(Web3.keccak(text = signature))
+
+def topic_hash(signature):
+    topic = TOPICS.get(signature)
+    if (topic is None):
+        topic = _keccak(signature)
+        TOPICS[signature] = topic
+    return topic
+
+def main():
+    mismatches = [signature for signature, topic in TOPICS.items() if _keccak(signature) != topic]
+    for signature in mismatches:
+        print(f'Wrong topic for {signature}: {TOPICS[signature]} instead of {_keccak(signature)}')
+    print(f'{len(TOPICS) - len(mismatches)} of {len(TOPICS)} topics match')
+    return 1 if len(mismatches) > 0 else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,154 @@
+# USD valuation of token amounts (token1Usd and token2Usd of mergeRecordsCache), replacing getRecentPrice in usdValues.js. The hourly
+# prices of priceData are held in one sorted array per token symbol, and each amount is valued at the most recent price before its block
+# time, found with a binary search (searchsorted) for a whole batch at once. Values are written back in bulk, one statement per batch
+from timeit import default_timer as timer
+
+import numpy as np
+
+class PriceIndex:
+    """
+    A class representing the price series of each token, for as-of lookups
+
+    Attributes
+    ----------
+    symbols (Array)             Token symbols with prices
+    _times (Dictionary)         Sorted price times (datetime64) of each token symbol
+    _prices (Dictionary)        Prices in USD, in the same order as the times, of each token symbol
+
+    Methods
+    -------
+    __init__                    Loads the prices of priceData into one sorted series per token symbol
+    prices                      Returns the most recent price before each time (NaN if there is none)
+    values                      Returns the USD value of each amount, at the most recent price before its time
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _price_query = "SELECT tokenSymbol, time, priceInUsd FROM priceData ORDER BY tokenSymbol, time, id"
+
+    def __init__(self, cursor):
+        cursor.execute(self._price_query)
+        series = {}
+        for symbol, time, price in cursor.fetchall():
+            series.setdefault(symbol, ([], []))
+            times, prices = series[symbol]
+            # Same as usdValues.js: when several prices have the same time, the first one is used
+            if (len(times) > 0 and times[-1] == time):
+                continue
+            times.append(time)
+            prices.append(price)
+
+        self.symbols = list(series)
+        self._times = {symbol: np.array(times, dtype = 'datetime64[s]') for symbol, (times, _) in series.items()}
+        self._prices = {symbol: np.array(prices, dtype = np.float64) for symbol, (_, prices) in series.items()}
+
+    def prices(self, symbols, times):
+        symbols = np.asarray(symbols, dtype = object)
+        times = np.asarray(times, dtype = 'datetime64[s]')
+        result = np.full(len(symbols), np.nan)
+        for symbol in self.symbols:
+            rows = np.nonzero(symbols == symbol)[0]
+            if (len(rows) == 0):
+                continue
+            # Most recent price strictly before the time: the position left of the first price at or after it
+            positions = np.searchsorted(self._times[symbol], times[rows], side = 'left') - 1
+            found = positions >= 0
+            result[rows[found]] = self._prices[symbol][positions[found]]
+        return result
+
+    def values(self, symbols, amounts, times):
+        # Amounts of 0 are worth 0 even without a price. Amounts without a symbol or a price have no value (None). This is where exact
+        # amounts (Decimal, or fixed-point fixedPoint.Wei) are converted to floats
+        amounts = np.array([np.nan if amount is None else float(amount) for amount in amounts], dtype = np.float64)
+        values = amounts * self.prices(symbols, times)
+        values[amounts == 0] = 0
+        return [None if np.isnan(value) else float(value) for value in values]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.symbols)} symbols)')
+
+class UsdValuation:
+    """
+    A class that fills the missing USD values of mergeRecordsCache, one batch of rows at a time
+
+    Attributes
+    ----------
+    step (Integer)              Number of rows per batch
+    frob_only (Boolean)         Whether only the DAI amounts of Maker frobs are valued (token2Usd, same as updateFrobValues in usdValues.js)
+    rows_valued (Integer)       Number of rows updated so far
+    _db (Connection)            MySQL connection
+    _index (PriceIndex)         Prices of each token
+
+    Methods
+    -------
+    __init__                    Sets the connection and options, and loads the prices
+    run                         Values every row with a missing USD value, and writes the values back
+    value_rows                  Returns the USD values of a batch of rows (id, block time, amounts and symbols)
+    _write                      Writes the values of a batch in one statement
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _select_query = """
+        SELECT id, blockTime, token1Amt, token1Symbol, token1Usd, token2Amt, token2Symbol, token2Usd FROM mergeRecordsCache
+        WHERE id > %s AND ({missing})
+        ORDER BY id LIMIT %s
+    """
+    # Values are only written where they were missing, so that existing values are never replaced. The batch is joined to the table as a
+    # derived table, so that only existing rows are updated (an INSERT would add rows deleted in the meantime, and fail in strict mode)
+    _update_query = """
+        UPDATE mergeRecordsCache m JOIN ({values}) v ON m.id = v.id
+        SET m.token1Usd = IFNULL(m.token1Usd, v.token1Usd), m.token2Usd = IFNULL(m.token2Usd, v.token2Usd)
+    """
+
+    def __init__(self, db, step = 10000, frob_only = False):
+        self._db = db
+        self.step = step
+        self.frob_only = frob_only
+        self.rows_valued = 0
+        cursor = db.cursor()
+        self._index = PriceIndex(cursor)
+        cursor.close()
+
+    def run(self):
+        if (self.frob_only):
+            missing = "token2Usd IS NULL AND trxType = 'frob' AND token2Amt <> 0"
+        else:
+            missing = "(token1Symbol IS NOT NULL AND token1Usd IS NULL) OR (token2Symbol IS NOT NULL AND token2Usd IS NULL)"
+        query = self._select_query.format(missing = missing)
+
+        # Rows are read by increasing id, so that rows without a price (left empty) are not read again
+        cursor = self._db.cursor()
+        last_id = 0
+        start = timer()
+        while True:
+            cursor.execute(query, (last_id, self.step))
+            rows = cursor.fetchall()
+            if (len(rows) == 0):
+                break
+            self._write(cursor, self.value_rows(rows))
+            last_id = rows[-1][0]
+            self.rows_valued += len(rows)
+            print(f'Valued {self.rows_valued} rows (up to id {last_id})')
+        cursor.close()
+        print(f'Valuation done in {timer() - start:.1f} s')
+
+    def value_rows(self, rows):
+        ids, times, token1Amts, token1Symbols, token1Usds, token2Amts, token2Symbols, token2Usds = zip(*rows)
+        token2Values = self._index.values(token2Symbols, token2Amts, times)
+        if (self.frob_only):
+            token1Values = [None] * len(rows)
+        else:
+            token1Values = self._index.values(token1Symbols, token1Amts, times)
+
+        # Only missing values are set (None otherwise)
+        values = []
+        for i in range(len(rows)):
+            token1Usd = token1Values[i] if (token1Symbols[i] is not None and token1Usds[i] is None) else None
+            token2Usd = token2Values[i] if (token2Symbols[i] is not None and token2Usds[i] is None) or self.frob_only else None
+            values.append((ids[i], token1Usd, token2Usd))
+        return values
+
+    def _write(self, cursor, values):
+        placeholders = ' UNION ALL '.join(['SELECT %s AS id, %s AS token1Usd, %s AS token2Usd'] + ['SELECT %s, %s, %s'] * (len(values) - 1))
+        cursor.execute(self._update_query.format(values = placeholders), [value for row in values for value in row])
+        self._db.commit()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({"frob" if self.frob_only else "all"})')
@@ -9,6 +9,9 @@ const tools = require('../utils/eventLib.js')
 // updateValues(true)
 updateFrobAllValues(true)
 
+// NOTE: USD values of mergeRecordsCache are now filled by usdValuation.py (same prices, with an as-of binary search and bulk updates).
+// getValues is still used to collect priceData
+
 /**
   * Get the most recent price for a particular record
   * @param  {Array} priceTable - Array of dictionaries from SQL, with price values for each currency at specific time intervals
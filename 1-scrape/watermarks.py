@@ -0,0 +1,58 @@
+# Block watermarks for incremental ingestion. For each protocol, version and record, the watermark is the last block whose rows are fully
+# committed to SQL. It is updated in the same transaction as the rows of each block chunk, so that an interrupted run can resume right
+# after the watermark, without duplicate or missing rows
+from datetime import datetime, timezone
+
+class Watermark:
+    """
+    A class representing the block watermark of one record
+
+    Attributes
+    ----------
+    protocol_name (String)      Name of the protocol
+    version (Integer)           Version of the protocol
+    record_name (String)        Name of the record
+    _cursor (Cursor)            MySQL cursor, used to create the table and read the watermark
+
+    Methods
+    -------
+    __init__                    Sets the record, and creates the watermark table if needed
+    read                        Returns the last committed block (None if the record was never ingested incrementally)
+    write                       Sets the last committed block. Must run in the same transaction as the rows of the block chunk
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _create_query = """
+        CREATE TABLE IF NOT EXISTS ingestWatermarks (
+            protocol VARCHAR(20) NOT NULL,
+            version INT NOT NULL,
+            record VARCHAR(100) NOT NULL,
+            lastBlock INT NOT NULL,
+            updated DATETIME NOT NULL,
+            PRIMARY KEY (protocol, version, record)
+        )
+    """
+
+    def __init__(self, cursor, protocol, record):
+        self.protocol_name = protocol.name
+        self.version = protocol.version
+        self.record_name = record.name
+        self._cursor = cursor
+        self._cursor.execute(self._create_query)
+
+    def read(self):
+        read_query = "SELECT lastBlock FROM ingestWatermarks WHERE protocol = %s AND version = %s AND record = %s"
+        self._cursor.execute(read_query, (self.protocol_name, self.version, self.record_name))
+        rows = self._cursor.fetchall()
+        if (len(rows) == 0):
+            return None
+        return rows[0][0]
+
+    def write(self, cursor, block):
+        write_query = """
+            INSERT INTO ingestWatermarks (protocol, version, record, lastBlock, updated) VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE lastBlock = VALUES(lastBlock), updated = VALUES(updated)
+        """
+        cursor.execute(write_query, (self.protocol_name, self.version, self.record_name, block, datetime.now(timezone.utc).replace(tzinfo = None)))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.protocol_name}, {self.version}, {self.record_name})')
@@ -0,0 +1,179 @@
+# Grouping of addresses that belong to the same user. Addresses are linked through Maker vaults (owner, DSProxy and UrnHandler addresses),
+# and every address seen in a protocol is added as its own group if it has no link. Groups are built with a disjoint-set (union-find)
+# structure, so that adding a link costs near-constant time, and a link that bridges two existing groups merges both of them. Addresses are
+# integer IDs of the address book (utils/addressBook.py), so the index of each address is an array lookup instead of a dictionary of strings
+import numpy as np
+
+class DisjointSet:
+    """
+    A disjoint-set structure over integer elements, with path compression and union by rank
+
+    Attributes
+    ----------
+    parent (Array)          Parent of each element (an element is the root of its set if it is its own parent)
+    rank (Array)            Upper bound on the height of each root's tree
+
+    Methods
+    -------
+    __init__                Creates an empty structure
+    add                     Adds a new element in its own set, and returns its index
+    extend                  Adds a number of new elements, each in its own set
+    find                    Returns the root of an element's set, compressing the path to the root
+    union                   Merges the sets of two elements
+    __len__                 Returns the number of elements
+    __repr__                Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self):
+        self.parent = []
+        self.rank = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        self.rank.append(0)
+        return len(self.parent) - 1
+
+    def extend(self, n):
+        start = len(self.parent)
+        self.parent.extend(range(start, start + n))
+        self.rank.extend([0] * n)
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # Path compression: point every element on the path directly to the root
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, x, y):
+        x_root = self.find(x)
+        y_root = self.find(y)
+        if (x_root == y_root):
+            return x_root
+
+        # Union by rank: attach the shorter tree below the taller one
+        if (self.rank[x_root] < self.rank[y_root]):
+            x_root, y_root = y_root, x_root
+        self.parent[y_root] = x_root
+        if (self.rank[x_root] == self.rank[y_root]):
+            self.rank[x_root] += 1
+        return x_root
+
+    def __len__(self):
+        return len(self.parent)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
+
+class AddressGrouper:
+    """
+    A class that groups addresses (address IDs) linked to the same user
+
+    Attributes
+    ----------
+    _sets (DisjointSet)     Disjoint sets over address indexes
+    _index (Array)          Index of each address ID (-1 if not added), in the order in which addresses were first added
+    _addrs (Array)          Address ID of each index
+
+    Methods
+    -------
+    __init__                Creates an empty grouping
+    add_links               Adds rows of linked address IDs (e.g. the owner, proxy and UrnHandler of a Maker vault). Missing addresses
+                            (negative IDs, NO_ADDRESS) are skipped
+    add_addresses           Adds address IDs, each in its own group unless it was already linked
+    group_ids               Returns the group ID of every address ID
+    group_id_array          Returns the group ID of every address index, as an array
+    address_indexes         Returns the index of each address ID, as an array
+    groups                  Returns the list of groups (sets of address IDs), ordered by group ID
+    addresses               Returns the set of all address IDs
+    _add_all                Returns the index of each address ID (-1 for missing addresses), adding new addresses in the order in which
+                            they first appear
+    __len__                 Returns the number of addresses
+    __repr__                Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self):
+        self._sets = DisjointSet()
+        self._index = np.empty(0, dtype = np.int64)
+        self._addrs = np.empty(0, dtype = np.int64)
+
+    def add_links(self, rows):
+        # Rows can be an array (rows x addresses) or any iterable of rows of the same length
+        rows = np.asarray(rows if isinstance(rows, np.ndarray) else list(rows), dtype = np.int64)
+        if (rows.size == 0):
+            return
+        indexes = self._add_all(rows.ravel()).reshape(rows.shape)
+        for row in indexes.tolist():
+            first = None
+            for x in row:
+                if x < 0:
+                    continue
+                if first is None:
+                    first = x
+                else:
+                    self._sets.union(first, x)
+
+    def add_addresses(self, addrs):
+        self._add_all(addrs)
+
+    def group_ids(self):
+        return dict(zip(self._addrs.tolist(), self.group_id_array().tolist()))
+
+    def group_id_array(self):
+        # Group IDs are stable: groups are numbered in the order of their first-added address, so the same inputs (in the same order)
+        # always give the same IDs, whatever order the unions happened in
+        root_to_id = {}
+        ids = np.empty(len(self._addrs), dtype = np.int64)
+        for x in range(len(self._addrs)):
+            root = self._sets.find(x)
+            if root not in root_to_id:
+                root_to_id[root] = len(root_to_id)
+            ids[x] = root_to_id[root]
+        return ids
+
+    def address_indexes(self, addrs):
+        addrs = np.asarray(addrs, dtype = np.int64)
+        if (len(addrs) > 0 and (addrs.min() < 0 or addrs.max() >= len(self._index) or (self._index[addrs] < 0).any())):
+            raise ValueError('Address IDs were not added to the grouper')
+        return self._index[addrs]
+
+    def groups(self):
+        groups = []
+        for addr, group_id in self.group_ids().items():
+            if group_id == len(groups):
+                groups.append(set())
+            groups[group_id].add(addr)
+        return groups
+
+    def addresses(self):
+        return set(self._addrs.tolist())
+
+    def _add_all(self, addrs):
+        addrs = np.asarray(addrs, dtype = np.int64)
+        present = addrs >= 0
+        if (present.any()):
+            # The index array grows to the largest address ID (IDs are dense, so it stays close to the number of addresses)
+            size = int(addrs.max()) + 1
+            if (size > len(self._index)):
+                grown = np.full(max(size, 2 * len(self._index)), -1, dtype = np.int64)
+                grown[:len(self._index)] = self._index
+                self._index = grown
+
+            # New addresses get the next indexes, in the order in which they first appear (as when adding addresses one at a time)
+            uniques, first = np.unique(addrs[present], return_index = True)
+            new = uniques[np.argsort(first)]
+            new = new[self._index[new] < 0]
+            self._index[new] = np.arange(len(self._addrs), len(self._addrs) + len(new))
+            self._addrs = np.concatenate([self._addrs, new])
+            self._sets.extend(len(new))
+
+        indexes = np.full(len(addrs), -1, dtype = np.int64)
+        indexes[present] = self._index[addrs[present]]
+        return indexes
+
+    def __len__(self):
+        return len(self._addrs)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
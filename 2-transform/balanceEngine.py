@@ -0,0 +1,359 @@
+# Balance engine for the debt-financed collateral algorithm (step 3 of algo.ipynb). For each address group, the transactions are replayed in
+# block order, tracking for each token the debt-financed and free balances held in the wallet and locked as collateral in each protocol.
+# Balances are kept in __slots__ records, so that the hundreds of attribute updates per transaction don't go through per-instance dicts.
+# The rows produced are the same as the algoResults2 rows of the original notebook loop
+
+# Position of each column in a transaction row (same order as the mergeRecordsCache table)
+TRX_ID = 0
+BLOCK_TIME = 1
+TOKEN1_AMT = 6
+TOKEN1_SYMBOL = 7
+TOKEN1_USD = 8
+TOKEN2_AMT = 9
+TOKEN2_SYMBOL = 10
+TOKEN2_USD = 11
+PROTOCOL = 12
+TRX_TYPE = 13
+
+class TokenBalance:
+    """
+    A class representing the balances of one token for one address group
+
+    Attributes
+    ----------
+    wallet_free (Number)                Free balance in the wallet
+    wallet_debt (Number)                Debt-financed balance in the wallet
+    maker_withdraw_debt (Number)        Debt withdrawn from Maker (always negative, same for other protocols)
+    maker_debt_collat (Number)          Debt-financed collateral locked in Maker
+    maker_free_collat (Number)          Free collateral locked in Maker
+    compound_withdraw_debt (Number)     Debt withdrawn from Compound
+    compound_debt_collat (Number)       Debt-financed collateral locked in Compound
+    compound_free_collat (Number)       Free collateral locked in Compound
+    aave_withdraw_debt (Number)         Debt withdrawn from Aave
+    aave_debt_collat (Number)           Debt-financed collateral locked in Aave
+    aave_free_collat (Number)           Free collateral locked in Aave
+
+    Methods
+    -------
+    __init__                            Sets all balances to 0
+    __repr__                            Returns string output of the call by which the object was instantiated
+    """
+    __slots__ = (
+        'wallet_free', 'wallet_debt',
+        'maker_withdraw_debt', 'maker_debt_collat', 'maker_free_collat',
+        'compound_withdraw_debt', 'compound_debt_collat', 'compound_free_collat',
+        'aave_withdraw_debt', 'aave_debt_collat', 'aave_free_collat',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
+
+class TokenTotals:
+    """
+    A class representing the cumulative collateral locked in each protocol for one token, across all address groups
+
+    Attributes
+    ----------
+    sum_maker_debt_lock (Number)            Cumulative debt-financed collateral locked in Maker
+    sum_maker_free_lock (Number)            Cumulative free collateral locked in Maker
+    sum_maker_debt_lock_usd (Number)        Same as sum_maker_debt_lock, in USD
+    sum_maker_free_lock_usd (Number)        Same as sum_maker_free_lock, in USD
+    (same for compound and aave)
+
+    Methods
+    -------
+    __init__                                Sets all totals to 0
+    add                                     Adds the totals of another object (e.g. from another worker)
+    __repr__                                Returns string output of the call by which the object was instantiated
+    """
+    __slots__ = (
+        'sum_maker_debt_lock', 'sum_maker_free_lock', 'sum_maker_debt_lock_usd', 'sum_maker_free_lock_usd',
+        'sum_compound_debt_lock', 'sum_compound_free_lock', 'sum_compound_debt_lock_usd', 'sum_compound_free_lock_usd',
+        'sum_aave_debt_lock', 'sum_aave_free_lock', 'sum_aave_debt_lock_usd', 'sum_aave_free_lock_usd',
+    )
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
+
+class BalanceEngine:
+    """
+    A class that runs the debt-financed collateral algorithm, one address group at a time
+
+    Attributes
+    ----------
+    sum_tokens (Dictionary)     Cumulative totals (TokenTotals) across all groups processed, by token symbol
+    group_totals (Dictionary)   Part of the totals from the last group processed, by token symbol
+    trace (Boolean)             Whether each transaction and the group balances are printed (phase 1a of the notebook)
+
+    Methods
+    -------
+    __init__                    Creates empty totals
+    process_group               Replays the transactions of a group, and returns its algoResults2 rows (its part of the totals is kept
+                                in group_totals)
+    _print_transaction          Prints a transaction (trace mode)
+    _print_balances             Prints the balances of a group (trace mode)
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, trace = False):
+        self.sum_tokens = {}
+        self.group_totals = {}
+        self.trace = trace
+
+    def process_group(self, group_id, transactions, group_tokens = None):
+        # Balances start at 0 for every group, unless the state of a previous run is given
+        if (group_tokens is None):
+            group_tokens = {}
+        sum_tokens = self.sum_tokens
+        # The group's part of the totals is also kept apart, so that it can be stored with its balances (stateSnapshot.py). The totals of
+        # all groups are still added in transaction order, so they are the same as in the original loop
+        group_sums = {}
+        rows = []
+
+        for transac in transactions:
+            token1Amt = transac[TOKEN1_AMT]
+            token1Symbol = transac[TOKEN1_SYMBOL]
+            token1Usd = transac[TOKEN1_USD]
+            token2Amt = transac[TOKEN2_AMT]
+            token2Symbol = transac[TOKEN2_SYMBOL]
+            protocol = transac[PROTOCOL]
+            trxType = transac[TRX_TYPE]
+
+            lockTransac = False
+
+            # Create balances for token, if none
+            if (token1Symbol is not None):
+                if (token1Symbol not in group_tokens):
+                    group_tokens[token1Symbol] = TokenBalance()
+                if (token1Symbol not in sum_tokens):
+                    sum_tokens[token1Symbol] = TokenTotals()
+            if (token2Symbol is not None):
+                if (token2Symbol not in group_tokens):
+                    group_tokens[token2Symbol] = TokenBalance()
+                if (token2Symbol not in sum_tokens):
+                    sum_tokens[token2Symbol] = TokenTotals()
+
+            if (protocol == 'Uniswap' or protocol == 'Maker'):
+                # Uniswap
+                if (trxType == 'Swap'):
+                    # Amounts are from perspective of sender. Therefore, reverse balances to get perspective of receiver
+                    # Start with the amount getting sent (originally positive), because that determines whether any debt is exchanged
+                    if (token1Amt >= token2Amt):
+                        sentAmt, sent = token1Amt, group_tokens[token1Symbol]
+                        receivedAmt, received = token2Amt, group_tokens[token2Symbol]
+                    else:
+                        sentAmt, sent = token2Amt, group_tokens[token2Symbol]
+                        receivedAmt, received = token1Amt, group_tokens[token1Symbol]
+
+                    sentDebtAmt = min(sent.wallet_debt, sentAmt)
+                    sentFreeAmt = max(0, sentAmt - sentDebtAmt)
+                    debtPct = 0 if sentAmt == 0 else sentDebtAmt / sentAmt
+                    receivedDebtAmt = debtPct * receivedAmt
+                    receivedFreeAmt = (1 - debtPct) * receivedAmt
+
+                    sent.wallet_debt = max(0, sent.wallet_debt - sentDebtAmt)
+                    sent.wallet_free = max(0, sent.wallet_free - sentFreeAmt)
+
+                    # receivedAmt is originally negative (from perspective of sender), so subtracting receivedDebtAmt and receivedFreeAmt
+                    # is actually adding those balances
+                    received.wallet_debt = max(0, received.wallet_debt - receivedDebtAmt)
+                    received.wallet_free = max(0, received.wallet_free - receivedFreeAmt)
+
+                # Maker
+                elif (trxType == 'frob'):
+                    # Subtract token1 (dink = collateral), add token2 (dart = debt) to wallet balance
+                    # Reverse amounts for Maker balance
+                    token1 = group_tokens[token1Symbol]
+                    if (token1Amt > 0):
+                        lockTransac = True
+                        debtAmt = min(token1.wallet_debt, token1Amt)
+                        freeAmt = max(0, token1Amt - debtAmt)
+                        debtPct = debtAmt / token1Amt
+                        debtAmtUsd = token1Usd * debtPct
+                        freeAmtUsd = token1Usd * (1 - debtPct)
+
+                        token1.wallet_debt = max(0, token1.wallet_debt - debtAmt)
+                        token1.wallet_free = max(0, token1.wallet_free - freeAmt)
+                        token1.maker_debt_collat += debtAmt
+                        token1.maker_free_collat += freeAmt
+
+                        totals = sum_tokens[token1Symbol]
+                        totals.sum_maker_debt_lock += debtAmt
+                        totals.sum_maker_free_lock += freeAmt
+                        totals.sum_maker_debt_lock_usd += debtAmtUsd
+                        totals.sum_maker_free_lock_usd += freeAmtUsd
+                        part = group_sums.get(token1Symbol)
+                        if (part is None):
+                            part = group_sums[token1Symbol] = TokenTotals()
+                        part.sum_maker_debt_lock += debtAmt
+                        part.sum_maker_free_lock += freeAmt
+                        part.sum_maker_debt_lock_usd += debtAmtUsd
+                        part.sum_maker_free_lock_usd += freeAmtUsd
+                    else:
+                        debtAmt = min(token1.maker_debt_collat, -token1Amt)
+                        freeAmt = max(0, -token1Amt - debtAmt)
+
+                        token1.maker_debt_collat = max(0, token1.maker_debt_collat - debtAmt)
+                        token1.maker_free_collat = max(0, token1.maker_free_collat - freeAmt)
+                        token1.wallet_debt += debtAmt
+                        token1.wallet_free += freeAmt
+
+                    # Same debt calculations for withdraw/repay
+                    token2 = group_tokens[token2Symbol]
+                    token2.wallet_debt = max(0, token2.wallet_debt + token2Amt)
+                    token2.maker_withdraw_debt = min(0, token2.maker_withdraw_debt - token2Amt)
+
+            elif (protocol == 'Compound' or protocol == 'Aave'):
+                if (trxType == 'Mint' or trxType == 'Deposit'):
+                    lockTransac = True
+                    token1 = group_tokens[token1Symbol]
+
+                    debtAmt = min(token1.wallet_debt, token1Amt)
+                    freeAmt = max(0, token1Amt - debtAmt)
+                    debtPct = 0 if token1Amt == 0 else debtAmt / token1Amt
+                    debtAmtUsd = token1Usd * debtPct
+                    freeAmtUsd = token1Usd * (1 - debtPct)
+
+                    token1.wallet_debt = max(0, token1.wallet_debt - debtAmt)
+                    token1.wallet_free = max(0, token1.wallet_free - freeAmt)
+
+                    totals = sum_tokens[token1Symbol]
+                    part = group_sums.get(token1Symbol)
+                    if (part is None):
+                        part = group_sums[token1Symbol] = TokenTotals()
+                    if (protocol == 'Compound'):
+                        token1.compound_debt_collat += debtAmt
+                        token1.compound_free_collat += freeAmt
+
+                        totals.sum_compound_debt_lock += debtAmt
+                        totals.sum_compound_free_lock += freeAmt
+                        totals.sum_compound_debt_lock_usd += debtAmtUsd
+                        totals.sum_compound_free_lock_usd += freeAmtUsd
+                        part.sum_compound_debt_lock += debtAmt
+                        part.sum_compound_free_lock += freeAmt
+                        part.sum_compound_debt_lock_usd += debtAmtUsd
+                        part.sum_compound_free_lock_usd += freeAmtUsd
+                    else:
+                        token1.aave_debt_collat += debtAmt
+                        token1.aave_free_collat += freeAmt
+
+                        totals.sum_aave_debt_lock += debtAmt
+                        totals.sum_aave_free_lock += freeAmt
+                        totals.sum_aave_debt_lock_usd += debtAmtUsd
+                        totals.sum_aave_free_lock_usd += freeAmtUsd
+                        part.sum_aave_debt_lock += debtAmt
+                        part.sum_aave_free_lock += freeAmt
+                        part.sum_aave_debt_lock_usd += debtAmtUsd
+                        part.sum_aave_free_lock_usd += freeAmtUsd
+
+                elif (trxType == 'Redeem' or trxType == 'RedeemUnderlying'):
+                    token1 = group_tokens[token1Symbol]
+                    if (protocol == 'Compound'):
+                        debtAmt = min(token1.compound_debt_collat, token1Amt)
+                        freeAmt = max(0, token1Amt - debtAmt)
+
+                        token1.compound_debt_collat = max(0, token1.compound_debt_collat - debtAmt)
+                        token1.compound_free_collat = max(0, token1.compound_free_collat - freeAmt)
+                    else:
+                        debtAmt = min(token1.aave_debt_collat, token1Amt)
+                        freeAmt = max(0, token1Amt - debtAmt)
+
+                        token1.aave_debt_collat = max(0, token1.aave_debt_collat - debtAmt)
+                        token1.aave_free_collat = max(0, token1.aave_free_collat - freeAmt)
+
+                    token1.wallet_debt += debtAmt
+                    token1.wallet_free += freeAmt
+
+                elif (trxType == 'Borrow'): # Borrow same transaction for both Aave and Compound
+                    token1 = group_tokens[token1Symbol]
+                    if (protocol == 'Compound'):
+                        token1.compound_withdraw_debt = min(0, token1.compound_withdraw_debt - token1Amt)
+                    else:
+                        token1.aave_withdraw_debt = min(0, token1.aave_withdraw_debt - token1Amt)
+
+                    token1.wallet_debt += token1Amt
+
+                elif (trxType == 'Repay' or trxType == 'RepayBorrow'):
+                    token1 = group_tokens[token1Symbol]
+                    if (protocol == 'Compound'):
+                        token1.compound_withdraw_debt = min(0, token1.compound_withdraw_debt + token1Amt)
+                    else:
+                        # Kept as in the original notebook (starts from the Compound balance). Withdrawn debt is only printed, so it
+                        # doesn't change the results
+                        token1.aave_withdraw_debt = min(0, token1.compound_withdraw_debt + token1Amt)
+
+                    token1.wallet_debt = max(0, token1.wallet_debt - token1Amt)
+
+            if (self.trace):
+                self._print_transaction(transac)
+                self._print_balances(group_tokens)
+
+            if (lockTransac):
+                rows.append({
+                    'trxId': transac[TRX_ID],
+                    'groupID': group_id,
+                    'blockTime': transac[BLOCK_TIME],
+                    'token': token1Symbol,
+                    'debtAmtUsd': debtAmtUsd,
+                    'freeAmtUsd': freeAmtUsd,
+                    'trxType': trxType,
+                    'protocol': protocol})
+
+        self.group_totals = group_sums
+        return rows
+
+    def _print_transaction(self, transac):
+        token1Amt = transac[TOKEN1_AMT]
+        token2Amt = transac[TOKEN2_AMT]
+        protocol = transac[PROTOCOL]
+        trxType = transac[TRX_TYPE]
+
+        if (trxType == 'Swap'):
+            action1, action2 = ('sent to', 'received from') if token1Amt >= token2Amt else ('received from', 'sent to')
+        elif (trxType == 'frob'):
+            action1 = 'locked in' if token1Amt > 0 else 'unlocked from'
+            action2 = 'withdrawn from' if token2Amt > 0 else 'repaid to'
+        else:
+            actions = {'Mint': 'locked in', 'Deposit': 'locked in', 'Redeem': 'unlocked from', 'RedeemUnderlying': 'unlocked from',
+                'Borrow': 'withdrawn from', 'Repay': 'repaid to', 'RepayBorrow': 'repaid to'}
+            print(f'\n{abs(round(token1Amt, 2))} {transac[TOKEN1_SYMBOL]} {actions.get(trxType)} {protocol}. ')
+            return
+
+        print(
+            f'\n{abs(round(token1Amt, 2))} {transac[TOKEN1_SYMBOL]} {action1}, {abs(round(token2Amt, 2))} {transac[TOKEN2_SYMBOL]} '
+            f'{action2} {protocol}. '
+        )
+
+    def _print_balances(self, group_tokens):
+        for token, data in group_tokens.items():
+            print(f"""
+{token}
+Wallet balance
+    Debt:                           {round(data.wallet_debt, 2)}
+    Free:                           {round(data.wallet_free, 2)}
+Maker balance
+    Debt collateral:                {round(data.maker_debt_collat, 2)}
+    Free collateral:                {round(data.maker_free_collat, 2)}
+    Withdrawn debt:                 {round(data.maker_withdraw_debt, 2)}
+Compound balance
+    Debt collateral:                {round(data.compound_debt_collat, 2)}
+    Free collateral:                {round(data.compound_free_collat, 2)}
+    Withdrawn debt:                 {round(data.compound_withdraw_debt, 2)}
+Aave balance
+    Debt collateral:                {round(data.aave_debt_collat, 2)}
+    Free collateral:                {round(data.aave_free_collat, 2)}
+    Withdrawn debt:                 {round(data.aave_withdraw_debt, 2)}""")
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}()')
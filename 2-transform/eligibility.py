@@ -0,0 +1,40 @@
+# Eligibility of address groups (step 2d of algo.ipynb): a group is eligible if its addresses appear in at least two protocols. Instead of
+# intersecting every group with the address set of each protocol, each address (by its index in addrGrouping.py) gets a bit mask of the
+# protocols it appears in, the masks of each group are combined with a bitwise OR, and the bits set in each group mask are counted
+import numpy as np
+
+# Number of bits set in each mask
+_POPCOUNT = np.array([bin(mask).count('1') for mask in range(256)], dtype = np.uint8)
+
+class ProtocolMasks:
+    """
+    A class representing the protocols in which each address and each address group appear, as bit masks
+
+    Attributes
+    ----------
+    address_masks (Array)       Mask of each address index (bit i set if the address appears in protocol i)
+    group_masks (Array)         Mask of each group (OR of the masks of its addresses)
+    group_ids (Array)           Group ID of each address index
+
+    Methods
+    -------
+    __init__                    Sets the mask of each address and of each group
+    eligible                    Returns whether each group appears in at least a number of protocols
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, grouper, protocol_addrs):
+        # Masks have 8 bits, so up to 8 protocols (4 are used: Compound, Uniswap, Maker and Aave)
+        self.address_masks = np.zeros(len(grouper), dtype = np.uint8)
+        for bit, addrs in enumerate(protocol_addrs):
+            self.address_masks[grouper.address_indexes(addrs)] |= np.uint8(1 << bit)
+
+        self.group_ids = grouper.group_id_array()
+        num_groups = int(self.group_ids.max()) + 1 if len(self.group_ids) > 0 else 0
+        self.group_masks = np.zeros(num_groups, dtype = np.uint8)
+        np.bitwise_or.at(self.group_masks, self.group_ids, self.address_masks)
+
+    def eligible(self, min_protocols = 2):
+        return _POPCOUNT[self.group_masks] >= min_protocols
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self.address_masks)} addresses, {len(self.group_masks)} groups)')
@@ -0,0 +1,92 @@
+# Index of the eligible transactions by address group (step 3b of algo.ipynb). Selecting the transactions of each group with isin scans
+# the whole DataFrame once per group. Here each address is mapped to its group, and the transactions are sorted once by group (a
+# transaction between two groups is in both), keeping their block order within each group. The transactions of a group are then a
+# contiguous slice, read in place. Addresses are integer IDs of the address book (utils/addressBook.py), so the group of every transaction is
+# found with array lookups
+from itertools import chain
+
+import numpy as np
+
+class GroupIndex:
+    """
+    A class representing the eligible transactions, partitioned by address group
+
+    Attributes
+    ----------
+    first_id (Integer)          ID of the first group in the index
+    group_ids (Array)           Group ID of each address ID (-1 for addresses outside the groups)
+    offsets (Array)             Position of the first transaction of each group (the last value is the number of transactions)
+    states (Dictionary)         Balances (by token) of groups at the start of their transactions, by group ID (empty groups start at 0)
+    _rows (Array)               Transactions (tuples, in the order of the DataFrame columns), sorted by group
+
+    Methods
+    -------
+    __init__                    Maps address IDs to groups, and partitions the transactions (addr1 and addr2 columns of address IDs)
+    transactions                Returns the transactions of a group (an iterator over the index, without copying them)
+    active_groups               Returns the IDs of the groups with transactions
+    shard                       Returns the index of a range of groups (e.g. to send to another process)
+    from_sorted                 Returns the index of transactions already sorted by group (e.g. read in chunks, transactionStream.py)
+    __len__                     Returns the number of groups
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, groups, transactions):
+        self.first_id = 0
+        self.states = {}
+        addr1 = transactions['addr1'].to_numpy(dtype = np.int64)
+        addr2 = transactions['addr2'].to_numpy(dtype = np.int64)
+        members = np.fromiter(chain.from_iterable(groups), dtype = np.int64)
+        size = max([int(addrs.max()) + 1 for addrs in [addr1, addr2, members] if len(addrs) > 0] + [1])
+        self.group_ids = np.full(size, -1, dtype = np.int64)
+        self.group_ids[members] = np.repeat(np.arange(len(groups), dtype = np.int64), [len(group) for group in groups])
+
+        # Group of each transaction (missing addresses, with negative IDs, have no group). A transaction between two addresses of different
+        # groups belongs to both
+        group1 = np.where(addr1 >= 0, self.group_ids[addr1], -1)
+        group2 = np.where(addr2 >= 0, self.group_ids[addr2], -1)
+        in_group1 = group1 >= 0
+        in_group2 = (group2 >= 0) & (group2 != group1)
+        row_positions = np.concatenate([np.nonzero(in_group1)[0], np.nonzero(in_group2)[0]])
+        row_groups = np.concatenate([group1[in_group1], group2[in_group2]])
+
+        # Sorted by group, and by position within each group, so that transactions stay in block order within each group
+        rows = list(zip(*transactions.to_dict("list").values()))
+        order = np.lexsort((row_positions, row_groups))
+        self._rows = [rows[i] for i in row_positions[order].tolist()]
+        counts = np.bincount(row_groups, minlength = len(groups))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def transactions(self, group_id):
+        start = self.offsets[group_id - self.first_id]
+        end = self.offsets[group_id - self.first_id + 1]
+        return map(self._rows.__getitem__, range(start, end))
+
+    def active_groups(self):
+        return (np.nonzero(np.diff(self.offsets))[0] + self.first_id).tolist()
+
+    def shard(self, first_id, end_id):
+        # The address map is not needed to read transactions, so it is not copied
+        start = self.offsets[first_id - self.first_id]
+        end = self.offsets[end_id - self.first_id]
+        shard = object.__new__(GroupIndex)
+        shard.first_id = first_id
+        shard.group_ids = np.empty(0, dtype = np.int64)
+        shard.states = {group_id: state for group_id, state in self.states.items() if first_id <= group_id < end_id}
+        shard.offsets = self.offsets[first_id - self.first_id:end_id - self.first_id + 1] - start
+        shard._rows = self._rows[start:end]
+        return shard
+
+    @classmethod
+    def from_sorted(cls, first_id, end_id, row_groups, rows):
+        index = object.__new__(cls)
+        index.first_id = first_id
+        index.group_ids = np.empty(0, dtype = np.int64)
+        index.states = {}
+        index.offsets = np.searchsorted(np.array(row_groups, dtype = np.int64), np.arange(first_id, end_id + 1)).astype(np.int64)
+        index._rows = rows
+        return index
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({len(self)} groups, {len(self._rows)} transactions)')
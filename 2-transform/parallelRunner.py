@@ -0,0 +1,109 @@
+# Parallel execution of the balance engine (balanceEngine.py). Address groups never share balances, so consecutive groups are split into
+# shards, which are processed in a process pool. Each shard only receives the transactions of its own groups (a slice of the group index,
+# groupIndex.py). Rows are returned in groupID order, and the totals of each shard are added in shard order. Shards don't depend on the
+# number of workers, so the totals are the same on every run
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from balanceEngine import BalanceEngine
+
+def _process_shard(index):
+    engine = BalanceEngine()
+    results = []
+    for group_id in range(index.first_id, index.first_id + len(index)):
+        group_tokens = index.states.get(group_id, {})
+        rows = engine.process_group(group_id, index.transactions(group_id), group_tokens)
+        results.append((group_id, rows, group_tokens, engine.group_totals))
+    return results, engine.sum_tokens
+
+class ParallelRunner:
+    """
+    A class that runs the balance engine on a range of address groups, in parallel
+
+    Attributes
+    ----------
+    max_workers (Integer)       Number of processes (1 to run in the current process, e.g. to print each transaction)
+    shard_groups (Integer)      Number of consecutive groups in each shard
+    trace (Boolean)             Whether each transaction and the group balances are printed (only with 1 worker)
+    sum_tokens (Dictionary)     Cumulative totals (TokenTotals) across all groups returned so far, by token symbol
+
+    Methods
+    -------
+    __init__                    Sets the options
+    run                         Processes consecutive group indexes (groupIndex.py), and returns the algoResults2 rows, the final
+                                balances and the part of the totals of each group, in groupID order
+    _shards                     Splits the group indexes into shards
+    _run_serial                 Same as run, in the current process
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, max_workers = 4, shard_groups = 1000, trace = False):
+        self.max_workers = max_workers
+        self.shard_groups = shard_groups
+        self.trace = trace
+        self.sum_tokens = {}
+
+    def run(self, indexes):
+        if (self.max_workers == 1 or self.trace):
+            yield from self._run_serial(indexes)
+            return
+
+        pool = ProcessPoolExecutor(max_workers = self.max_workers)
+        shards = self._shards(indexes)
+        running = {}            # running shards: future -> shard index
+        done = {}               # processed shards waiting for earlier shards: shard index -> (rows by group, totals)
+        shards_left = True
+        next_index = 0          # index of the next shard to submit
+        next_yield = 0          # index of the next shard to return
+
+        try:
+            while (shards_left or running or done):
+                # 1. Submit new shards. Shards waiting for an earlier shard also count, so that memory stays bounded (indexes read in
+                # chunks are only read when their shards are needed)
+                while (shards_left and len(running) + len(done) < 2 * self.max_workers):
+                    shard = next(shards, None)
+                    if (shard is None):
+                        shards_left = False
+                        break
+                    running[pool.submit(_process_shard, shard)] = next_index
+                    next_index += 1
+
+                # 2. Return processed shards in groupID order. Totals are added in the same order, so the result doesn't depend on which
+                # shard finishes first
+                if (next_yield in done):
+                    results, sum_tokens = done.pop(next_yield)
+                    next_yield += 1
+                    for token, totals in sum_tokens.items():
+                        # Missing symbols can be NaN (from pandas). Each process has its own NaN object, and NaN != NaN, so they are
+                        # matched here, as one token (same as in a single process)
+                        if (token != token):
+                            token = next((key for key in self.sum_tokens if key != key), token)
+                        if (token in self.sum_tokens):
+                            self.sum_tokens[token].add(totals)
+                        else:
+                            self.sum_tokens[token] = totals
+                    yield from results
+                    continue
+
+                # 3. Wait for the next shard to finish
+                finished, _ = wait(list(running), return_when = FIRST_COMPLETED)
+                for future in finished:
+                    done[running.pop(future)] = future.result()
+        finally:
+            pool.shutdown(wait = False, cancel_futures = True)
+
+    def _run_serial(self, indexes):
+        engine = BalanceEngine(trace = self.trace)
+        engine.sum_tokens = self.sum_tokens
+        for index in indexes:
+            for group_id in range(index.first_id, index.first_id + len(index)):
+                group_tokens = index.states.get(group_id, {})
+                rows = engine.process_group(group_id, index.transactions(group_id), group_tokens)
+                yield group_id, rows, group_tokens, engine.group_totals
+
+    def _shards(self, indexes):
+        for index in indexes:
+            end_id = index.first_id + len(index)
+            for first_id in range(index.first_id, end_id, self.shard_groups):
+                yield index.shard(first_id, min(first_id + self.shard_groups, end_id))
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.max_workers} workers, {self.shard_groups} groups per shard)')
@@ -0,0 +1,328 @@
+# Snapshots of the algorithm state, for incremental runs of step 3b of algo.ipynb. After a run, the balances of each group (wallet and
+# collateral and debt in each protocol, by token) and the cumulative totals are stored in SQL, with the last block of the transactions
+# replayed. The next run only replays the transactions after that block, for the groups they touch, starting from the stored balances,
+# and only appends the new algoResults2 rows. Rows, balances and progress are committed together, one batch of groups at a time, so an
+# interrupted run resumes after the last committed group. The first run (no snapshot) replays every transaction, into an empty
+# algoResults2 table. Group IDs are positions in the list of groups, which change when groups are added or merged, so balances are stored
+# by group key instead: the smallest address ID of the group (utils/addressBook.py). The key is also the groupID of the algoResults2 rows
+# (and of addrGroups2, in algo.ipynb). Groups only grow (new links merge them), so a group keeps its key, or takes over the keys of the
+# groups merged into it. The addresses replayed into the snapshot, and each group's part of the totals, are stored with the balances. At
+# the start of a run:
+# - groups whose addresses were all replayed (including groups merged together) start from the sum of the balances stored under their
+#   keys, and their rows and part of the totals move to the new key
+# - groups with an address that was never replayed (newly eligible groups, and groups that gained an address) are replayed from the first
+#   block, after their stored balances, rows and part of the totals are removed
+# History is still dropped in one case: a transaction sent before the snapshot from a newly eligible address (addr1) to a group that gained
+# no address was not read for that group (addr1 was not eligible, see transactionStream.py), and is not read by the next runs either,
+# because that group only replays blocks after the snapshot
+import hashlib
+from itertools import chain
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import text
+
+from balanceEngine import TokenBalance, TokenTotals
+
+class StateSnapshot:
+    """
+    A class representing the stored state of the algorithm (balances of each group, and cumulative totals)
+
+    Attributes
+    ----------
+    last_block (Integer)        Last block of the transactions replayed into the snapshot (None before the first run)
+    target_block (Integer)      Last block of the run in progress (None if no run is in progress)
+    next_group (Integer)        First group not committed yet by the run in progress
+    results_table (String)      Table of the algorithm rows, whose groupID is the group key
+    _engine (Engine)            SQLAlchemy engine
+    _hash (String)              Hash of the address groups of the run in progress (a run can only be resumed with the same groups)
+    _keys (Array)               Key of each group (smallest address ID), by group ID
+    _new_members (Array)        Address IDs of the run's groups that were never replayed (stored when the run finishes)
+
+    Methods
+    -------
+    __init__                    Creates the snapshot tables if needed, and reads the progress
+    start                       Starts a run up to a block (or resumes the run in progress), and returns its range of blocks and groups,
+                                and the groups to replay from the first block
+    load_states                 Adds the stored balances of the active groups to each group index (groupIndex.py)
+    commit                      Inserts algoResults2 rows (by group key), and stores the balances and part of the totals of their groups
+                                and the progress, in one transaction
+    finish                      Adds the totals of the run to the stored totals, stores the new addresses, and moves the snapshot to the
+                                last block of the run
+    totals                      Returns the stored totals (TokenTotals), by token symbol
+    _read_totals                Returns the totals of the snapshot, or of the run in progress
+    _write_totals               Writes the totals of the snapshot, or of the run in progress
+    _full_groups                Returns the groups with an address that was never replayed (replayed from the first block)
+    _merge_states               Removes the stored state of the groups replayed from the first block, and adds together the state of
+                                merged groups
+    _remove_keys                Removes the balances, rows and part of the totals of groups, and subtracts that part from the totals
+    _move_keys                  Adds the balances and part of the totals of groups to the groups they joined, and moves their rows
+    _groups_hash                Returns a hash of the address groups
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    _create_queries = [
+        """
+        CREATE TABLE IF NOT EXISTS algoSnapshot (
+            id TINYINT NOT NULL,
+            lastBlock INT NULL,
+            targetBlock INT NULL,
+            nextGroup INT NULL,
+            groupsHash CHAR(32) NOT NULL,
+            updated DATETIME NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS algoGroupState (groupKey INT NOT NULL, token VARCHAR(20) NOT NULL, "
+        + ', '.join([f'{name} DOUBLE NOT NULL' for name in TokenBalance.__slots__]) + ", PRIMARY KEY (groupKey, token))",
+        "CREATE TABLE IF NOT EXISTS algoTokenTotals (token VARCHAR(20) NOT NULL, pending TINYINT NOT NULL, "
+        + ', '.join([f'{name} DOUBLE NOT NULL' for name in TokenTotals.__slots__]) + ", PRIMARY KEY (token, pending))",
+        "CREATE TABLE IF NOT EXISTS algoGroupTotals (groupKey INT NOT NULL, token VARCHAR(20) NOT NULL, "
+        + ', '.join([f'{name} DOUBLE NOT NULL' for name in TokenTotals.__slots__]) + ", PRIMARY KEY (groupKey, token))",
+        "CREATE TABLE IF NOT EXISTS algoGroupMembers (addressID INT NOT NULL, PRIMARY KEY (addressID))",
+    ]
+
+    def __init__(self, engine, results_table = 'algoResults2'):
+        self._engine = engine
+        self.results_table = results_table
+        with self._engine.begin() as connection:
+            for query in self._create_queries:
+                connection.execute(text(query))
+            row = connection.execute(text('SELECT lastBlock, targetBlock, nextGroup, groupsHash FROM algoSnapshot WHERE id = 1')).fetchone()
+        self.last_block, self.target_block, self.next_group, self._hash = row if row is not None else (None, None, None, None)
+        self._keys = []
+        self._new_members = np.empty(0, dtype = np.int64)
+
+    def start(self, target_block, groups):
+        self._keys = [min(group) for group in groups]
+        groups_hash = self._groups_hash(groups)
+
+        # A run in progress is resumed with the same range of blocks, so that its committed groups are not replayed. Its progress is a
+        # group ID, so the groups must be the same as when it started
+        if (self.target_block is not None and self._hash != groups_hash):
+            raise ValueError(
+                f'Address groups changed during the run in progress (up to block {self.target_block}). Finish it with the same groups, and '
+                'run again with the new groups'
+            )
+        with self._engine.begin() as connection:
+            # The stored state is changed once, when the run starts. A resumed run finds the same groups to replay from the first block,
+            # because new addresses are only stored when the run finishes
+            full_groups = self._full_groups(connection, groups) if (self.last_block is not None) else []
+            if (self.last_block is not None and self.target_block is None):
+                self._merge_states(connection, groups, full_groups)
+            if (self.last_block is None):
+                self._new_members = np.fromiter(chain.from_iterable(groups), dtype = np.int64)
+            if (self.target_block is None):
+                query = """
+                    INSERT INTO algoSnapshot (id, lastBlock, targetBlock, nextGroup, groupsHash, updated)
+                    VALUES (1, :last_block, :target_block, 0, :groups_hash, :updated)
+                    ON DUPLICATE KEY UPDATE targetBlock = VALUES(targetBlock), nextGroup = VALUES(nextGroup), groupsHash = VALUES(groupsHash),
+                    updated = VALUES(updated)
+                """
+                connection.execute(text(query), {
+                    'last_block': self.last_block, 'target_block': target_block, 'groups_hash': groups_hash,
+                    'updated': datetime.now(timezone.utc).replace(tzinfo = None)
+                })
+        if (self.target_block is None):
+            self.target_block = target_block
+            self.next_group = 0
+            self._hash = groups_hash
+
+        first = 'the first block' if self.last_block is None else f'block {self.last_block + 1}'
+        print(f'Replaying transactions from {first} to block {self.target_block}, from group {self.next_group}')
+        if (len(full_groups) > 0):
+            print(f'{len(full_groups)} new or grown groups are replayed from the first block')
+        return self.last_block, self.target_block, self.next_group, self._read_totals(pending = 1), full_groups
+
+    def load_states(self, indexes):
+        columns = ', '.join(TokenBalance.__slots__)
+        for index in indexes:
+            group_ids = {self._keys[x]: x for x in index.active_groups()}
+            if (self.last_block is not None and len(group_ids) > 0):
+                query = f"SELECT groupKey, token, {columns} FROM algoGroupState WHERE groupKey IN ({', '.join(map(str, group_ids))})"
+                with self._engine.connect() as connection:
+                    for row in connection.execute(text(query)):
+                        balance = TokenBalance()
+                        for name, value in zip(TokenBalance.__slots__, row[2:]):
+                            setattr(balance, name, value)
+                        index.states.setdefault(group_ids[row[0]], {})[row[1]] = balance
+            yield index
+
+    def commit(self, table, rows, states, group_totals, next_group, sum_tokens):
+        state_columns = ', '.join(TokenBalance.__slots__)
+        state_query = (
+            f"INSERT INTO algoGroupState (groupKey, token, {state_columns}) "
+            f"VALUES (:groupKey, :token, {', '.join([':' + name for name in TokenBalance.__slots__])}) "
+            "ON DUPLICATE KEY UPDATE " + ', '.join([f'{name} = VALUES({name})' for name in TokenBalance.__slots__])
+        )
+        state_rows = []
+        for group_id, group_tokens in states.items():
+            for token, balance in group_tokens.items():
+                state_rows.append({
+                    'groupKey': self._keys[group_id], 'token': token, **{name: getattr(balance, name) for name in TokenBalance.__slots__}
+                })
+        # The part of the totals of each group is added to the part of its previous runs
+        totals_columns = ', '.join(TokenTotals.__slots__)
+        totals_query = (
+            f"INSERT INTO algoGroupTotals (groupKey, token, {totals_columns}) "
+            f"VALUES (:groupKey, :token, {', '.join([':' + name for name in TokenTotals.__slots__])}) "
+            "ON DUPLICATE KEY UPDATE " + ', '.join([f'{name} = {name} + VALUES({name})' for name in TokenTotals.__slots__])
+        )
+        totals_rows = []
+        for group_id, group_sums in group_totals.items():
+            for token, data in group_sums.items():
+                totals_rows.append({
+                    'groupKey': self._keys[group_id], 'token': token, **{name: getattr(data, name) for name in TokenTotals.__slots__}
+                })
+
+        # Rows are returned by group ID (position in the list of groups), and stored by group key, which doesn't change between runs
+        for row in rows:
+            row['groupID'] = self._keys[row['groupID']]
+
+        with self._engine.begin() as connection:
+            if (len(rows) > 0):
+                connection.execute(table.insert(), rows)
+            if (len(state_rows) > 0):
+                connection.execute(text(state_query), state_rows)
+            if (len(totals_rows) > 0):
+                connection.execute(text(totals_query), totals_rows)
+            # Totals of the run so far. They replace the totals of the previous commit
+            self._write_totals(connection, sum_tokens, pending = 1)
+            connection.execute(text('UPDATE algoSnapshot SET nextGroup = :next_group, updated = :updated WHERE id = 1'), {
+                'next_group': next_group, 'updated': datetime.now(timezone.utc).replace(tzinfo = None)
+            })
+        self.next_group = next_group
+
+    def finish(self, step = 10000):
+        totals = self._read_totals(pending = 0)
+        for token, run_totals in self._read_totals(pending = 1).items():
+            if (token in totals):
+                totals[token].add(run_totals)
+            else:
+                totals[token] = run_totals
+
+        with self._engine.begin() as connection:
+            self._write_totals(connection, totals, pending = 0)
+            connection.execute(text('DELETE FROM algoTokenTotals WHERE pending = 1'))
+            # Addresses of the run's groups are now replayed up to its last block
+            members = [{'addressID': address_id} for address_id in self._new_members.tolist()]
+            for i in range(0, len(members), step):
+                connection.execute(text('INSERT INTO algoGroupMembers (addressID) VALUES (:addressID)'), members[i:i+step])
+            connection.execute(text(
+                'UPDATE algoSnapshot SET lastBlock = targetBlock, targetBlock = NULL, nextGroup = NULL, updated = :updated WHERE id = 1'
+            ), {'updated': datetime.now(timezone.utc).replace(tzinfo = None)})
+        self.last_block = self.target_block
+        self.target_block = None
+        self.next_group = None
+        self._new_members = np.empty(0, dtype = np.int64)
+
+    def totals(self):
+        return self._read_totals(pending = 0)
+
+    def _read_totals(self, pending, connection = None):
+        if (connection is None):
+            with self._engine.connect() as connection:
+                return self._read_totals(pending, connection)
+        columns = ', '.join(TokenTotals.__slots__)
+        totals = {}
+        query = f'SELECT token, {columns} FROM algoTokenTotals WHERE pending = :pending ORDER BY token'
+        for row in connection.execute(text(query), {'pending': pending}):
+            data = TokenTotals()
+            for name, value in zip(TokenTotals.__slots__, row[1:]):
+                setattr(data, name, value)
+            totals[row[0]] = data
+        return totals
+
+    def _write_totals(self, connection, totals, pending):
+        columns = ', '.join(TokenTotals.__slots__)
+        query = (
+            f"REPLACE INTO algoTokenTotals (token, pending, {columns}) "
+            f"VALUES (:token, :pending, {', '.join([':' + name for name in TokenTotals.__slots__])})"
+        )
+        rows = [
+            {'token': token, 'pending': pending, **{name: getattr(data, name) for name in TokenTotals.__slots__}} for token, data in totals.items()
+        ]
+        if (len(rows) > 0):
+            connection.execute(text(query), rows)
+
+    def _full_groups(self, connection, groups):
+        # Addresses never replayed into the snapshot: their history (and so that of their group) is missing
+        members = np.fromiter(chain.from_iterable(groups), dtype = np.int64)
+        replayed = np.fromiter((row[0] for row in connection.execute(text('SELECT addressID FROM algoGroupMembers'))), dtype = np.int64)
+        is_new = ~np.isin(members, replayed)
+        self._new_members = members[is_new]
+        member_groups = np.repeat(np.arange(len(groups), dtype = np.int64), [len(group) for group in groups])
+        return np.unique(member_groups[is_new]).tolist()
+
+    def _merge_states(self, connection, groups, full_groups):
+        # Group of each address ID, and group of each stored key (-1 for keys outside the groups, e.g. addresses no longer eligible, whose
+        # balances are kept as they are)
+        members = np.fromiter(chain.from_iterable(groups), dtype = np.int64)
+        group_ids = np.full(int(members.max()) + 1 if len(members) > 0 else 0, -1, dtype = np.int64)
+        group_ids[members] = np.repeat(np.arange(len(groups), dtype = np.int64), [len(group) for group in groups])
+        stored = np.array([row[0] for row in connection.execute(text('SELECT DISTINCT groupKey FROM algoGroupState'))], dtype = np.int64)
+        stored_groups = np.full(len(stored), -1, dtype = np.int64)
+        inside = stored < len(group_ids)
+        stored_groups[inside] = group_ids[stored[inside]]
+        is_full = np.zeros(len(groups), dtype = bool)
+        is_full[full_groups] = True
+
+        # Keys inside a group replayed from the first block: their state would be counted twice
+        removed = [int(key) for key, x in zip(stored.tolist(), stored_groups.tolist()) if x >= 0 and is_full[x]]
+        if (len(removed) > 0):
+            self._remove_keys(connection, removed)
+            print(f'Balances of {len(removed)} groups that gained addresses were removed, to replay them from the first block')
+
+        # Keys that are not the key of their group any more: the group was merged into another one (or took an address with a smaller ID)
+        moved = {
+            int(key): self._keys[x] for key, x in zip(stored.tolist(), stored_groups.tolist())
+            if x >= 0 and not is_full[x] and key != self._keys[x]
+        }
+        if (len(moved) > 0):
+            self._move_keys(connection, moved)
+            print(f'Balances of {len(moved)} merged groups were added to the groups they joined')
+
+    def _remove_keys(self, connection, keys):
+        key_list = ', '.join(map(str, keys))
+        columns = ', '.join(TokenTotals.__slots__)
+        totals = self._read_totals(0, connection)
+        for row in connection.execute(text(f"SELECT token, {columns} FROM algoGroupTotals WHERE groupKey IN ({key_list})")):
+            data = totals.setdefault(row[0], TokenTotals())
+            for name, value in zip(TokenTotals.__slots__, row[1:]):
+                setattr(data, name, getattr(data, name) - value)
+        self._write_totals(connection, totals, pending = 0)
+        connection.execute(text(f"DELETE FROM algoGroupTotals WHERE groupKey IN ({key_list})"))
+        connection.execute(text(f"DELETE FROM algoGroupState WHERE groupKey IN ({key_list})"))
+        connection.execute(text(f"DELETE FROM {self.results_table} WHERE groupID IN ({key_list})"))
+
+    def _move_keys(self, connection, moved):
+        old_keys = ', '.join(map(str, set(moved) | set(moved.values())))
+        for table, record_class in [('algoGroupState', TokenBalance), ('algoGroupTotals', TokenTotals)]:
+            columns = ', '.join(record_class.__slots__)
+            merged = {}
+            for row in connection.execute(text(f"SELECT groupKey, token, {columns} FROM {table} WHERE groupKey IN ({old_keys})")):
+                key = moved.get(row[0], row[0])
+                record = merged.setdefault((key, row[1]), record_class())
+                for name, value in zip(record_class.__slots__, row[2:]):
+                    setattr(record, name, getattr(record, name) + value)
+            connection.execute(text(f"DELETE FROM {table} WHERE groupKey IN ({old_keys})"))
+            if (len(merged) > 0):
+                connection.execute(text(
+                    f"INSERT INTO {table} (groupKey, token, {columns}) "
+                    f"VALUES (:groupKey, :token, {', '.join([':' + name for name in record_class.__slots__])})"
+                ), [
+                    {'groupKey': key, 'token': token, **{name: getattr(record, name) for name in record_class.__slots__}}
+                    for (key, token), record in merged.items()
+                ])
+        connection.execute(text(f'UPDATE {self.results_table} SET groupID = :new_key WHERE groupID = :old_key'), [
+            {'old_key': old_key, 'new_key': new_key} for old_key, new_key in moved.items()
+        ])
+
+    def _groups_hash(self, groups):
+        digest = hashlib.blake2b(digest_size = 16)
+        for group in groups:
+            # Groups hold address IDs (utils/addressBook.py), which never change once given
+            digest.update((','.join(map(str, sorted(group))) + ';').encode())
+        return digest.hexdigest()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.last_block})')
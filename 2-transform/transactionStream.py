@@ -0,0 +1,119 @@
+# Streaming read of the eligible transactions (step 3a of algo.ipynb). Instead of a query with every eligible address in an IN (...)
+# list, and a DataFrame with every transaction, the addresses are staged in a table with their group ID, and mergeRecordsCache is joined
+# on it. Rows are ordered by group and block on the server, and read in chunks with a server-side cursor, so memory depends on the chunk
+# size, not on the number of transactions. Each chunk is returned as a group index (groupIndex.py) of complete groups. With an address book
+# (utils/addressBook.py), groups hold address IDs, and the addr1 and addr2 columns of the rows are returned as address IDs. SQL tables hold
+# address strings, so the addresses are staged (and joined) as strings
+from bisect import bisect_left
+
+import pandas as pd
+from sqlalchemy import text, bindparam
+
+from groupIndex import GroupIndex
+
+class TransactionStream:
+    """
+    A class that reads the eligible transactions from SQL in chunks of complete address groups
+
+    Attributes
+    ----------
+    chunk_rows (Integer)        Number of rows read from the server-side cursor at a time
+    stage_table (String)        Table in which the eligible addresses are staged with their group ID
+    address_book (AddressBook)  Address book of the address IDs in the groups and rows (None if addresses are strings)
+    _engine (Engine)            SQLAlchemy engine. The stream uses its own connection, because an open server-side cursor blocks its
+                                connection (e.g. for the inserts into algoResults2)
+
+    Methods
+    -------
+    __init__                    Sets the engine and options
+    stage                       Writes the eligible addresses to the staging table, with their group ID
+    chunks                      Returns the transactions of a range of groups (optionally after a block, except for the groups replayed
+                                from the first block, and up to a block), one group index (complete groups) at a time
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    # Transactions whose addr1 is eligible are selected for the group of addr1 and for the group of addr2 (a transaction between two groups
+    # is returned for both). When both addresses are in the same group, UNION returns it once
+    _select_query = """
+        SELECT * FROM (
+            SELECT m.*, s.groupID AS stageGroupID FROM mergeRecordsCache m
+            JOIN {stage_table} s ON s.address = m.addr1
+            WHERE s.groupID >= :min_id AND s.groupID < :max_id{block_filter}
+            UNION
+            SELECT m.*, s.groupID AS stageGroupID FROM mergeRecordsCache m
+            JOIN {stage_table} e ON e.address = m.addr1
+            JOIN {stage_table} s ON s.address = m.addr2
+            WHERE s.groupID >= :min_id AND s.groupID < :max_id{block_filter}
+        ) t
+        ORDER BY stageGroupID, blockNumber, id
+    """
+
+    def __init__(self, engine, chunk_rows = 200000, stage_table = 'algoAddrStage', address_book = None):
+        self._engine = engine
+        self.chunk_rows = chunk_rows
+        self.stage_table = stage_table
+        self.address_book = address_book
+
+    def stage(self, groups, step = 10000):
+        with self._engine.connect() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS {self.stage_table}'))
+            connection.execute(text(
+                f'CREATE TABLE {self.stage_table} (address VARCHAR(42) NOT NULL, groupID INT NOT NULL, PRIMARY KEY (address), KEY (groupID))'
+            ))
+            group_ids = [x for x in range(len(groups)) for _ in groups[x]]
+            addrs = [addr for group in groups for addr in group]
+            if (self.address_book is not None):
+                addrs = self.address_book.addresses(addrs).tolist()
+            sqlArr = [{'address': addr, 'groupID': x} for addr, x in zip(addrs, group_ids)]
+            insert_query = text(f'INSERT INTO {self.stage_table} (address, groupID) VALUES (:address, :groupID)')
+            for i in range(0, len(sqlArr), step):
+                connection.execute(insert_query, sqlArr[i:i+step])
+
+    def chunks(self, min_id, max_id, first_block = None, last_block = None, full_groups = None):
+        # Blocks after first_block (e.g. the block of a state snapshot, stateSnapshot.py), up to last_block (included). The groups in
+        # full_groups (e.g. groups without a snapshot state) are read from the first block
+        block_filter = ''
+        params = {'min_id': min_id, 'max_id': max_id, 'first_block': first_block, 'last_block': last_block}
+        if (first_block is not None and full_groups):
+            block_filter += ' AND (m.blockNumber > :first_block OR s.groupID IN :full_groups)'
+            params['full_groups'] = list(full_groups)
+        elif (first_block is not None):
+            block_filter += ' AND m.blockNumber > :first_block'
+        if (last_block is not None):
+            block_filter += ' AND m.blockNumber <= :last_block'
+        query = text(self._select_query.format(stage_table = self.stage_table, block_filter = block_filter))
+        if ('full_groups' in params):
+            query = query.bindparams(bindparam('full_groups', expanding = True))
+
+        with self._engine.connect() as connection:
+            result = connection.execution_options(stream_results = True).execute(query, params)
+            columns = list(result.keys())
+            first_id = min_id
+            row_groups = []
+            rows = []
+
+            while True:
+                batch = result.fetchmany(self.chunk_rows)
+                if (len(batch) == 0):
+                    break
+                # Same conversion as pd.read_sql (e.g. DECIMAL values to float, NULL values to NaN in numeric columns), so that the
+                # algorithm sees the same values as with a DataFrame
+                chunk = pd.DataFrame.from_records(batch, columns = columns, coerce_float = True)
+                if (self.address_book is not None):
+                    chunk['addr1'] = self.address_book.ids(chunk['addr1'])
+                    chunk['addr2'] = self.address_book.ids(chunk['addr2'])
+                row_groups += chunk.pop('stageGroupID').tolist()
+                rows += zip(*chunk.to_dict("list").values())
+
+                # The last group may continue in the next batch, so it is kept for the next chunk
+                cut = bisect_left(row_groups, row_groups[-1])
+                if (cut > 0):
+                    yield GroupIndex.from_sorted(first_id, row_groups[-1], row_groups[:cut], rows[:cut])
+                    first_id = row_groups[-1]
+                    row_groups = row_groups[cut:]
+                    rows = rows[cut:]
+
+            # Groups after the last transaction (without transactions) are still returned, with no rows
+            yield GroupIndex.from_sorted(first_id, max_id, row_groups, rows)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.stage_table}, {self.chunk_rows} rows per chunk)')
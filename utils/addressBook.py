@@ -0,0 +1,172 @@
+# Persistent dictionary of addresses. Each 20-byte address gets a dense integer ID (0, 1, 2, ...) the first time it is seen, so that
+# addresses can be held as integers instead of 42-character strings: rows decoded in 1-scrape (RecordExplorer.set_address_ids) and the
+# address columns, groups and indexes of 2-transform. Sets and joins of addresses then become operations on integer arrays. IDs are never
+# changed once given: the file is the list of addresses in ID order (20 bytes each), and new addresses are only appended to it. Both stages
+# open the same file, so an address has the same ID in both. SQL tables still hold address strings: IDs are converted back when written
+import os, threading
+
+import numpy as np
+
+# Default file of the address book (shared by 1-scrape and 2-transform)
+ADDRESS_BOOK_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), '1-scrape', 'cache', 'addressBook.bin')
+# Number of bytes of an address
+ADDRESS_BYTES = 20
+# ID of a missing address (NULL in SQL, None or NaN in a DataFrame)
+NO_ADDRESS = -1
+
+# Value of each hex character (255 for any other character), and hex character of each value
+_HEX_VALUES = np.full(256, 255, dtype = np.uint8)
+for value, char in enumerate(b'0123456789abcdef'):
+    _HEX_VALUES[char] = value
+for value, char in enumerate(b'ABCDEF', start = 10):
+    _HEX_VALUES[char] = value
+_HEX_CHARS = np.frombuffer(b'0123456789abcdef', dtype = np.uint8)
+
+class AddressId(int):
+    """
+    A class representing an address as its ID in the address book. Decoded rows hold AddressId values instead of plain integers, so that
+    the writers (pageWriter.py, bulkLoader.py) can tell address columns apart and write them as address strings
+
+    Methods
+    -------
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({int(self)})')
+
+class AddressBook:
+    """
+    A class representing the dictionary of addresses, with the ID of each address
+
+    Attributes
+    ----------
+    path (String)               File of the address book (None if it is only kept in memory)
+    _ids (Dictionary)           ID of each address (20 bytes)
+    _addrs (Bytearray)          Addresses (20 bytes each), in ID order
+    _saved (Integer)            Number of addresses already in the file
+    _lock (Lock)                Lock for additions from other threads (e.g. decoding while the page writer converts IDs back)
+
+    Methods
+    -------
+    __init__                    Loads the addresses saved in the file
+    id                          Returns the ID of an address ("0x" + 40 hex characters) as an AddressId, adding it if needed
+    ids                         Returns the IDs of a column of addresses (strings), as an array, adding new addresses
+    hex_ids                     Returns the IDs of addresses laid out as rows x 40 hex characters (e.g. BigQuery words, batchDecoder.py),
+                                as an array, adding new addresses
+    address                     Returns the address of an ID ("0x" + 40 lowercase hex characters)
+    addresses                   Returns the addresses of an array of IDs, as an array of strings
+    sql_value                   Returns the address of an AddressId value (other values are returned as they are)
+    save                        Appends the addresses added since the last save to the file
+    _lookup                     Returns the IDs of addresses (20 bytes), adding new addresses
+    __len__                     Returns the number of addresses
+    __repr__                    Returns string output of the call by which the object was instantiated
+    """
+    def __init__(self, path = ADDRESS_BOOK_PATH):
+        self.path = path
+        self._ids = {}
+        self._addrs = bytearray()
+        self._lock = threading.Lock()
+        if (path is not None and os.path.exists(path)):
+            with open(path, 'rb') as f:
+                data = f.read()
+            # A partial address at the end of the file (interrupted save) is ignored, and overwritten by the next save
+            count = len(data) // ADDRESS_BYTES
+            self._addrs = bytearray(data[:count * ADDRESS_BYTES])
+            self._ids = {bytes(self._addrs[i * ADDRESS_BYTES:(i + 1) * ADDRESS_BYTES]): i for i in range(count)}
+        self._saved = len(self._ids)
+
+    def id(self, addr):
+        # Hex characters are case-insensitive, so a checksummed address has the same ID as the lowercase address
+        if (not addr.startswith('0x') or len(addr) != 2 + 2 * ADDRESS_BYTES):
+            raise ValueError(f'"{addr}" is not an address ("0x" + 40 hex characters)')
+        key = bytes.fromhex(addr[2:])
+        x = self._ids.get(key)
+        if (x is None):
+            x = self._lookup([key])[0]
+        return AddressId(x)
+
+    def ids(self, addrs):
+        # Each distinct address is only converted once
+        addrs = np.asarray(addrs, dtype = object)
+        ids = np.full(len(addrs), NO_ADDRESS, dtype = np.int64)
+        present = np.fromiter((isinstance(addr, str) for addr in addrs), dtype = bool, count = len(addrs))
+        uniques, inverse = np.unique(addrs[present].astype(str), return_inverse = True)
+        ids[present] = np.array([self.id(addr) for addr in uniques.tolist()], dtype = np.int64)[inverse]
+        return ids
+
+    def hex_ids(self, words):
+        # Two hex characters make one byte, so each row of 40 characters becomes one 20-byte address, without building a string
+        values = _HEX_VALUES[words]
+        if (values.shape[1] != 2 * ADDRESS_BYTES or (values == 255).any()):
+            raise ValueError('Addresses must be laid out as rows of 40 hex characters')
+        raw = np.ascontiguousarray((values[:, 0::2] << 4) | values[:, 1::2]).view(f'V{ADDRESS_BYTES}').ravel()
+        uniques, inverse = np.unique(raw, return_inverse = True)
+        return np.array(self._lookup([addr.tobytes() for addr in uniques]), dtype = np.int64)[inverse.ravel()]
+
+    def address(self, x):
+        if (x == NO_ADDRESS):
+            return None
+        if (x < 0 or x >= len(self)):
+            raise ValueError(f'Address ID {x} is not in the address book')
+        return '0x' + self._addrs[x * ADDRESS_BYTES:(x + 1) * ADDRESS_BYTES].hex()
+
+    def addresses(self, ids):
+        ids = np.asarray(ids, dtype = np.int64)
+        present = ids != NO_ADDRESS
+        if (len(ids) > 0 and (ids.min() < NO_ADDRESS or ids.max() >= len(self))):
+            raise ValueError('Address IDs are not in the address book')
+        # The view of the bytearray is released before the lock, because a bytearray can't grow while it is viewed
+        with self._lock:
+            raw = np.frombuffer(self._addrs, dtype = np.uint8).reshape(-1, ADDRESS_BYTES)[ids[present]]
+        chars = np.empty((len(raw), 2 + 2 * ADDRESS_BYTES), dtype = np.uint8)
+        chars[:, 0] = ord('0')
+        chars[:, 1] = ord('x')
+        chars[:, 2::2] = _HEX_CHARS[raw >> 4]
+        chars[:, 3::2] = _HEX_CHARS[raw & 15]
+        addrs = np.full(len(ids), None, dtype = object)
+        addrs[present] = chars.view(f'S{chars.shape[1]}').ravel().astype(f'U{chars.shape[1]}')
+        return addrs
+
+    def sql_value(self, value):
+        # SQL tables hold address strings, so IDs in decoded rows are converted back when the rows are written
+        if (isinstance(value, AddressId)):
+            return self.address(value)
+        return value
+
+    def save(self):
+        if (self.path is None):
+            return
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+            with open(self.path, 'ab') as f:
+                # IDs are positions in the file, so only this book's own additions can be appended: if another process saved addresses
+                # since this book was loaded, the same IDs would refer to different addresses
+                size = f.tell()
+                if (size // ADDRESS_BYTES != self._saved):
+                    raise ValueError(f'Address book {self.path} was changed by another process since it was loaded. Load it again, and repeat the run')
+                if (size % ADDRESS_BYTES != 0):
+                    f.truncate(self._saved * ADDRESS_BYTES)
+                f.write(self._addrs[self._saved * ADDRESS_BYTES:])
+                f.flush()
+                os.fsync(f.fileno())
+            self._saved = len(self._ids)
+
+    def _lookup(self, keys):
+        ids = self._ids
+        missing = [key for key in keys if key not in ids]
+        if (len(missing) > 0):
+            with self._lock:
+                # Checked again, in case another thread added the address in the meantime
+                for key in missing:
+                    if (key not in ids):
+                        ids[key] = len(ids)
+                        self._addrs += key
+        return [ids[key] for key in keys]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.path})')